@@ -0,0 +1,556 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Array-backed (columnar) storage of per-frame face annotations
+"""
+
+import numpy
+
+#: Number of key-points localized by flandmark
+LANDMARKS = 8
+
+#: The record layout used to store annotation tables in binary files
+RECORD = [
+    ('valid', 'bool', ()),
+    ('bbox', 'int32', (4,)),
+    ('landmarks', 'int32', (LANDMARKS, 2)),
+    ('eyes', 'int32', (2, 4)),
+    ('eye_centers', 'int32', (2, 2)),
+    ('face_remainder', 'int32', (4,)),
+    ]
+
+#: The layout of the index of a binary annotation cache. The width of the
+#: source field is set, when a cache is created, to the longest source path it
+#: contains, so paths are never truncated.
+INDEX = [
+    ('source', 'S'),
+    ('offset', 'int64'),
+    ('length', 'int64'),
+    ('mtime', 'float64'),
+    ('size', 'int64'),
+    ]
+
+class AnnotationTable(object):
+  """Stores the annotations of a video as arrays, with one entry per frame
+
+  Attributes:
+
+  valid
+    A boolean array ``(T,)`` indicating which frames are annotated
+
+  bbox
+    An ``int32`` array ``(T,4)`` with the bounding-box in which the key-point
+    localization took place (``x``, ``y``, ``width``, ``height``)
+
+  landmarks
+    An ``int32`` array ``(T,8,2)`` with the localized key-points
+
+  eyes
+    An ``int32`` array ``(T,2,4)`` with the right and left eye bounding-boxes
+
+  eye_centers
+    An ``int32`` array ``(T,2,2)`` with the right and left eye centers
+
+  face_remainder
+    An ``int32`` array ``(T,4)`` with the face remainder bounding-box
+
+  Entries for frames that are not annotated are meaningless. The table also
+  behaves like the dictionaries returned by
+  :py:func:`.utils.flandmark_load_annotations` (keyed by frame number), so it
+  can be used with all functions that take annotations as input. The
+  dictionary of a frame is only built when it is looked up and is not kept.
+  Functions processing frame after frame (e.g.
+  :py:func:`.utils.frame_differences`) use the lighter :py:meth:`regions`
+  instead.
+
+  Keyword parameters:
+
+  length
+    The number of frames in the video
+  """
+
+  def __init__(self, length):
+
+    self.valid = numpy.zeros((length,), dtype=bool)
+    self.bbox = numpy.zeros((length, 4), dtype='int32')
+    self.landmarks = numpy.zeros((length, LANDMARKS, 2), dtype='int32')
+    self.eyes = numpy.zeros((length, 2, 4), dtype='int32')
+    self.eye_centers = numpy.zeros((length, 2, 2), dtype='int32')
+    self.face_remainder = numpy.zeros((length, 4), dtype='int32')
+
+  @staticmethod
+  def from_records(records, length=None):
+    """Builds a table from a record array with the fields defined by
+    :py:data:`RECORD`. The table arrays are views to the records whenever
+    possible, so no data is copied (nor read, if the records are
+    memory-mapped). If ``length`` is larger than the number of records, the
+    table is padded with invalid entries.
+    """
+
+    if length is None: length = len(records)
+
+    if length > len(records):
+      retval = AnnotationTable(length)
+      for name, dtype, shape in RECORD:
+        getattr(retval, name)[:len(records)] = records[name]
+      return retval
+
+    retval = AnnotationTable(0)
+    for name, dtype, shape in RECORD:
+      setattr(retval, name, records[name][:length])
+    return retval
+
+  def records(self):
+    """Returns the contents of this table as a record array with the fields
+    defined by :py:data:`RECORD`"""
+
+    retval = numpy.zeros((len(self.valid),), dtype=RECORD)
+    for name, dtype, shape in RECORD: retval[name] = getattr(self, name)
+    return retval
+
+  @staticmethod
+  def read(filename, length=None, verbose=False):
+    """Reads all annotations in a (flandmark) text file at once
+
+    Every line in the file contains the frame number, the bounding-box and the
+    landmarks (as ``x y`` pairs), separated by spaces. No filtering is
+    applied (see :py:meth:`filter`) and the eye and face remainder
+    regions are not calculated (see :py:meth:`flandmark_calculate_regions`).
+
+    Keyword parameters:
+
+    filename
+      The name of the file to read the annotations from
+
+    length
+      The number of frames in the video. Annotations for frames after that are
+      ignored. If not set, the table is made just large enough to hold the
+      last annotated frame.
+
+    verbose
+      Prints some stuff about the file
+    """
+
+    import warnings
+
+    if verbose:
+      print "Loading annotations from '%s'..." % filename,
+
+    with warnings.catch_warnings(): #empty files are fine
+      warnings.simplefilter('ignore')
+      data = numpy.loadtxt(filename, dtype='int64', ndmin=2)
+
+    if verbose:
+      print "%d frames loaded" % len(data)
+
+    if not data.size: data = numpy.zeros((0, 5+2*LANDMARKS), dtype='int64')
+
+    if data.shape[1] != 5+2*LANDMARKS:
+      raise RuntimeError, "Annotations at `%s' have %d columns, expected %d" % \
+          (filename, data.shape[1], 5+2*LANDMARKS)
+
+    keys = data[:,0]
+    if length is None: length = keys.max() + 1 if len(keys) else 0
+    use = (keys >= 0) & (keys < length)
+    keys = keys[use]
+    data = data[use]
+
+    retval = AnnotationTable(length)
+    retval.valid[keys] = True
+    retval.bbox[keys] = data[:,1:5]
+    retval.landmarks[keys] = data[:,5:].reshape(len(data), LANDMARKS, 2)
+    return retval
+
+  @staticmethod
+  def flandmark_read(filename, length=None, min_width=50, max_jump=0.,
+      max_gap=0, verbose=False):
+    """Reads flandmark annotations from a text file, calculates the eye and
+    face remainder regions and filters the annotations (see
+    :py:meth:`filter`). See :py:meth:`read` for a description of the other
+    parameters.
+    """
+
+    retval = AnnotationTable.read(filename, length, verbose)
+    retval.flandmark_calculate_regions()
+    return retval.filter(min_width, max_jump, max_gap, verbose)
+
+  def copy(self):
+    """Returns a (deep) copy of this table"""
+
+    retval = AnnotationTable(0)
+    for name, dtype, shape in RECORD:
+      setattr(retval, name, numpy.array(getattr(self, name)))
+    return retval
+
+  def subsample(self, stride, length=None):
+    """Returns a table with the annotations for every ``stride`` frames of
+    this one (i.e. for frames ``0``, ``stride``, ``2*stride``, ...), to be
+    used with videos subsampled in the same way. The new table is at most
+    ``length`` entries long, if that is given. Arrays are views to the arrays
+    of this table."""
+
+    retval = AnnotationTable(0)
+    for name, dtype, shape in RECORD:
+      setattr(retval, name, getattr(self, name)[::stride][:length])
+    return retval
+
+  def filter(self, min_width=50, max_jump=0., max_gap=0, verbose=False):
+    """Filters annotations, in this order, by:
+
+    1. Removing annotations with bounding-boxes narrower than ``min_width``
+       pixels (see :py:meth:`filter_width`)
+    2. If ``max_jump`` is set, removing isolated landmark outliers (see
+       :py:meth:`filter_jumps`)
+    3. If ``max_gap`` is set, interpolating the annotations of short sequences
+       of missing frames (see :py:meth:`interpolate_gaps`)
+
+    Returns the filtered table, which is a copy of this one if any
+    annotations had to be interpolated, or this table otherwise.
+    """
+
+    retval = self
+    retval.filter_width(min_width, verbose)
+    if max_jump: retval.filter_jumps(max_jump, verbose)
+    if max_gap:
+      retval = retval.copy() #the table may be memory-mapped
+      retval.interpolate_gaps(max_gap, verbose)
+    return retval
+
+  def filter_width(self, min_width, verbose=False):
+    """Invalidates annotations with bounding-boxes narrower than
+    ``min_width`` pixels"""
+
+    remove = self.valid & (self.bbox[:,2] < min_width)
+
+    if verbose:
+      for key in numpy.nonzero(remove)[0]:
+        print "Annotation for frame %d was removed (width = %d is < %d)" % \
+            (key, self.bbox[key,2], min_width)
+
+    self.valid = self.valid & ~remove
+
+  def filter_jumps(self, max_jump, verbose=False):
+    """Invalidates annotations whose landmarks jump away from both the previous
+    and the next annotated frames
+
+    The jump between two annotations is the average distance between their
+    corresponding landmarks, divided by the width of the bounding-box. An
+    annotation is considered an outlier if its jump w.r.t. the closest valid
+    annotations before and after it (if any) is larger than ``max_jump``.
+    Sustained movements of the face are not affected.
+    """
+
+    keys = numpy.nonzero(self.valid)[0]
+    if len(keys) < 2: return
+
+    landmarks = self.landmarks[keys].astype('float64')
+    width = numpy.maximum(self.bbox[keys,2], 1).astype('float64')
+    distance = numpy.sqrt(((landmarks[1:] - landmarks[:-1])**2).sum(axis=2))
+    jump = distance.mean(axis=1)
+
+    before = numpy.ones((len(keys),), dtype=bool)
+    before[1:] = (jump / width[1:]) > max_jump
+    after = numpy.ones((len(keys),), dtype=bool)
+    after[:-1] = (jump / width[:-1]) > max_jump
+    remove = keys[before & after]
+
+    if verbose:
+      for key in remove:
+        print "Annotation for frame %d was removed (landmark jump > %g)" % \
+            (key, max_jump)
+
+    self.valid = numpy.array(self.valid)
+    self.valid[remove] = False
+
+  def interpolate_gaps(self, max_gap, verbose=False):
+    """Linearly interpolates the bounding-box and landmarks of sequences of up
+    to ``max_gap`` frames without annotations, between two annotated frames.
+    Eye and face remainder regions are calculated for the interpolated
+    frames."""
+
+    from .utils import round_half_away
+
+    length = len(self.valid)
+    positions = numpy.arange(length)
+
+    # the closest valid frames before and after every frame (or -1/length)
+    previous = numpy.maximum.accumulate(numpy.where(self.valid, positions, -1))
+    following = numpy.where(self.valid, positions, length)
+    following = numpy.minimum.accumulate(following[::-1])[::-1]
+
+    fill = ~self.valid & (previous >= 0) & (following < length) & \
+        ((following - previous - 1) <= max_gap)
+    keys = numpy.nonzero(fill)[0]
+    if not len(keys): return
+
+    previous = previous[keys]
+    following = following[keys]
+    weight = (keys - previous) / (following - previous).astype('float64')
+
+    for name in ('bbox', 'landmarks'):
+      arr = getattr(self, name)
+      w = weight.reshape((len(keys),) + (1,) * (arr.ndim-1))
+      start = arr[previous].astype('float64')
+      arr[keys] = round_half_away(start + w * (arr[following] - start))
+
+    if verbose:
+      for key in keys:
+        print "Annotation for frame %d was interpolated" % key
+
+    self.valid[keys] = True
+    self.flandmark_calculate_regions(keys=keys)
+
+  def flandmark_calculate_regions(self, width_enlargement=0.1,
+      height_proportion=0.5, keys=None):
+    """Calculates the eye and face remainder regions for all valid frames,
+    taking into consideration the landmarks were extracted automatically using
+    flandmark. The eye region geometry can be tuned with the parameters
+    ``width_enlargement`` and ``height_proportion`` (see
+    :py:func:`.utils.flandmark_eye_regions`). If ``keys`` is given, regions
+    are only calculated for those frames."""
+
+    from .utils import flandmark_eye_regions, flandmark_face_remainders
+
+    if keys is None: keys = numpy.nonzero(self.valid)[0]
+    landmarks = self.landmarks[keys]
+    self.eyes[keys], self.eye_centers[keys] = flandmark_eye_regions(landmarks,
+        width_enlargement, height_proportion)
+    self.face_remainder[keys] = flandmark_face_remainders(landmarks)
+
+  def arrays(self):
+    """Returns the tuple ``(valid, eyes, eye_centers, face_remainder)``, as
+    expected by :py:func:`.utils.video_features`"""
+
+    return self.valid, self.eyes, self.eye_centers, self.face_remainder
+
+  def regions(self, key, default=None):
+    """Returns the annotation of a frame restricted to the regions read by the
+    difference step, as a dictionary with the ``bbox``, ``eyes``,
+    ``eye_centers`` and ``face_remainder`` entries (as lists), or
+    ``default``, if the frame is not annotated. This is cheaper than
+    :py:meth:`get`, which also converts the landmarks and builds tuples."""
+
+    if not (0 <= key < len(self.valid) and self.valid[key]): return default
+    return {
+        'bbox': self.bbox[key].tolist(),
+        'eyes': self.eyes[key].tolist(),
+        'eye_centers': self.eye_centers[key].tolist(),
+        'face_remainder': self.face_remainder[key].tolist(),
+        }
+
+  # dictionary-like interface
+
+  def __len__(self):
+    return int(self.valid.sum())
+
+  def has_key(self, key):
+    return 0 <= key < len(self.valid) and bool(self.valid[key])
+
+  __contains__ = has_key
+
+  def __getitem__(self, key):
+    retval = self.get(key)
+    if retval is None: raise KeyError, key
+    return retval
+
+  def get(self, key, default=None):
+    if not (0 <= key < len(self.valid) and self.valid[key]): return default
+
+    def tuples(rows):
+      return tuple([tuple(k) for k in rows])
+
+    return {
+        'bbox': tuple(self.bbox[key].tolist()),
+        'landmark': tuples(self.landmarks[key].tolist()),
+        'eyes': tuples(self.eyes[key].tolist()),
+        'eye_centers': tuples(self.eye_centers[key].tolist()),
+        'face_remainder': tuple(self.face_remainder[key].tolist()),
+        }
+
+  def keys(self):
+    return numpy.nonzero(self.valid)[0].tolist()
+
+  def iterkeys(self):
+    return iter(self.keys())
+
+  __iter__ = iterkeys
+
+  def itervalues(self):
+    for key in self.keys(): yield self[key]
+
+  def iteritems(self):
+    for key in self.keys(): yield key, self[key]
+
+class AnnotationCache(object):
+  """A binary file with the (pre-calculated) annotation tables of many videos
+
+  The file contains two arrays in ``.npy`` format, one after the other: an
+  index (see :py:data:`INDEX`) followed by the records (see
+  :py:data:`RECORD`) of all videos, concatenated. The index keeps, for every
+  annotation source file (by its full path), the offset and number of its
+  records, as well as the modification time and size of the source at the
+  time the cache was created. The records are memory-mapped, so only the
+  tables of the videos that are used are ever read from disk.
+
+  Use :py:meth:`create` to create a new cache and :py:meth:`open` to open an
+  existing one.
+
+  Keyword parameters:
+
+  filename
+    The name of the file containing the cache
+  """
+
+  _opened = {}
+
+  def __init__(self, filename):
+
+    from numpy.lib import format
+
+    self.filename = filename
+
+    f = open(filename, 'rb')
+    try:
+      format.read_magic(f)
+      shape, fortran, dtype = format.read_array_header_1_0(f)
+      index = numpy.fromfile(f, dtype=dtype, count=shape[0])
+      format.read_magic(f)
+      shape, fortran, dtype = format.read_array_header_1_0(f)
+      offset = f.tell()
+    finally:
+      f.close()
+
+    self.index = dict([(k['source'], k) for k in index])
+    if shape[0]:
+      self.records = numpy.memmap(filename, dtype=dtype, mode='r',
+          offset=offset, shape=shape)
+    else:
+      self.records = numpy.zeros((0,), dtype=dtype)
+
+  @staticmethod
+  def key(source):
+    """Returns the key used to index a given annotation source file"""
+
+    import os
+    return os.path.realpath(source)
+
+  @staticmethod
+  def open(filename):
+    """Opens an existing cache, re-using the one already opened by this
+    process, if that is the case"""
+
+    if filename not in AnnotationCache._opened:
+      AnnotationCache._opened[filename] = AnnotationCache(filename)
+    return AnnotationCache._opened[filename]
+
+  @staticmethod
+  def create(filename, sources, verbose=False):
+    """Creates a new cache with the annotations of the given source files
+
+    The annotations are read and the eye and face remainder regions calculated
+    for all annotated frames. No filtering is applied: this is done when the
+    tables are loaded back, so the filtering parameters can be changed without
+    re-creating the cache.
+
+    Keyword parameters:
+
+    filename
+      The name of the file to create
+
+    sources
+      An iterable over the (flandmark) annotation files to store
+
+    verbose
+      Prints some stuff about every file
+    """
+
+    import os
+    from numpy.lib import format
+
+    index = []
+    records = []
+    offset = 0
+    for source in sources:
+      stat = os.stat(source)
+      table = AnnotationTable.read(source, verbose=verbose)
+      table.flandmark_calculate_regions()
+      records.append(table.records())
+      index.append((AnnotationCache.key(source), offset, len(records[-1]),
+        stat.st_mtime, stat.st_size))
+      offset += len(records[-1])
+
+    width = max([len(k[0]) for k in index] + [1])
+    layout = [('source', 'S%d' % width)] + INDEX[1:]
+    index = numpy.array(index, dtype=layout)
+    if records: records = numpy.concatenate(records)
+    else: records = numpy.zeros((0,), dtype=RECORD)
+
+    # writes and renames, so an existing cache is always complete
+    partial = filename + '.partial'
+    f = open(partial, 'wb')
+    try:
+      format.write_array(f, index)
+      format.write_array(f, records)
+    finally:
+      f.close()
+    os.rename(partial, filename)
+
+    AnnotationCache._opened.pop(filename, None)
+
+  def table(self, source, length=None):
+    """Returns the annotation table for a given source file
+
+    If the source file is not in the cache or was modified after the cache was
+    created, returns ``None``. The table returned is memory-mapped and should
+    not be modified. See :py:meth:`AnnotationTable.from_records` for the
+    meaning of ``length``.
+    """
+
+    import os
+
+    entry = self.index.get(AnnotationCache.key(source))
+    if entry is None: return None
+
+    stat = os.stat(source)
+    if entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+      return None
+
+    records = self.records[entry['offset']:(entry['offset']+entry['length'])]
+    return AnnotationTable.from_records(records, length)
+
+def flandmark_load(source, length=None, min_width=50, max_jump=0., max_gap=0,
+    cache=None, verbose=False):
+  """Loads flandmark annotations, using a binary cache if possible
+
+  Keyword parameters:
+
+  source
+    The (flandmark) annotation text file
+
+  length
+    The number of frames in the video (see :py:meth:`AnnotationTable.read`)
+
+  min_width, max_jump, max_gap
+    Filtering parameters (see :py:meth:`AnnotationTable.filter`)
+
+  cache
+    The name of a file created with :py:meth:`AnnotationCache.create`. If the
+    file does not exist, or the annotations for ``source`` are missing or
+    stale in it, the text file is read instead.
+
+  verbose
+    Prints some stuff about the annotations loaded
+  """
+
+  import os
+
+  if cache is not None and os.path.exists(cache):
+    retval = AnnotationCache.open(cache).table(source, length)
+    if retval is not None:
+      if verbose:
+        print "Loaded %d annotations for '%s' from cache '%s'" % \
+            (retval.valid.sum(), source, cache)
+      return retval.filter(min_width, max_jump, max_gap, verbose)
+
+  return AnnotationTable.flandmark_read(source, length, min_width, max_jump,
+      max_gap, verbose)
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""On-disk caching of light-normalized face crops
+"""
+
+import os
+import numpy
+
+def read_regions(valid, eyes, face_remainder, shape):
+  """Calculates, for every frame of a video, the region read by the difference
+  step
+
+  The pair of frames ``(k-1, k)`` is only compared if both frames are
+  annotated, in which case the eye regions and the face remainder of the
+  annotation for frame ``k`` are read from both frames. The region of every
+  frame is the bounding box of all regions read from it.
+
+  Keyword parameters:
+
+  valid, eyes, face_remainder
+    The annotation arrays for the video, as returned by
+    :py:meth:`.annotations.AnnotationTable.arrays`
+
+  shape
+    The shape of the (gray-scaled) frames of the video
+
+  Returns an array of shape ``(T, 4)`` with the regions ``(y0, y1, x0, x1)``,
+  which are empty for frames that are not read at all.
+  """
+
+  from .utils import clip_boxes
+
+  valid = numpy.asarray(valid, dtype='bool')
+  length = len(valid)
+
+  # pair[k] is set if frames k-1 and k are compared
+  pair = numpy.zeros((length+1,), dtype='bool')
+  pair[1:length] = valid[1:] & valid[:-1]
+
+  boxes = numpy.concatenate((numpy.asarray(eyes).reshape(length, 2, 4),
+    numpy.asarray(face_remainder).reshape(length, 1, 4)), axis=1)
+  boxes = clip_boxes(boxes, shape)
+  following = numpy.zeros_like(boxes)
+  following[:-1] = boxes[1:]
+
+  # every frame is read on the regions for its own annotation (comparison with
+  # the previous frame) and for the annotation of the next frame
+  candidates = numpy.concatenate((boxes, following), axis=1)
+  used = numpy.concatenate((numpy.repeat(pair[:length,numpy.newaxis], 3, 1),
+    numpy.repeat(pair[1:,numpy.newaxis], 3, 1)), axis=1)
+  used &= (candidates[...,1] > candidates[...,0]) & \
+      (candidates[...,3] > candidates[...,2])
+
+  big = max(shape) + 1
+  retval = numpy.zeros((length, 4), dtype='int64')
+  retval[:,0] = numpy.where(used, candidates[...,0], big).min(axis=1)
+  retval[:,1] = numpy.where(used, candidates[...,1], 0).max(axis=1)
+  retval[:,2] = numpy.where(used, candidates[...,2], big).min(axis=1)
+  retval[:,3] = numpy.where(used, candidates[...,3], 0).max(axis=1)
+  retval[~used.any(axis=1)] = 0
+
+  return retval
+
+class NormalizedCrops(object):
+  """The (light-normalized) frames of a video, restricted to the regions read
+  by the difference step
+
+  Keyword parameters:
+
+  shape
+    The shape of the (gray-scaled) frames of the video
+
+  regions
+    An array of shape ``(T, 4)`` with the region ``(y0, y1, x0, x1)`` stored
+    for every frame (see :py:func:`read_regions`)
+
+  data
+    A 1D (uint8) array with the pixels of all regions, concatenated
+  """
+
+  def __init__(self, shape=(0, 0), regions=None, data=None):
+
+    self.shape = tuple(shape)
+    if regions is None: regions = numpy.zeros((0, 4), dtype='int64')
+    self.regions = numpy.asarray(regions, dtype='int64')
+    sizes = (self.regions[:,1] - self.regions[:,0]) * \
+        (self.regions[:,3] - self.regions[:,2])
+    self.offsets = numpy.zeros((len(sizes)+1,), dtype='int64')
+    numpy.cumsum(sizes, out=self.offsets[1:])
+    if data is None: data = numpy.zeros((self.offsets[-1],), dtype='uint8')
+    self.data = numpy.asarray(data, dtype='uint8')
+
+  def __len__(self):
+    return len(self.regions)
+
+  def frames(self):
+    """Yields the frames of the video, with all pixels outside the stored
+    regions set to zero"""
+
+    for key, (y0, y1, x0, x1) in enumerate(self.regions):
+      frame = numpy.zeros(self.shape, dtype='uint8')
+      frame[y0:y1, x0:x1] = self.data[self.offsets[key]:self.offsets[key+1]\
+          ].reshape(y1-y0, x1-x0)
+      yield frame
+
+  def save(self, filename):
+    """Saves the crops on the given (``.npz``) file"""
+
+    # writes and renames, so an existing file is always complete
+    partial = filename + '.partial'
+    f = open(partial, 'wb')
+    numpy.savez(f, shape=numpy.array(self.shape, dtype='int64'),
+        regions=self.regions, data=self.data)
+    f.close()
+    os.rename(partial, filename)
+
+  @staticmethod
+  def load(filename):
+    """Loads the crops from a file created with :py:meth:`save`"""
+
+    arrays = numpy.load(filename)
+    return NormalizedCrops(arrays['shape'], arrays['regions'], arrays['data'])
+
+class CropRecorder(object):
+  """Records the regions read by the difference step from the frames of a
+  video, as they are produced (see :py:meth:`record`)
+
+  The recorded crops are only available, as :py:attr:`crops`, once all frames
+  were produced, so the crops of a video that was not completely processed
+  are never cached.
+  """
+
+  def __init__(self):
+
+    self.crops = None
+
+  def record(self, frames, annotations):
+    """Stores the regions read by the difference step from the given frames
+
+    Keyword parameters:
+
+    frames
+      An iterable over the (light-normalized) frames of the video
+
+    annotations
+      The :py:class:`.annotations.AnnotationTable` for the video
+
+    This is a generator that yields every frame of ``frames``, unchanged.
+    """
+
+    valid, eyes, eye_centers, face_remainder = annotations.arrays()
+    shape = (0, 0)
+    regions = numpy.zeros((0, 4), dtype='int64')
+    crops = []
+    for key, frame in enumerate(frames):
+      if not crops:
+        shape = frame.shape
+        regions = read_regions(valid, eyes, face_remainder, shape)
+      y0, y1, x0, x1 = regions[key]
+      crops.append(frame[y0:y1, x0:x1].ravel().copy())
+      yield frame
+
+    self.crops = NormalizedCrops(shape, regions[:len(crops)],
+        numpy.concatenate(crops) if crops else None)
+
+class CropCache(object):
+  """A directory of :py:class:`NormalizedCrops`, one file per video, light
+  normalization strategy and parameters
+
+  Only the version of the light normalization (see
+  :py:data:`.stagecache.VERSIONS`) and the parameters that change the
+  normalized pixels (the annotations, the normalization strategy and the
+  normalized region) identify the crops, so
+  they are reused when any of the parameters of the following steps (e.g.
+  the maximum eye displacement) change.
+
+  Keyword parameters:
+
+  directory
+    The directory containing the cached crops. It is created if it does not
+    exist.
+  """
+
+  def __init__(self, directory):
+
+    self.directory = directory
+    if not os.path.exists(directory): os.makedirs(directory)
+
+  @staticmethod
+  def key(video, annotations, normalization, **parameters):
+    """Returns the key identifying the crops for a video
+
+    Keyword parameters:
+
+    video
+      The path to the video file
+
+    annotations
+      The path to the (flandmark) annotations for the video
+
+    normalization
+      The name of the light normalization strategy (see
+      :py:data:`.utils.LIGHT_NORMALIZATIONS`), whose registered parameters
+      are also taken into account
+
+    parameters
+      Any other parameters that affect the normalized pixels (e.g. the
+      annotation filtering parameters and the normalized region)
+    """
+
+    import hashlib
+    from .utils import LIGHT_NORMALIZATIONS
+    from .stagecache import VERSIONS
+
+    def identity(filename):
+      stat = os.stat(filename)
+      return (os.path.realpath(filename), stat.st_mtime, stat.st_size)
+
+    description = (VERSIONS['crops'], identity(video), identity(annotations),
+        normalization,
+        sorted(LIGHT_NORMALIZATIONS[normalization][2].items()),
+        sorted(parameters.items()))
+    return hashlib.sha1(repr(description)).hexdigest()
+
+  def path(self, key):
+    """Returns the path of the file for the given key"""
+
+    return os.path.join(self.directory, key + '.npz')
+
+  def load(self, key):
+    """Returns the crops for the given key or ``None``, if they are not cached"""
+
+    if not os.path.exists(self.path(key)): return None
+    return NormalizedCrops.load(self.path(key))
+
+  def save(self, key, crops):
+    """Caches the crops under the given key"""
+
+    crops.save(self.path(key))
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Running (cumulative) statistics for 1D signals
+
+The functions in this module calculate, in a single vectorized pass, the mean
+and the standard deviation (biased estimator) of every prefix ``arr[:(k+1)]``
+of an input signal. The class :py:class:`RunningMoments` does the same, but
+one sample at a time, so it can be used on live streams.
+
+The default ``welford`` method computes the running mean from a cumulative sum
+and the second central moment by accumulating Welford's increments, which is
+numerically stable for long streams. Because :py:class:`RunningMoments` uses
+exactly the same sequence of floating-point operations, both produce
+bit-identical results for the same input.
+"""
+
+import numpy
+
+METHODS = ('welford', 'sum')
+
+def _counts(shape):
+  """Returns the number of samples seen at each position of the last axis,
+  shaped so it broadcasts against an array of the given shape."""
+
+  retval = numpy.arange(1, shape[-1]+1, dtype='float64')
+  return retval.reshape((1,)*(len(shape)-1) + (shape[-1],))
+
+def cumulative_mean(arr):
+  """Calculates the running mean along the last axis of the input array
+
+  Element ``k`` of the output (on the last axis) contains the mean of the
+  elements ``0`` to ``k`` of the input.
+  """
+
+  arr = numpy.asarray(arr, dtype='float64')
+  return numpy.cumsum(arr, axis=-1) / _counts(arr.shape)
+
+def cumulative_moments(arr, method='welford'):
+  """Calculates the running mean and standard deviation (biased estimator)
+  along the last axis of the input array
+
+  Keyword parameters:
+
+  arr
+    The input signal. If the array has more than 1 dimension, the statistics
+    are calculated independently along the last axis.
+
+  method
+    One of ``welford`` (the default) or ``sum``. The ``sum`` method evaluates
+    the variance as ``E[x^2] - E[x]^2`` from cumulative sums. It is slightly
+    faster, but suffers from cancellation on long or offset signals. The
+    ``welford`` method accumulates the second central moment using the
+    increments ``(x[k] - mean[k-1]) * (x[k] - mean[k])``, which is stable.
+
+  Returns a tuple with two arrays with the same shape as the input, containing
+  the running mean and running standard deviation respectively.
+  """
+
+  if method not in METHODS:
+    raise RuntimeError, "Unknown method `%s' (use one of %s)" % \
+        (method, ', '.join(METHODS))
+
+  arr = numpy.asarray(arr, dtype='float64')
+  counts = _counts(arr.shape)
+  mean = numpy.cumsum(arr, axis=-1) / counts
+
+  if not arr.shape[-1]: return mean, numpy.copy(mean)
+
+  if method == 'sum':
+    var = (numpy.cumsum(arr**2, axis=-1) / counts) - mean**2
+    var[var < 0.] = 0. #cancellation may lead to tiny negative values
+    return mean, numpy.sqrt(var)
+
+  previous = numpy.empty_like(mean)
+  previous[...,0] = arr[...,0]
+  previous[...,1:] = mean[...,:-1]
+  m2 = numpy.cumsum((arr - previous) * (arr - mean), axis=-1)
+  return mean, numpy.sqrt(m2 / counts)
+
+def cumulative_std(arr, method='welford'):
+  """Calculates the running standard deviation (biased estimator) along the
+  last axis of the input array. See :py:func:`cumulative_moments` for details.
+  """
+
+  return cumulative_moments(arr, method)[1]
+
+class RunningMoments(object):
+  """Keeps the running mean and standard deviation (biased estimator) of a
+  signal, updated one sample at a time in constant time and memory.
+
+  Keyword parameters:
+
+  values
+    An optional iterable of values to initialize the statistics with
+  """
+
+  def __init__(self, values=()):
+
+    self.reset()
+    for k in values: self.update(k)
+
+  def reset(self):
+    """Forgets all samples seen so far"""
+
+    self.count = 0
+    self.total = 0.
+    self.m2 = 0.
+    self.mean = 0.
+
+  def update(self, value):
+    """Accounts for a new sample and returns the updated running mean and
+    standard deviation as a tuple"""
+
+    value = numpy.float64(value)
+    previous = self.mean if self.count else value
+    self.count += 1
+    self.total += value
+    self.mean = self.total / self.count
+    self.m2 += (value - previous) * (value - self.mean)
+    return self.mean, self.std
+
+  def merge(self, other):
+    """Accounts for all the samples in another :py:class:`RunningMoments`,
+    using Chan's parallel update for the second central moment. This allows
+    the statistics of long streams to be calculated in independent chunks."""
+
+    if not other.count: return
+    if not self.count:
+      self.count, self.total, self.m2, self.mean = \
+          other.count, other.total, other.m2, other.mean
+      return
+
+    count = self.count + other.count
+    delta = other.mean - self.mean
+    self.m2 += other.m2 + (delta**2 * self.count * other.count / count)
+    self.count = count
+    self.total += other.total
+    self.mean = self.total / self.count
+
+  @property
+  def variance(self):
+    """The running variance (biased estimator)"""
+
+    if not self.count: return numpy.float64(0.)
+    return self.m2 / self.count
+
+  @property
+  def std(self):
+    """The running standard deviation (biased estimator)"""
+
+    return numpy.sqrt(self.variance)
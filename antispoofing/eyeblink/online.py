@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Frame-by-frame (online) eye-blink detection for live video streams
+"""
+
+import numpy
+from .moments import RunningMoments
+
+class OnlineBlinkDetector(object):
+  """Detects eye-blinks incrementally, one pair of consecutive frames at a time
+
+  Every update costs constant time and memory, independently of how many
+  frames were already processed. The scores and blink counts produced are the
+  same as the ones obtained running :py:func:`.utils.score` and
+  :py:func:`.utils.count_blinks` on the features of the whole video.
+
+  As in the batch pipeline, the first frame of a video (which has no
+  predecessor) is accounted for with an undefined feature vector when the
+  detector is created or reset. Frames given to this detector should already
+  be light-normalized, if that is desired.
+
+  Keyword parameters:
+
+  max_displacement
+    Maximum displacement (w.r.t. to the eye width) between eye-centers to
+    consider the eye for calculating eye-differences
+
+  threshold_ratio
+    How many standard deviations from the running average of the scores a
+    peak should be to be counted as a blink
+
+  skip_frames
+    How many frames to skip before start eye-blink detection again (after an
+    eye-blink has been successfuly detected).
+
+  exact
+    If set, the face remainder is calculated from the exact intersection of
+    the face remainder and eye regions
+  """
+
+  def __init__(self, max_displacement=0.2, threshold_ratio=3.0,
+      skip_frames=10, exact=False):
+
+    self.max_displacement = max_displacement
+    self.threshold_ratio = threshold_ratio
+    self.skip_frames = skip_frames
+    self.exact = exact
+    self.buffer = None
+    self.reset()
+
+  def reset(self):
+    """Restarts detection for a new video"""
+
+    self.ratio_moments = RunningMoments()
+    self.score_moments = RunningMoments()
+    self.frames = 0
+    self.blinks = 0
+    self.score = None
+    self.skip = self.skip_frames #start by skipping the initial frames
+    self.push(numpy.NaN, numpy.NaN)
+
+  def __call__(self, frames, annotations):
+    """Processes the next pair of consecutive frames
+
+    Keyword parameters:
+
+    frames
+      A tuple with the previous and current gray-scaled frames
+
+    annotations
+      Annotations for the two frames (dictionaries with ``eyes``,
+      ``eye_centers`` and ``face_remainder`` fields or ``None``)
+
+    Returns a tuple with the score for the current frame and the number of
+    blinks detected so far.
+    """
+
+    from .utils import frame_features, DifferenceBuffer
+
+    if self.buffer is None: self.buffer = DifferenceBuffer()
+
+    return self.push(*frame_features(frames, annotations,
+      self.max_displacement, self.buffer, self.exact))
+
+  def push(self, eye, facerem):
+    """Processes the pre-computed features of the next frame
+
+    Keyword parameters:
+
+    eye
+      The normalized frame difference on the eye region
+
+    facerem
+      The normalized frame difference on the face remainder
+
+    Returns a tuple with the score for the current frame and the number of
+    blinks detected so far.
+    """
+
+    eye = numpy.float64(eye)
+    denominator = numpy.float64(facerem)
+    if denominator == 0.0: denominator = numpy.float64(1.0)
+
+    old_settings = numpy.seterr(invalid='ignore')
+    ratio = eye / denominator
+    numpy.seterr(**old_settings)
+    if numpy.isnan(ratio): ratio = numpy.float64(0.)
+
+    # see utils.score() for details
+    rm, rs = self.ratio_moments.update(ratio)
+    score = ratio - rm
+    if eye == 0.0: score = rm
+    if abs(score) < rs: score = rm
+    if score < rm: score = rm
+
+    # see utils.count_blinks() for details
+    rm, rs = self.score_moments.update(score)
+    if self.skip:
+      self.skip -= 1
+    elif (score - rm) >= (self.threshold_ratio * rs):
+      self.blinks += 1
+      self.skip = self.skip_frames
+
+    self.frames += 1
+    self.score = score
+    return self.score, self.blinks
+
+  def decide(self, features, blinks=1, budget=None):
+    """Processes pre-computed features until a decision can be made
+
+    Features are only consumed while needed, so if they are produced as the
+    video is decoded (e.g. with :py:func:`.utils.frame_differences`), decoding
+    stops as soon as a decision is made.
+
+    Keyword parameters:
+
+    features
+      An iterable over the features ``(eye, facerem)`` of the next frames
+
+    blinks
+      The number of blinks after which the video is accepted as a real access
+
+    budget
+      The maximum number of frames (including the first one) to process. If
+      set to ``None``, all available features may be processed.
+
+    Returns a tuple with the number of the last frame processed (the frame at
+    which the decision was made) and the number of blinks detected up to it.
+    The number of blinks is ``blinks`` if the video was accepted before the
+    budget ran out.
+    """
+
+    features = iter(features)
+    while self.blinks < blinks and (budget is None or self.frames < budget):
+      try:
+        eye, facerem = features.next()
+      except StopIteration:
+        break
+      self.push(eye, facerem)
+
+    return self.frames - 1, self.blinks
+
+  @property
+  def score_mean(self):
+    """The running average of the scores produced so far"""
+
+    return self.score_moments.mean
+
+  @property
+  def threshold(self):
+    """The current threshold for detecting a blink on the scores"""
+
+    return self.score_moments.mean + \
+        (self.threshold_ratio * self.score_moments.std)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Command-line programs for the eye-blink counter-measure
+"""
+
+def add_database_options(parser):
+  """Adds the options selecting the videos of the REPLAY-ATTACK database to
+  treat (``--protocol`` and ``--support``) to an argument parser"""
+
+  from xbob.db.replay import Database
+
+  protocols = [k.name for k in Database().protocols()]
+
+  parser.add_argument('-p', '--protocol', metavar='PROTOCOL', type=str,
+      default='grandtest', choices=protocols, dest="protocol",
+      help="The protocol type may be specified to subselect a smaller number of files to operate on (one of '%s'; defaults to '%%(default)s')" % '|'.join(sorted(protocols)))
+
+  supports = ('fixed', 'hand', 'hand+fixed')
+
+  parser.add_argument('-s', '--support', metavar='SUPPORT', type=str,
+      default='hand+fixed', dest='support', choices=supports, help="If you would like to select a specific support to be used, use this option (one of '%s'; defaults to '%%(default)s')" % '|'.join(sorted(supports)))
+
+def add_input_arguments(parser):
+  """Adds the (optional) positional arguments with the base directories of the
+  videos and of their (flandmark) annotations to an argument parser"""
+
+  import os
+  import sys
+
+  basedir = os.path.dirname(os.path.dirname(os.path.realpath(sys.argv[0])))
+  INPUTDIR = os.path.join(basedir, 'database')
+  ANNOTATIONS = os.path.join(basedir, 'annotations')
+
+  parser.add_argument('inputdir', metavar='DIR', type=str, default=INPUTDIR,
+      nargs='?', help='Base directory containing the videos to be treated by this procedure (defaults to "%(default)s")')
+  parser.add_argument('annotations', metavar='DIR', type=str,
+      default=ANNOTATIONS, nargs='?', help='Base directory containing the (flandmark) annotations to be treated by this procedure (defaults to "%(default)s")')
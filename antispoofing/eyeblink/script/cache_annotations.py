@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Converts the (flandmark) text annotations of all videos in a protocol into
+a single binary file that can be used as a cache by the other scripts in this
+package. Eye and face remainder regions are pre-calculated. Annotations whose
+text file changes after the cache was created are automatically re-read from
+the text file.
+"""
+
+import os
+import sys
+import argparse
+
+def main():
+  """Main method"""
+
+  from xbob.db.replay import Database
+  from . import add_database_options
+  from ..annotations import AnnotationCache
+
+  basedir = os.path.dirname(os.path.dirname(os.path.realpath(sys.argv[0])))
+  ANNOTATIONS = os.path.join(basedir, 'annotations')
+
+  parser = argparse.ArgumentParser(description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('annotations', metavar='DIR', type=str,
+      default=ANNOTATIONS, nargs='?', help='Base directory containing the (flandmark) annotations to be converted (defaults to "%(default)s")')
+  parser.add_argument('output', metavar='FILE', type=str,
+      help='Name of the binary file to create')
+
+  add_database_options(parser)
+
+  parser.add_argument('-v', '--verbose', action='store_true', dest='verbose',
+      default=False, help='Increases this script verbosity')
+
+  args = parser.parse_args()
+
+  if not os.path.exists(args.annotations):
+    parser.error("annotation directory `%s' does not exist" % args.annotations)
+
+  if args.support == 'hand+fixed': args.support = ('hand', 'fixed')
+
+  db = Database()
+
+  objs = db.objects(protocol=args.protocol, support=args.support,
+      cls=('real', 'attack', 'enroll'))
+
+  sources = [obj.make_path(args.annotations, '.flandmark') for obj in objs]
+  AnnotationCache.create(args.output, sources, args.verbose)
+
+  if args.verbose:
+    print "Saved annotations for %d video(s) at `%s'" % (len(sources),
+        args.output)
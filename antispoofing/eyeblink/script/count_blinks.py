@@ -12,45 +12,55 @@ import bob
 import numpy
 import argparse
 
+def add_blink_options(parser):
+  """Adds the options controlling the counting of eye-blinks (i.e. the
+  parameters of :py:func:`.utils.count_blinks`) to an argument parser"""
+
+  parser.add_argument('-S', '--skip-frames', metavar='INT', type=int,
+      default=10, dest='skip', help="Number of frames to skip once an eye-blink has been detected (defaults to %(default)s)")
+  parser.add_argument('-T', '--threshold-ratio', metavar='FLOAT', type=float,
+      default=3.0, dest='thres_ratio', help="How many standard deviations to use for counting positive blink picks to %(default)s)")
+
 def main():
   """Main method"""
   
   from xbob.db.replay import Database
+  from . import add_database_options
   from .. import utils
-
-  protocols = [k.name for k in Database().protocols()]
+  from .. import store
+  from ..store import StageInput, StageOutput, BlinkSummary, is_store
 
   parser = argparse.ArgumentParser(description=__doc__,
       formatter_class=argparse.RawDescriptionHelpFormatter)
-  parser.add_argument('inputdir', metavar='DIR', type=str, help='Base directory containing the scores to be loaded and merged')
-  parser.add_argument('outputdir', metavar='DIR', type=str, help='Base output directory for every file created by this procedure')
+  parser.add_argument('inputdir', metavar='DIR', type=str, help='Base directory (or store file, ending in ".store") containing the scores to be loaded and merged')
+  parser.add_argument('outputdir', metavar='DIR', type=str, help='Base output directory for every file created by this procedure. If the name ends in ".store", all blinks are saved on a single file, instead')
   
-  parser.add_argument('-p', '--protocol', metavar='PROTOCOL', type=str,
-      default='grandtest', choices=protocols, dest="protocol",
-      help="The protocol type may be specified to subselect a smaller number of files to operate on (one of '%s'; defaults to '%%(default)s')" % '|'.join(sorted(protocols)))
-
-  supports = ('fixed', 'hand', 'hand+fixed')
+  add_database_options(parser)
 
-  parser.add_argument('-s', '--support', metavar='SUPPORT', type=str, 
-      default='hand+fixed', dest='support', choices=supports, help="If you would like to select a specific support to be used, use this option (one of '%s'; defaults to '%%(default)s')" % '|'.join(sorted(supports))) 
+  add_blink_options(parser)
 
-  parser.add_argument('-S', '--skip-frames', metavar='INT', type=int,
-      default=10, dest='skip', help="Number of frames to skip once an eye-blink has been detected (defaults to %(default)s)")
-
-  parser.add_argument('-T', '--threshold-ratio', metavar='FLOAT', type=float,
-      default=3.0, dest='thres_ratio', help="How many standard deviations to use for counting positive blink picks to %(default)s)")
+  parser.add_argument('-t', '--stride', metavar='INT', type=int, default=1,
+      dest='stride', help="The stride used for calculating the frame differences with framediff.py. The number of frames to skip is scaled accordingly (defaults to %(default)s)")
 
   parser.add_argument('-v', '--verbose', action='store_true', dest='verbose',
       default=False, help='Increases this script verbosity')
 
   args = parser.parse_args()
 
-  if not os.path.exists(args.inputdir):
+  if not store.exists(args.inputdir):
     parser.error("input directory `%s' does not exist" % args.inputdir)
 
   if args.support == 'hand+fixed': args.support = ('hand', 'fixed')
 
-  if not os.path.exists(args.outputdir):
+  if args.stride < 1:
+    parser.error("the stride should be at least 1")
+
+  skip = utils.stride_skip_frames(args.skip, args.stride)
+  if args.verbose and args.stride > 1:
+    print "Stride %d: skipping %d score(s) after every blink" % \
+        (args.stride, skip)
+
+  if not is_store(args.outputdir) and not os.path.exists(args.outputdir):
     if args.verbose: print "Creating output directory %s..." % args.outputdir
     os.makedirs(args.outputdir)
 
@@ -59,14 +69,29 @@ def main():
   objs = db.objects(protocol=args.protocol, support=args.support,
       cls=('real', 'attack', 'enroll'))
 
+  # loads all scores and counts blinks for the whole protocol in one go
+  reader = StageInput(args.inputdir, '.hdf5')
+  scores = [reader.load(obj) for obj in objs]
+  lengths = [len(k) for k in scores]
+  blinks = utils.count_blinks_batch(utils.stack_sequences(scores),
+      args.thres_ratio, skip, lengths)
+
+  writer = StageOutput(args.outputdir, '.hdf5')
+  summary = []
+
   counter = 0
-  for obj in objs:
+  for obj, nb, length in zip(objs, blinks, lengths):
     counter += 1
-    arr = obj.load(args.inputdir, '.hdf5')
-    nb = utils.count_blinks(arr, args.thres_ratio, args.skip)
+    nb = nb[:length]
 
     if args.verbose:
       print "Processed file %s [%d/%d]... %d blink(s)" % \
-          (obj.path, counter, len(objs), nb[-1])
+          (obj.path, counter, len(objs), nb[-1] if length else 0)
+
+    writer.save(obj, nb)
+    summary.append((obj, nb))
+
+  writer.close()
 
-    obj.save(nb, args.outputdir, '.hdf5')
+  # saves the frames at which blinks were detected, for quick merging
+  BlinkSummary.write(args.outputdir, summary)
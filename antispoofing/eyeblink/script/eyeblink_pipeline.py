@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Runs the whole eye-blink counter-measure on the REPLAY-ATTACK database in a
+single pass: for every video, frame differences are calculated, scored and
+eye-blinks counted in memory, as framediff.py, make_scores.py and
+count_blinks.py would do. The 5-column score files and the error rates are
+produced at the end, as with merge_scores.py. Intermediate results are only
+saved if requested.
+"""
+
+import os
+import sys
+import argparse
+
+def run_video(task):
+  """Calculates features, scores and blinks for a single video, retrying on
+  failure
+
+  Keyword parameters:
+
+  task
+    A tuple containing the video filename, the annotations filename, a
+    dictionary with the keyword parameters for
+    :py:func:`.framediff.compute_features`, the threshold ratio and number of
+    frames to skip for counting blinks, the rows of the blink array to return,
+    a tuple of 3 flags indicating if the features, scores and blinks should be
+    returned, the stage cache directory (or ``None``), the number of retries
+    and a flag indicating if progress should be printed.
+
+  Returns a tuple with the number of blinks at the requested rows, a tuple
+  with the (requested) features, scores and blinks, and an error message,
+  which is ``None`` if the video was successfuly processed. Videos that are
+  too short for the requested rows are reported as such, without retrying.
+
+  If a stage cache is used, the features, scores and blinks are looked up in
+  it before being computed. The key of the scores depends on the key of the
+  features and the key of the blinks on the key of the scores, so only the
+  stages whose parameters (or inputs) changed are computed again.
+  """
+
+  from .. import utils
+  from ..stagecache import StageCache
+  from .framediff import compute_features, features_key
+
+  filename, annotations, parameters, thres_ratio, skip, rows, keep, \
+      cache_dir, retries, verbose = task
+
+  names = ('features', 'scores', 'blinks')
+
+  error = None
+  for attempt in range(retries+1):
+    try:
+      cache = None
+      if cache_dir is not None:
+        cache = StageCache(cache_dir)
+        keys = {'features': features_key(filename, annotations, parameters)}
+        keys['scores'] = StageCache.key('make_scores', {},
+            upstream=(keys['features'],))
+        keys['blinks'] = StageCache.key('count_blinks',
+            {'thres_ratio': thres_ratio, 'skip': skip},
+            upstream=(keys['scores'],))
+
+      computes = {
+          'features': lambda: compute_features(filename, annotations,
+            verbose=verbose, **parameters),
+          'scores': lambda: utils.score(get('features')),
+          'blinks': lambda: utils.count_blinks(get('scores'), thres_ratio,
+            skip),
+          }
+
+      results = {}
+      def get(name):
+        """Returns the result of a stage, loaded from the cache or computed
+        (and cached) once, only if needed"""
+
+        if name not in results:
+          if cache is not None: results[name] = cache.get(keys[name])
+          if results.get(name) is None:
+            results[name] = computes[name]()
+            if cache is not None: cache.put(keys[name], results[name])
+        return results[name]
+
+      blinks = get('blinks')
+      arrays = [get(k) if flag else None for k, flag in zip(names, keep)]
+      break
+    except Exception, e:
+      error = "%s: %s" % (type(e).__name__, e)
+  else:
+    return None, (None, None, None), error
+
+  # a short video fails the same way on every attempt, so it is checked here
+  needed = max(rows) + 1 if rows else 0
+  if len(blinks) < needed:
+    stride = parameters.get('stride', 1)
+    if stride == 1:
+      error = "video has only %d frames, %d are needed for the requested " \
+          "number of scores" % (len(blinks), needed)
+    else:
+      error = "video has only %d frames at stride %d, %d are needed for " \
+          "the requested number of scores" % (len(blinks), stride, needed)
+    return None, (None, None, None), error
+
+  return blinks[rows], tuple(arrays), None
+
+def main():
+  """Main method"""
+
+  import numpy
+  from xbob.db.replay import Database
+  from . import add_database_options, add_input_arguments
+  from .. import utils
+  from ..store import StageOutput, BlinkSummary
+  from .framediff import add_feature_options, add_cache_options, \
+      feature_parameters, evict_cache
+  from .count_blinks import add_blink_options
+  from .merge_scores import write_scores, report, add_scores_options, \
+      scores_ends
+
+  parser = argparse.ArgumentParser(description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+  add_input_arguments(parser)
+  parser.add_argument('outputdir', metavar='DIR', type=str,
+      help='Base output directory for the 5-column score files')
+
+  add_database_options(parser)
+
+  add_feature_options(parser)
+  add_cache_options(parser)
+
+  add_blink_options(parser)
+  add_scores_options(parser)
+
+  parser.add_argument('-F', '--save-features', metavar='PATH', type=str,
+      dest='save_features', help="Saves the frame differences on this directory (or store file, if the name ends in \".store\"), as framediff.py would")
+  parser.add_argument('-O', '--save-scores', metavar='PATH', type=str,
+      dest='save_scores', help="Saves the scores on this directory (or store file), as make_scores.py would")
+  parser.add_argument('-B', '--save-blinks', metavar='PATH', type=str,
+      dest='save_blinks', help="Saves the blinks on this directory (or store file), as count_blinks.py would")
+
+  parser.add_argument('-j', '--jobs', metavar='INT', type=int, default=1,
+      dest='jobs', help="Number of local processes to use for processing videos in parallel (defaults to %(default)s)")
+  parser.add_argument('-r', '--retries', metavar='INT', type=int, default=0,
+      dest='retries', help="Number of times to retry processing a video that failed before reporting it (defaults to %(default)s)")
+
+  parser.add_argument('-v', '--verbose', action='store_true', dest='verbose',
+      default=False, help='Increases this script verbosity')
+
+  args = parser.parse_args()
+
+  if args.support == 'hand+fixed': args.support = ('hand', 'fixed')
+
+  if args.jobs < 1:
+    parser.error("the number of jobs should be at least 1")
+
+  if args.stride < 1:
+    parser.error("the stride should be at least 1")
+
+  args.ends = scores_ends(args)
+
+  if not os.path.exists(args.outputdir):
+    if args.verbose: print "Creating output directory %s..." % args.outputdir
+    os.makedirs(args.outputdir)
+
+  parameters = feature_parameters(args)
+  skip = utils.stride_skip_frames(args.skip, args.stride)
+  rows = [utils.stride_row(k-1, args.stride) for k in args.ends]
+  paths = (args.save_features, args.save_scores, args.save_blinks)
+  keep = tuple([k is not None for k in paths])
+  writers = [StageOutput(k, '.hdf5') if k is not None else None \
+      for k in paths]
+
+  db = Database()
+
+  # all videos needed for the score files, grouped
+  groups = ('train', 'devel', 'test')
+  classes = ('real', 'attack')
+  objects = {}
+  process = []
+  for group in groups:
+    for cls in classes:
+      objects[(group, cls)] = db.objects(protocol=args.protocol,
+          support=args.support, groups=(group,), cls=(cls,))
+      process.extend(objects[(group, cls)])
+
+  tasks = [(str(obj.videofile(args.inputdir)),
+    obj.make_path(args.annotations, '.flandmark'), parameters,
+    args.thres_ratio, skip, rows, keep, args.cache_dir, args.retries,
+    args.verbose and args.jobs == 1) for obj in process]
+
+  if args.jobs == 1:
+    results = (run_video(k) for k in tasks)
+  else:
+    import multiprocessing
+    pool = multiprocessing.Pool(args.jobs)
+    results = pool.imap(run_video, tasks) #results come in submission order
+
+  from itertools import izip
+
+  counts = {}
+  summary = []
+  failed = []
+  for counter, (obj, task, (nb, arrays, error)) in \
+      enumerate(izip(process, tasks, results)):
+
+    if error is not None:
+      failed.append((task[0], error))
+      sys.stdout.write("File %s [%d/%d] FAILED: %s\n" % (task[0], counter+1,
+        len(tasks), error))
+      sys.stdout.flush()
+      continue
+
+    counts[obj.id] = nb
+    for writer, array in zip(writers, arrays):
+      if writer is not None: writer.save(obj, array)
+    if arrays[2] is not None: summary.append((obj, arrays[2]))
+
+    if args.verbose and args.jobs != 1:
+      sys.stdout.write("Processed file %s [%d/%d]\n" % (task[0], counter+1,
+        len(tasks)))
+      sys.stdout.flush()
+
+  if args.jobs != 1:
+    pool.close()
+    pool.join()
+
+  for writer in writers:
+    if writer is not None: writer.close()
+  if summary: BlinkSummary.write(args.save_blinks, summary)
+  evict_cache(args)
+
+  if failed:
+    print "%d out of %d video(s) could not be processed:" % (len(failed),
+        len(tasks))
+    for filename, error in failed: print " * %s: %s" % (filename, error)
+    return 1
+
+  def blinks(group, cls):
+    """The number of blinks for all videos of a group and class, at all rows"""
+
+    objs = objects[(group, cls)]
+    return numpy.array([counts[k.id] for k in objs]).reshape(len(objs),
+        len(rows))
+
+  for column, end in enumerate(args.ends):
+
+    if len(args.ends) != 1:
+      print "Number of scores: %d" % end
+
+    merged = {}
+    for group in groups:
+      if len(args.ends) == 1: name = '%s-5col.txt' % group
+      else: name = '%s-5col-%d.txt' % (group, end)
+
+      if args.verbose:
+        print "Writing '%s' (blinks at row %d)..." % (name, rows[column])
+
+      positives = blinks(group, 'real')[:,column]
+      negatives = blinks(group, 'attack')[:,column]
+      write_scores(os.path.join(args.outputdir, name),
+          objects[(group, 'real')], positives, objects[(group, 'attack')],
+          negatives, args.verbose)
+      merged[group] = (negatives, positives)
+
+    for nb in (1, 2, 3):
+      report(merged['devel'][0], merged['devel'][1], merged['test'][0],
+          merged['test'][1], nb)
+
+  return 0
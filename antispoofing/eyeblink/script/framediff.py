@@ -12,37 +12,402 @@ database and a baseline, Anjos & Marcel, IJCB'11.
 import os, sys
 import argparse
 
+# light normalizers are kept across videos (see compute_features())
+normalizers = {}
+
+def compute_features(filename, annotations, max_displacement, exact=False,
+    integral=False, batch=0, annotation_cache=None, min_width=50, max_jump=0.,
+    max_gap=0, normalization='histogram', region='face_remainder',
+    crop_cache=None, prefetch=0, stride=1, verbose=False):
+  """Calculates the normalized frame differences for a single video
+
+  Keyword parameters:
+
+  filename
+    The path to the video file to be processed
+
+  annotations
+    The path to the (flandmark) annotations for the video
+
+  max_displacement
+    Maximum displacement (w.r.t. to the eye width) between eye-centers to
+    consider the eye for calculating eye-differences
+
+  exact
+    If set, the face remainder is calculated from the exact intersection of
+    the face remainder and eye regions
+
+  integral
+    If set, all region sums are read from a single summed-area table per frame
+    pair
+
+  batch
+    If larger than 1, frame differences are calculated for blocks of this
+    number of frames at once (see :py:func:`.utils.video_features`) instead
+    of frame pair by frame pair
+
+  annotation_cache
+    The name of a binary annotation cache file (see ``cache_annotations.py``)
+    to load the annotations from, if they are available and up-to-date in it
+
+  min_width, max_jump, max_gap
+    Annotation filtering parameters (see
+    :py:meth:`.annotations.AnnotationTable.filter`)
+
+  normalization
+    The light normalization strategy (see
+    :py:data:`.utils.LIGHT_NORMALIZATIONS`)
+
+  region
+    The region of every frame to light-normalize (see
+    :py:class:`.utils.LightNormalizer`)
+
+  crop_cache
+    A directory where the normalized regions of the frames that are read for
+    calculating differences are cached (see :py:class:`.crops.CropCache`).
+    If the crops for all frames of this video are found, the video is not
+    decoded. Crops are only cached once all frames were processed.
+
+  prefetch
+    If larger than 0, frames are decoded and converted to gray-scale in a
+    background thread, up to this number of frames ahead of the ones being
+    processed (see :py:func:`.utils.prefetch`)
+
+  stride
+    Differences are calculated between frames ``k`` and ``k+stride``, for
+    every ``stride`` frames of the video (i.e. frames ``0``, ``stride``,
+    ``2*stride``, ...), instead of between consecutive frames
+
+  verbose
+    If set, prints progress information while processing the video
+
+  Returns a 2D array with the eye and face remainder differences for every
+  frame in the video (or every ``stride`` frames).
+  """
+
+  import bob
+  import numpy
+  from itertools import islice
+  from .. import utils
+  from ..annotations import flandmark_load
+  from ..crops import CropCache, CropRecorder
+
+  input = bob.io.VideoReader(filename)
+  total = input.number_of_frames
+  length = (total + stride - 1) // stride
+
+  crops = recorder = None
+  if crop_cache is not None:
+    cache = CropCache(crop_cache)
+    key = cache.key(filename, annotations, normalization, region=region,
+        min_width=min_width, max_jump=max_jump, max_gap=max_gap,
+        stride=stride)
+    crops = cache.load(key)
+    if crops is not None and len(crops) != length: crops = None #incomplete
+
+  annotations = flandmark_load(annotations, total, min_width, max_jump,
+      max_gap, cache=annotation_cache, verbose=verbose)
+  if stride > 1: annotations = annotations.subsample(stride, length)
+
+  if verbose:
+    details = ''
+    if stride > 1: details += ', stride %d' % stride
+    details += ', %.2f Hz' % (input.frame_rate / stride)
+    if crops is not None: details += ', cached crops'
+    sys.stdout.write("Processing file %s (%d frames%s)..." % (filename,
+      length, details))
+
+  if crops is not None:
+    frames = crops.frames()
+
+  else:
+    if not normalizers.has_key((normalization, region)):
+      normalizers[(normalization, region)] = \
+          utils.light_normalizer(normalization, region)
+
+    # start the work here: frames are decoded, light-normalized and compared
+    # one at a time - only frames that are used for a difference are
+    # normalized
+    frames = utils.light_normalized_frames(
+        utils.prefetch(utils.gray_frames(islice(input, 0, None, stride)),
+          prefetch), annotations,
+        normalizers[(normalization, region)], used_only=True)
+
+    if crop_cache is not None:
+      recorder = CropRecorder()
+      frames = recorder.record(frames, annotations)
+
+  features = numpy.ndarray((length, 2), dtype='float64')
+  features[:] = numpy.NaN
+
+  def progress(rows):
+    """Prints one character per processed frame"""
+
+    if not verbose: return
+    for row in rows:
+      if row[0] == 0: sys.stdout.write('x')
+      else: sys.stdout.write('.')
+    sys.stdout.flush()
+
+  if batch > 1:
+    for start, block in utils.frame_blocks(frames, batch):
+      end = start + len(block)
+      rows = utils.video_features(block,
+          *[k[start:end] for k in annotations.arrays()],
+          max_center_displacement=max_displacement, exact=exact)
+      features[(start+1):end] = rows[1:]
+      progress(rows[1:])
+
+  else:
+    differences = utils.frame_differences(frames, annotations,
+        max_displacement, exact=exact, integral=integral)
+    for k, row in enumerate(differences, 1):
+      features[k] = row
+      progress((row,))
+
+  if verbose:
+    sys.stdout.write('\n')
+    sys.stdout.flush()
+
+  if recorder is not None and recorder.crops is not None and \
+      len(recorder.crops) == length:
+    cache.save(key, recorder.crops)
+
+  return features
+
+#: Keyword parameters of :py:func:`compute_features` that do not change the
+#: features, so they are not part of their key on a stage cache
+NEUTRAL_PARAMETERS = ('annotation_cache', 'crop_cache', 'prefetch')
+
+def features_key(filename, annotations, parameters):
+  """Returns the key of the features of a video on a stage cache (see
+  :py:class:`.stagecache.StageCache`), given the video and annotations
+  filenames and the keyword parameters for :py:func:`compute_features`"""
+
+  from ..stagecache import StageCache
+
+  relevant = dict([(k, v) for k, v in parameters.items() \
+      if k not in NEUTRAL_PARAMETERS])
+  return StageCache.key('framediff', relevant, inputs=(filename, annotations))
+
+def timing_filename(path):
+  """Returns the name of the store with the time taken to calculate the
+  features of every video, for the features in ``path`` (a directory or a
+  store file)"""
+
+  from ..store import is_store, EXTENSION
+
+  if is_store(path): return path[:-len(EXTENSION)] + '-timing' + EXTENSION
+  return os.path.join(path, 'timing' + EXTENSION)
+
+def cached_features(filename, annotations, parameters, cache, verbose=False):
+  """Returns the features for a video from a stage cache, computing (and
+  caching) them if they are not there
+
+  Keyword parameters:
+
+  filename
+    The path to the video file to be processed
+
+  annotations
+    The path to the (flandmark) annotations for the video
+
+  parameters
+    A dictionary with the keyword parameters for :py:func:`compute_features`
+
+  cache
+    The :py:class:`.stagecache.StageCache` to use or ``None``, in which case
+    the features are always computed
+
+  verbose
+    If progress should be printed while computing the features
+
+  Returns a tuple with the features and the time (in seconds) taken to
+  compute them, which is ``None`` if they were read from the cache.
+  """
+
+  import time
+
+  def compute():
+    start = time.time()
+    features = compute_features(filename, annotations, verbose=verbose,
+        **parameters)
+    return features, time.time() - start
+
+  if cache is None: return compute()
+
+  key = features_key(filename, annotations, parameters)
+  features = cache.get(key)
+  if features is not None: return features, None
+
+  features, seconds = compute()
+  cache.put(key, features)
+  return features, seconds
+
+def run_task(task):
+  """Computes and saves the features for a single video, retrying on failure
+
+  Keyword parameters:
+
+  task
+    A tuple containing the video filename, the annotations filename, the output
+    filename, a dictionary with the keyword parameters for
+    :py:func:`compute_features`, the stage cache directory, the number of
+    retries and a flag indicating if progress should be printed. If the output
+    filename is ``None``, the features are not saved. If the stage cache
+    directory is ``None``, no cache is used.
+
+  Returns a tuple with the features, the time taken to compute them (see
+  :py:func:`cached_features`) and an error message, which is ``None`` if the
+  video was successfuly processed (otherwise, the features are ``None``).
+  """
+
+  import bob
+  from ..stagecache import StageCache
+
+  filename, annotations, output, parameters, cache_dir, retries, verbose = task
+
+  error = None
+  for attempt in range(retries+1):
+    try:
+      cache = StageCache(cache_dir) if cache_dir is not None else None
+      features, seconds = cached_features(filename, annotations, parameters,
+          cache, verbose)
+      if output is not None:
+        bob.db.utils.makedirs_safe(os.path.dirname(output))
+        # saves and renames, so an existing output is always complete
+        base, ext = os.path.splitext(output)
+        partial = base + '.partial' + ext
+        bob.io.save(features, partial)
+        os.rename(partial, output)
+      return features, seconds, None
+    except Exception, e:
+      error = "%s: %s" % (type(e).__name__, e)
+
+  return None, None, error
+
+def add_feature_options(parser):
+  """Adds the options controlling the calculation of features (i.e. the
+  keyword parameters of :py:func:`compute_features`) to an argument parser"""
+
+  from .. import utils
+
+  parser.add_argument('-M', '--maximum-displacement', metavar='FLOAT',
+      type=float, dest="max_displacement", default=0.2, help="Maximum displacement (w.r.t. to the eye width) between eye-centers to consider the eye for calculating eye-differences (defaults to %(default)s)")
+  parser.add_argument('-e', '--exact-remainder', action='store_true',
+      default=False, dest='exact', help="Calculates the face remainder from the exact intersection of the face remainder and (accepted) eye regions, instead of subtracting the eye differences from the whole face remainder")
+  parser.add_argument('-i', '--integral-image', action='store_true',
+      default=False, dest='integral', help="Calculates a single frame difference and its summed-area table per frame pair, from which all region sums are read")
+  parser.add_argument('-b', '--batch-size', metavar='INT', type=int,
+      default=0, dest='batch', help="If set to 2 or more, calculates the frame differences for blocks of this number of frames at once, which is faster but uses more memory (defaults to %(default)s, which processes one pair of frames at a time)")
+  parser.add_argument('-a', '--annotation-cache', metavar='FILE', type=str,
+      dest='annotation_cache', help="Binary file created with cache_annotations.py from which to load annotations. Annotations missing or stale in this file are read from the annotations directory")
+  parser.add_argument('-W', '--min-face-width', metavar='INT', type=int,
+      default=50, dest='min_width', help="Annotations with face bounding-boxes narrower than this number of pixels are discarded (defaults to %(default)s)")
+  parser.add_argument('-J', '--max-landmark-jump', metavar='FLOAT',
+      type=float, default=0., dest='max_jump', help="Annotations whose landmarks move, on average, more than this ratio of the face width w.r.t. both the previous and the next annotated frames are discarded as outliers (defaults to %(default)s, which disables this filter)")
+  parser.add_argument('-G', '--max-gap', metavar='INT', type=int, default=0,
+      dest='max_gap', help="Sequences of up to this number of frames without (valid) annotations between two annotated frames are filled by linear interpolation (defaults to %(default)s, which disables interpolation)")
+
+  normalizations = sorted(utils.LIGHT_NORMALIZATIONS.keys())
+
+  parser.add_argument('-N', '--normalization', metavar='METHOD', type=str,
+      default='histogram', dest='normalization', choices=normalizations,
+      help="The light normalization applied to the faces before calculating differences (one of '%s'; defaults to '%%(default)s'). The 'clahe' method requires OpenCV" % '|'.join(normalizations))
+
+  regions = ('face_remainder', 'union')
+
+  parser.add_argument('-R', '--normalization-region', metavar='REGION',
+      type=str, default='face_remainder', dest='region', choices=regions,
+      help="The region of every frame to light-normalize: the face remainder or the bounding box of the face remainder and both eye regions (one of '%s'; defaults to '%%(default)s')" % '|'.join(regions))
+  parser.add_argument('-C', '--crop-cache', metavar='DIR', type=str,
+      dest='crop_cache', help="Directory where the light-normalized face regions of every video are cached. Videos whose crops are found there (for the same annotations and normalization) are not decoded nor normalized again, so changing only the parameters of the following steps (e.g. the maximum displacement) is much faster")
+  parser.add_argument('-P', '--prefetch', metavar='INT', type=int, default=0,
+      dest='prefetch', help="Number of frames to decode ahead, in a background thread, while the previous ones are being processed (defaults to %(default)s, which decodes frames only when they are needed)")
+  parser.add_argument('-t', '--stride', metavar='INT', type=int, default=1,
+      dest='stride', help="Calculates the differences between frames k and k+STRIDE, for every STRIDE frames only, for a faster screening at a lower effective frame rate. All frames are still decoded, so the time spent decoding does not shrink. Pass the same option to count_blinks.py and merge_scores.py (defaults to %(default)s, which uses every frame)")
+
+def add_cache_options(parser):
+  """Adds the options controlling the stage cache (see
+  :py:class:`.stagecache.StageCache`) to an argument parser"""
+
+  parser.add_argument('--cache-dir', metavar='DIR', type=str,
+      dest='cache_dir', help="Directory where the results of every processing stage are cached, for every video, under a key derived from the video, the annotations and the parameters of that stage and of all stages it depends on. Results found there are not computed again")
+  parser.add_argument('--cache-max-size', metavar='MB', type=float,
+      dest='cache_max_size', help="After processing, removes the least recently used entries from the stage cache until it is at most this number of megabytes")
+  parser.add_argument('--cache-max-age', metavar='DAYS', type=float,
+      dest='cache_max_age', help="After processing, removes the entries of the stage cache that were not used for more than this number of days")
+
+def evict_cache(args):
+  """Evicts entries from the stage cache according to the options added by
+  :py:func:`add_cache_options`"""
+
+  from ..stagecache import StageCache
+
+  if args.cache_dir is None: return
+  if args.cache_max_size is None and args.cache_max_age is None: return
+
+  max_size = max_age = None
+  if args.cache_max_size is not None:
+    max_size = int(args.cache_max_size * 2**20)
+  if args.cache_max_age is not None:
+    max_age = args.cache_max_age * 24 * 60 * 60
+
+  removed, freed = StageCache(args.cache_dir).evict(max_size, max_age)
+  if removed:
+    print "Evicted %d entries (%.1f MB) from the stage cache" % (removed,
+        freed / float(2**20))
+
+def feature_parameters(args):
+  """Returns a dictionary with the keyword parameters for
+  :py:func:`compute_features`, from the arguments parsed with the options
+  added by :py:func:`add_feature_options`"""
+
+  return {
+      'max_displacement': args.max_displacement,
+      'exact': args.exact,
+      'integral': args.integral,
+      'batch': args.batch,
+      'annotation_cache': args.annotation_cache,
+      'min_width': args.min_width,
+      'max_jump': args.max_jump,
+      'max_gap': args.max_gap,
+      'normalization': args.normalization,
+      'region': args.region,
+      'crop_cache': args.crop_cache,
+      'prefetch': args.prefetch,
+      'stride': args.stride,
+      }
+
 def main():
 
   import bob
   import numpy
   from xbob.db.replay import Database
-
-  protocols = [k.name for k in Database().protocols()]
+  from . import add_database_options, add_input_arguments
+  from .. import utils
+  from ..store import StageOutput, is_store
 
   basedir = os.path.dirname(os.path.dirname(os.path.realpath(sys.argv[0])))
-  INPUTDIR = os.path.join(basedir, 'database')
-  ANNOTATIONS = os.path.join(basedir, 'annotations')
   OUTPUTDIR = os.path.join(basedir, 'framediff')
 
   parser = argparse.ArgumentParser(description=__doc__,
       formatter_class=argparse.RawDescriptionHelpFormatter)
-  parser.add_argument('inputdir', metavar='DIR', type=str, default=INPUTDIR,
-      nargs='?', help='Base directory containing the videos to be treated by this procedure (defaults to "%(default)s")')
-  parser.add_argument('annotations', metavar='DIR', type=str,
-      default=ANNOTATIONS, nargs='?', help='Base directory containing the (flandmark) annotations to be treated by this procedure (defaults to "%(default)s")')
+  add_input_arguments(parser)
   parser.add_argument('outputdir', metavar='DIR', type=str, default=OUTPUTDIR,
-      nargs='?', help='Base output directory for every file created by this procedure defaults to "%(default)s")')
-  parser.add_argument('-p', '--protocol', metavar='PROTOCOL', type=str,
-      default='grandtest', choices=protocols, dest="protocol",
-      help='The protocol type may be specified instead of the the id switch to subselect a smaller number of files to operate on (one of "%s"; defaults to "%%(default)s")' % '|'.join(sorted(protocols)))
-  parser.add_argument('-M', '--maximum-displacement', metavar='FLOAT',
-      type=float, dest="max_displacement", default=0.2, help="Maximum displacement (w.r.t. to the eye width) between eye-centers to consider the eye for calculating eye-differences (defaults to %(default)s)")
-
-  supports = ('fixed', 'hand', 'hand+fixed')
-
-  parser.add_argument('-s', '--support', metavar='SUPPORT', type=str,
-      default='hand+fixed', dest='support', choices=supports, help="If you would like to select a specific support to be used, use this option (one of '%s'; defaults to '%%(default)s')" % '|'.join(sorted(supports)))
+      nargs='?', help='Base output directory for every file created by this procedure (defaults to "%(default)s"). If the name ends in ".store", all features are saved on a single file, instead')
+  add_database_options(parser)
+  add_feature_options(parser)
+  add_cache_options(parser)
+  parser.add_argument('-j', '--jobs', metavar='INT', type=int, default=1,
+      dest='jobs', help="Number of local processes to use for processing videos in parallel (defaults to %(default)s)")
+  parser.add_argument('-r', '--retries', metavar='INT', type=int, default=0,
+      dest='retries', help="Number of times to retry processing a video that failed before reporting it (defaults to %(default)s)")
+
+  parser.add_argument('-c', '--chunk-size', metavar='INT', type=int,
+      default=1, dest='chunk_size', help="Number of (contiguous) videos to process in every grid task (defaults to %(default)s)")
+  parser.add_argument('-x', '--skip-existing', action='store_true',
+      default=False, dest='skip_existing', help="Skips videos for which the output file already exists, so resubmitted jobs only recompute missing outputs")
 
   # The next option just returns the total number of cases we will be running
   # It can be used to set jman --array option.
@@ -53,74 +418,93 @@ def main():
 
   if args.support == 'hand+fixed': args.support = ('hand', 'fixed')
 
-  from .. import utils 
-
   db = Database()
 
   process = db.objects(protocol=args.protocol, support=args.support,
       cls=('real', 'attack', 'enroll'))
 
+  if args.chunk_size < 1:
+    parser.error("the chunk size should be at least 1")
+
+  grid_tasks = (len(process) + args.chunk_size - 1) // args.chunk_size
+
   if args.grid_count:
-    print len(process)
+    print grid_tasks
     sys.exit(0)
 
   # if we are on a grid environment, just find what I have to process.
+  shard = None
   if os.environ.has_key('SGE_TASK_ID'):
     key = int(os.environ['SGE_TASK_ID']) - 1
-    if key >= len(process):
+    if key >= grid_tasks:
       raise RuntimeError, "Grid request for job %d on a setup with %d jobs" % \
-          (key, len(process))
-    process = [process[key]]
-
-  for counter, obj in enumerate(process):
-
-    filename = str(obj.videofile(args.inputdir))
-    input = bob.io.VideoReader(filename)
-    annotations = utils.flandmark_load_annotations(obj, args.annotations,
-        verbose=True)
-
-    sys.stdout.write("Processing file %s (%d frames) [%d/%d]..." % (filename,
-      input.number_of_frames, counter+1, len(process)))
-
-    # start the work here...
-    frames = [bob.ip.rgb_to_gray(k) for k in input]
-    #utils.light_normalize_tantriggs(frames, annotations, 0, len(frames))
-    utils.light_normalize_histogram(frames, annotations, 0, len(frames))
-
-    features = numpy.ndarray((input.number_of_frames, 2), dtype='float64')
-    features[:] = numpy.NaN
-
-    for k in range(1, len(frames)):
-
-      curr_annot = annotations[k] if annotations.has_key(k) else None
-      prev_annot = annotations[k-1] if annotations.has_key(k-1) else None
-      use_annotation = (prev_annot, curr_annot)
-
-      use_frames = (frames[k-1], frames[k])
-
-      # maximum of 5 pixel displacement acceptable
-      eye_diff, eye_pixels = utils.eval_eyes_difference(use_frames, 
-          use_annotation, args.max_displacement)
-      facerem_diff, facerem_pixels = utils.eval_face_remainder_difference(
-          use_frames, use_annotation, eye_diff, eye_pixels)
-
-      if eye_pixels != 0:
-        features[k][0] = eye_diff/float(eye_pixels)
-      else: 
-        features[k][0] = 0.
-
-      if facerem_pixels != 0:
-        features[k][1] = facerem_diff/float(facerem_pixels)
-      else: 
-        features[k][1] = 1.
+          (key, grid_tasks)
+    process = process[(key*args.chunk_size):((key+1)*args.chunk_size)]
+    shard = 'task%05d' % (key+1) #every grid task writes its own shard
+
+  # features are saved on a file per video or on a single store, next to the
+  # time taken to calculate them
+  writer = StageOutput(args.outputdir, '.hdf5', shard)
+  timer = StageOutput(timing_filename(args.outputdir), shard=shard)
+
+  if args.jobs < 1:
+    parser.error("the number of jobs should be at least 1")
+
+  if args.stride < 1:
+    parser.error("the stride should be at least 1")
+
+  parameters = feature_parameters(args)
+
+  if args.skip_existing:
+    total = len(process)
+    process = [k for k in process if not writer.exists(k)]
+    print "Skipping %d video(s) with existing outputs, %d remaining" % \
+        (total - len(process), len(process))
+
+  tasks = [(str(obj.videofile(args.inputdir)),
+    obj.make_path(args.annotations, '.flandmark'),
+    None if is_store(args.outputdir) else \
+        obj.make_path(args.outputdir, '.hdf5'),
+    parameters, args.cache_dir, args.retries, args.jobs == 1) \
+        for obj in process]
+
+  if args.jobs == 1:
+    results = (run_task(k) for k in tasks)
+  else:
+    import multiprocessing
+    pool = multiprocessing.Pool(args.jobs)
+    results = pool.imap(run_task, tasks) #results come in submission order
+
+  from itertools import izip
+
+  failed = []
+  for counter, (obj, task, (features, seconds, error)) in \
+      enumerate(izip(process, tasks, results)):
+
+    if error is not None:
+      failed.append((task[0], error))
+      sys.stdout.write("File %s [%d/%d] FAILED: %s\n" % (task[0], counter+1,
+        len(tasks), error))
+    else:
+      if task[2] is None: writer.save(obj, features)
+      if seconds is not None: timer.save(obj, numpy.array([seconds]))
+      if args.jobs != 1:
+        sys.stdout.write("Processed file %s (%d frames) [%d/%d]\n" % \
+            (task[0], len(features), counter+1, len(tasks)))
+    sys.stdout.flush()
 
-      if eye_diff == 0: sys.stdout.write('x')
-      else: sys.stdout.write('.')
-      sys.stdout.flush()
+  if args.jobs != 1:
+    pool.close()
+    pool.join()
 
-    obj.save(features, directory=args.outputdir, extension='.hdf5')
+  writer.close()
+  timer.close()
+  evict_cache(args)
 
-    sys.stdout.write('\n')
-    sys.stdout.flush()
+  if failed:
+    print "%d out of %d video(s) could not be processed:" % (len(failed),
+        len(tasks))
+    for filename, error in failed: print " * %s: %s" % (filename, error)
+    return 1
 
   return 0
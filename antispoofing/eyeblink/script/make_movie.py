@@ -45,6 +45,8 @@ def main():
   import os, sys
   from xbob.db.replay import Database, File
   from .. import utils
+  from ..online import OnlineBlinkDetector
+  from ..annotations import flandmark_load
 
   basedir = os.path.dirname(os.path.dirname(os.path.realpath(sys.argv[0])))
   ANNOTATIONS = os.path.join(basedir, 'annotations')
@@ -58,6 +60,12 @@ def main():
       help='Base path to the movie file you need plotting')
   parser.add_argument('output', metavar='FILE', type=str,
       help='Name of the output file to save the video')
+  parser.add_argument('-a', '--annotation-cache', metavar='FILE', type=str,
+      dest='annotation_cache', help="Binary file created with cache_annotations.py from which to load annotations. Annotations missing or stale in this file are read from the annotations directory")
+  normalizations = sorted(utils.LIGHT_NORMALIZATIONS.keys())
+  parser.add_argument('-N', '--normalization', metavar='METHOD', type=str,
+      default='histogram', dest='normalization', choices=normalizations,
+      help="The light normalization applied to the faces before calculating differences (one of '%s'; defaults to '%%(default)s'). The 'clahe' method requires OpenCV" % '|'.join(normalizations))
   parser.add_argument('-M', '--maximum-displacement', metavar='FLOAT',
       type=float, dest="max_displacement", default=0.2, help="Maximum displacement (w.r.t. to the eye width) between eye-centers to consider the eye for calculating eye-differences")
   parser.add_argument('-S', '--skip-frames', metavar='INT', type=int,
@@ -84,47 +92,46 @@ def main():
 
   # Choose the printed frames here.
   start = 0
-  end = 225
-
-  # Loads the input video
-  frames = [bob.ip.rgb_to_gray(k) for k in video[start:end]]
+  end = min(225, len(video))
 
   # Recalculates the features
-  annotations = utils.flandmark_load_annotations(obj, args.annotations,
-      verbose=True)
-
-  # Light-normalizes detected faces
-  #utils.light_normalize_tantriggs(frames, annotations, start, end)
-  utils.light_normalize_histogram(frames, annotations, start, end)
-
-  features = numpy.zeros((len(frames), 2), dtype='float64')
+  annotations = flandmark_load(obj.make_path(args.annotations, '.flandmark'),
+      len(video), cache=args.annotation_cache, verbose=True)
+
+  normalize = utils.light_normalizer(args.normalization)
+
+  def video_frames():
+    """Decodes and light-normalizes the frames of interest one at a time"""
+
+    from itertools import islice
+    return utils.light_normalized_frames(
+        utils.gray_frames(islice(video, start, end)), annotations, normalize,
+        start)
+
+  # Calculates scores and blinks incrementally, keeping the detector state for
+  # every frame so we can plot it later
+  detector = OnlineBlinkDetector(args.max_displacement, args.thres_ratio,
+      args.skip)
+  scores = numpy.zeros((end-start,), dtype='float64')
+  blinks = numpy.zeros((end-start,), dtype='int64')
+  means = numpy.zeros((end-start,), dtype='float64')
+  thresholds = numpy.zeros((end-start,), dtype='float64')
+  scores[0], blinks[0] = detector.score, detector.blinks
+  means[0], thresholds[0] = detector.score_mean, detector.threshold
 
   sys.stdout.write("Computing features ")
   sys.stdout.flush()
-  for k in range(start+1, end):
-    curr_annot = annotations[k] if annotations.has_key(k) else None
-    prev_annot = annotations[k-1] if annotations.has_key(k-1) else None
-    use_annotation = (prev_annot, curr_annot)
-    use_frames = (frames[k-1], frames[k])
+  differences = utils.frame_differences(video_frames(), annotations,
+      args.max_displacement, start)
+  for k, features in enumerate(differences, 1):
 
-    # maximum of 5 pixel displacement acceptable
-    eye_diff, eye_pixels = utils.eval_eyes_difference(use_frames, 
-        use_annotation, max_center_displacement=args.max_displacement)
-    facerem_diff, facerem_pixels = utils.eval_face_remainder_difference(
-        use_frames, use_annotation, eye_diff, eye_pixels)
+    scores[k], blinks[k] = detector.push(*features)
+    means[k], thresholds[k] = detector.score_mean, detector.threshold
 
-    if eye_pixels != 0: features[k][0] = eye_diff/float(eye_pixels)
-    else: features[k][0] = 0.
-
-    if facerem_pixels != 0: features[k][1] = facerem_diff/float(facerem_pixels)
-    else: features[k][1] = 1.
-
-    if eye_diff == 0: sys.stdout.write('x')
+    if features[0] == 0: sys.stdout.write('x')
     else: sys.stdout.write('.')
     sys.stdout.flush()
 
-  scores = utils.score(features)
-
   sys.stdout.write('\n')
   sys.stdout.flush()
 
@@ -138,7 +145,7 @@ def main():
   orows, ocolumns = None, None #the size of every frame in outv
   old_blinks = 0
   
-  for k in range(start,end):
+  for k, frame in enumerate(video_frames(), start):
 
     mpl.subplot(211)
     mpl.title("Frame %05d" % k)
@@ -147,23 +154,21 @@ def main():
     
     if use_annotation:
       x, y, width, height = use_annotation['bbox']
-      bob.ip.draw_box(frames[k], x, y, width, height, 255)
+      bob.ip.draw_box(frame, x, y, width, height, 255)
       x, y, width, height = use_annotation['eyes'][0]
-      bob.ip.draw_box(frames[k], x, y, width, height, 255)
+      bob.ip.draw_box(frame, x, y, width, height, 255)
       x, y, width, height = use_annotation['eyes'][1]
-      bob.ip.draw_box(frames[k], x, y, width, height, 255)
+      bob.ip.draw_box(frame, x, y, width, height, 255)
       x, y, width, height = use_annotation['face_remainder']
-      bob.ip.draw_box(frames[k], x, y, width, height, 255)
+      bob.ip.draw_box(frame, x, y, width, height, 255)
 
-    mpl.imshow(frames[k], cmap=GrayColorMap) #top plot
+    mpl.imshow(frame, cmap=GrayColorMap) #top plot
 
     mpl.subplot(212)
 
-    score_set = scores[start:k+1]
-    blinks = utils.count_blinks(score_set, args.thres_ratio, args.skip)
-    rmean = utils.rmean(score_set)[-1]
-    rstd = utils.rstd(score_set)[-1]
-    threshold = (args.thres_ratio * rstd) + rmean
+    score_set = scores[:(k-start+1)]
+    rmean = means[k-start]
+    threshold = thresholds[k-start]
 
     mpl.plot(numpy.arange(start, k+1), score_set, linewidth=2, label='score')
     mpl.hlines(rmean, start, end, color='red', 
@@ -173,7 +178,7 @@ def main():
     yrange = scores.max() - scores.min()
     mpl.axis((start, end, scores.min(), (0.2*yrange) + scores.max()))
     mpl.grid(True)
-    mpl.xlabel("Frames | Blinks = %d" % blinks[-1])
+    mpl.xlabel("Frames | Blinks = %d" % blinks[k-start])
     mpl.ylabel("Magnitude")
 
     figure = fig2array(fig)
@@ -185,8 +190,8 @@ def main():
 
     outv.append(figure[:,0:orows,0:ocolumns])
     mpl.clf()
-    if blinks[-1] != old_blinks:
-      old_blinks = blinks[-1]
+    if blinks[k-start] != old_blinks:
+      old_blinks = blinks[k-start]
       sys.stdout.write('%d' % old_blinks)
     else:
       sys.stdout.write('.')
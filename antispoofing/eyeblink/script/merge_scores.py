@@ -15,135 +15,326 @@ import bob
 import numpy
 import argparse
 
+def write_scores(filename, reals, positives, attacks, negatives,
+    verbose=False):
+  """Writes a 5-column score file
+
+  Keyword parameters:
+
+  filename
+    The name of the file to create
+
+  reals, attacks
+    The database objects for the real-accesses and attacks
+
+  positives, negatives
+    The number of blinks detected on every real-access and attack
+
+  verbose
+    If set, prints the number of blinks of every video
+  """
+
+  out = open(filename, 'wt')
+
+  if verbose:
+    sys.stdout.write(' * real-accesses: ')
+    sys.stdout.flush()
+  for obj, nb in zip(reals, positives):
+
+    if verbose:
+      sys.stdout.write('%d ' % nb)
+      sys.stdout.flush()
+
+    out.write('%d %d %d %s %d.0\n' % (obj.client.id, obj.client.id, obj.client.id, obj.path, nb))
+
+  if verbose:
+    sys.stdout.write('\n * attacks: ')
+    sys.stdout.flush()
+  for obj, nb in zip(attacks, negatives):
+
+    if verbose:
+      sys.stdout.write('%d ' % nb)
+      sys.stdout.flush()
+
+    out.write('%d %d attack %s %d.0\n' % (obj.client.id, obj.client.id, obj.path, nb))
+
+  out.close()
+
+  if verbose:
+    sys.stdout.write('\n')
+    sys.stdout.flush()
+
+def report(dev_neg, dev_pos, test_neg, test_pos, nb):
+  """Prints the error rates on the development and test sets, accepting videos
+  with at least ``nb`` blinks as real-accesses"""
+
+  thres = nb - 0.5
+
+  dev_far, dev_frr = bob.measure.farfrr(dev_neg, dev_pos, thres)
+  dev_hter = (dev_far + dev_frr)/2.0
+
+  test_far, test_frr = bob.measure.farfrr(test_neg, test_pos, thres)
+  test_hter = (test_far + test_frr)/2.0
+
+  print("Threshold - at least %d blink(s)" % nb)
+  
+  dev_ni = len(dev_neg) #number of impostors
+  dev_fa = int(round(dev_far*dev_ni)) #number of false accepts
+  dev_nc = len(dev_pos) #number of clients
+  dev_fr = int(round(dev_frr*dev_nc)) #number of false rejects
+  test_ni = len(test_neg) #number of impostors
+  test_fa = int(round(test_far*test_ni)) #number of false accepts
+  test_nc = len(test_pos) #number of clients
+  test_fr = int(round(test_frr*test_nc)) #number of false rejects
+
+  print " Error (devel): FAR %.2f%% (%d/%d) x FRR %.2f%% (%d/%d) = HTER %.2f%%" % \
+      (100*dev_far, dev_fa, dev_ni, 100*dev_frr, dev_fr, dev_nc, 100*dev_hter)
+  print " Error (test ): FAR %.2f%% (%d/%d) x FRR %.2f%% (%d/%d) = HTER %.2f%%" % \
+      (100*test_far, test_fa, test_ni, 100*test_frr, test_fr, test_nc, 100*test_hter)
+
+def sweep(ends, dev_neg, dev_pos, test_neg, test_pos):
+  """Evaluates every blink threshold for every number of scores at once, and
+  selects thresholds on the development set
+
+  Keyword parameters:
+
+  ends
+    The numbers of scores merged from every video
+
+  dev_neg, dev_pos, test_neg, test_pos
+    The number of blinks detected on every attack and real-access of the
+    development and test sets, with one column for every number of scores
+
+  Returns a list with a dictionary for every number of scores, containing the
+  number of scores (``scores``), the thresholds (``blinks``), the error rates
+  on the ``devel`` and ``test`` sets at every threshold (``far``, ``frr`` and
+  ``hter``) and the thresholds selected on the development set at the equal
+  error rate (``eer``) and the minimum half total error rate (``min_hter``),
+  with their error rates on both sets.
+  """
+
+  from .. import utils
+
+  # both sets are evaluated at the same thresholds
+  maximum = 1 + max([k.max() for k in (dev_neg, dev_pos, test_neg, test_pos) \
+      if k.size] or [0])
+  thresholds, dev_far, dev_frr, dev_hter = utils.blink_sweep(dev_neg, dev_pos,
+      maximum)
+  thresholds, test_far, test_frr, test_hter = utils.blink_sweep(test_neg,
+      test_pos, maximum)
+
+  selected = {}
+  for criterion in ('eer', 'min-hter'):
+    selected[criterion] = utils.select_blink_threshold(dev_far, dev_frr,
+        criterion)
+
+  def rates(far, frr, hter, i, column):
+    return {'far': far[i, column], 'frr': frr[i, column],
+        'hter': hter[i, column]}
+
+  retval = []
+  for column, end in enumerate(ends):
+    entry = {
+        'scores': end,
+        'blinks': thresholds.tolist(),
+        'devel': {'far': dev_far[:,column].tolist(),
+          'frr': dev_frr[:,column].tolist(),
+          'hter': dev_hter[:,column].tolist()},
+        'test': {'far': test_far[:,column].tolist(),
+          'frr': test_frr[:,column].tolist(),
+          'hter': test_hter[:,column].tolist()},
+        }
+    for criterion, indexes in selected.items():
+      i = indexes[column]
+      entry[criterion.replace('-', '_')] = {
+          'blinks': int(thresholds[i]),
+          'devel': rates(dev_far, dev_frr, dev_hter, i, column),
+          'test': rates(test_far, test_frr, test_hter, i, column),
+          }
+    retval.append(entry)
+
+  return retval
+
+def print_sweep(results):
+  """Prints the error rates at every threshold, and at the selected ones, for
+  the results of :py:func:`sweep`"""
+
+  for entry in results:
+    print "Sweep - %d score(s)" % entry['scores']
+    print " %6s | %-23s | %-23s" % ('', 'devel', 'test')
+    print " %6s | %7s %7s %7s | %7s %7s %7s" % ('blinks', 'FAR', 'FRR',
+        'HTER', 'FAR', 'FRR', 'HTER')
+    for i, nb in enumerate(entry['blinks']):
+      row = [100*entry[g][k][i] for g in ('devel', 'test') \
+          for k in ('far', 'frr', 'hter')]
+      print " %6d | %6.2f%% %6.2f%% %6.2f%% | %6.2f%% %6.2f%% %6.2f%%" % \
+          tuple([nb] + row)
+
+    for criterion, name in (('eer', 'EER'), ('min_hter', 'Minimum HTER')):
+      selection = entry[criterion]
+      print " %s threshold (devel) - at least %d blink(s)" % (name,
+          selection['blinks'])
+      for group in ('devel', 'test'):
+        print "  Error (%-5s): FAR %.2f%% x FRR %.2f%% = HTER %.2f%%" % \
+            (group, 100*selection[group]['far'],
+                100*selection[group]['frr'], 100*selection[group]['hter'])
+
+def write_sweep_csv(filename, results):
+  """Writes the results of :py:func:`sweep` as a CSV file, with a row for
+  every number of scores and threshold"""
+
+  import csv
+
+  f = open(filename, 'wb')
+  writer = csv.writer(f)
+  writer.writerow(['scores', 'blinks', 'devel_far', 'devel_frr',
+    'devel_hter', 'test_far', 'test_frr', 'test_hter'])
+  for entry in results:
+    for i, nb in enumerate(entry['blinks']):
+      writer.writerow([entry['scores'], nb] + \
+          ['%.6f' % entry[g][k][i] for g in ('devel', 'test') \
+            for k in ('far', 'frr', 'hter')])
+  f.close()
+
+def write_sweep_json(filename, results):
+  """Writes the results of :py:func:`sweep` as a JSON file"""
+
+  import json
+
+  f = open(filename, 'wt')
+  json.dump(results, f, indent=2, sort_keys=True)
+  f.close()
+
+def add_scores_options(parser):
+  """Adds the option selecting the numbers of scores to merge from every video
+  to an argument parser. The numbers are available as ``ends``, which is
+  ``None`` if the option is not given (see :py:func:`scores_ends`)."""
+
+  parser.add_argument('-n', '--number-of-scores', metavar='INT', type=int,
+      action='append', dest='ends', help="Number of scores to merge from every video (defaults to 220). This option can be given many times: blinks are then read once and a set of files is created for every number of scores")
+
+def scores_ends(args):
+  """Returns the numbers of scores to merge from every video, from the
+  arguments parsed with the option added by :py:func:`add_scores_options`"""
+
+  return args.ends or [220]
+
 def main():
   """Main method"""
   
   from xbob.db.replay import Database
+  from . import add_database_options
   from .. import utils
-
-  protocols = [k.name for k in Database().protocols()]
+  from .. import store
+  from ..store import StageInput, BlinkSummary
 
   parser = argparse.ArgumentParser(description=__doc__,
       formatter_class=argparse.RawDescriptionHelpFormatter)
-  parser.add_argument('inputdir', metavar='DIR', type=str, help='Base directory containing the eye-blinks to be merged')
+  parser.add_argument('inputdir', metavar='DIR', type=str, help='Base directory (or store file, ending in ".store") containing the eye-blinks to be merged')
   parser.add_argument('outputdir', metavar='DIR', type=str, help='Base output directory for every file created by this procedure')
   
-  parser.add_argument('-p', '--protocol', metavar='PROTOCOL', type=str,
-      default='grandtest', choices=protocols, dest="protocol",
-      help="The protocol type may be specified to subselect a smaller number of files to operate on (one of '%s'; defaults to '%%(default)s')" % '|'.join(sorted(protocols)))
+  add_database_options(parser)
 
-  supports = ('fixed', 'hand', 'hand+fixed')
+  add_scores_options(parser)
 
-  parser.add_argument('-s', '--support', metavar='SUPPORT', type=str, 
-      default='hand+fixed', dest='support', choices=supports, help="If you would like to select a specific support to be used, use this option (one of '%s'; defaults to '%%(default)s')" % '|'.join(sorted(supports))) 
+  parser.add_argument('-t', '--stride', metavar='INT', type=int, default=1,
+      dest='stride', help="The stride used for calculating the frame differences with framediff.py. The blinks detected up to frame NUMBER_OF_SCORES-1 are merged (defaults to %(default)s)")
 
-  parser.add_argument('-n', '--number-of-scores', metavar='INT', type=int,
-      default=220, dest='end', help="Number of scores to merge from every file (defaults to %(default)s)")
+  parser.add_argument('--sweep', action='store_true', dest='sweep',
+      default=False, help="Also prints the error rates at every blink threshold, for every number of scores, and the thresholds selected on the development set at the equal error rate and at the minimum HTER, with their error rates on the test set")
+  parser.add_argument('--csv', metavar='FILE', type=str, dest='csv',
+      help="Writes the error rates at every blink threshold, for every number of scores, on this CSV file")
+  parser.add_argument('--json', metavar='FILE', type=str, dest='json',
+      help="Writes the error rates at every blink threshold and the selected thresholds, for every number of scores, on this JSON file")
 
   parser.add_argument('-v', '--verbose', action='store_true', dest='verbose',
       default=False, help='Increases this script verbosity')
 
   args = parser.parse_args()
 
-  if not os.path.exists(args.inputdir):
+  if not store.exists(args.inputdir):
     parser.error("input directory `%s' does not exist" % args.inputdir)
 
   if args.support == 'hand+fixed': args.support = ('hand', 'fixed')
 
+  if args.stride < 1:
+    parser.error("the stride should be at least 1")
+
+  args.ends = scores_ends(args)
+
+  # the rows with the number of blinks detected up to frame (end-1)
+  rows = [utils.stride_row(k-1, args.stride) for k in args.ends]
+
   if not os.path.exists(args.outputdir):
     if args.verbose: print "Creating output directory %s..." % args.outputdir
     os.makedirs(args.outputdir)
 
   db = Database()
+  reader = StageInput(args.inputdir, '.hdf5')
+  summary = BlinkSummary.open(args.inputdir)
+
+  def counts(obj):
+    """Reads the number of blinks detected on a video at all rows at once"""
+
+    if summary is not None and summary.valid(obj):
+      return summary.counts(obj.id, rows)
+    return reader.rows(obj, rows)
 
-  def write_file(group):
+  def read_group(group):
+    """Reads the blinks for all real-accesses and attacks in a group"""
 
     if args.verbose:
-      print "Processing '%s' group..." % group
-  
-    out = open(os.path.join(args.outputdir, '%s-5col.txt' % group), 'wt')
+      print "Reading '%s' group..." % group
 
     reals = db.objects(protocol=args.protocol, support=args.support,
         groups=(group,), cls=('real',))
     attacks = db.objects(protocol=args.protocol, support=args.support,
         groups=(group,), cls=('attack',))
-    total = len(reals) + len(attacks)
-
-    counter = 0
-    positives = []
-    if args.verbose:
-      sys.stdout.write(' * real-accesses[%d]: ' % (args.end-1))
-      sys.stdout.flush()
-    for obj in reals:
-      counter += 1
-      fname = obj.make_path(args.inputdir, '.hdf5')
-
-      nb = bob.io.load(fname)[args.end-1]
-
-      if args.verbose:
-        sys.stdout.write('%d ' % nb)
-        sys.stdout.flush()
 
-      positives.append(nb)
-      
-      out.write('%d %d %d %s %d.0\n' % (obj.client.id, obj.client.id, obj.client.id, obj.path, nb))
+    positives = numpy.array([counts(obj) for obj in reals]).reshape(len(reals),
+        len(rows))
+    negatives = numpy.array([counts(obj) for obj in attacks]).reshape(
+        len(attacks), len(rows))
 
-    negatives = []
-    if args.verbose:
-      sys.stdout.write('\n * attacks[%d]: ' % (args.end-1))
-      sys.stdout.flush()
-    for obj in attacks:
-      counter += 1
-      fname = obj.make_path(args.inputdir, '.hdf5')
+    return reals, attacks, positives, negatives
 
-      nb = bob.io.load(fname)[args.end-1]
+  def write_file(group, data, column):
 
-      if args.verbose:
-        sys.stdout.write('%d ' % nb)
-        sys.stdout.flush()
+    reals, attacks, positives, negatives = data
+    positives = positives[:,column]
+    negatives = negatives[:,column]
 
-      negatives.append(nb)
-      
-      out.write('%d %d attack %s %d.0\n' % (obj.client.id, obj.client.id, obj.path, nb))
+    if len(args.ends) == 1: name = '%s-5col.txt' % group
+    else: name = '%s-5col-%d.txt' % (group, args.ends[column])
 
-    out.close()
-      
     if args.verbose:
-      sys.stdout.write('\n')
-      sys.stdout.flush()
+      print "Writing '%s' (blinks at row %d)..." % (name, rows[column])
 
-    return negatives, positives
-
-  train_neg, train_pos = write_file('train')
-  dev_neg, dev_pos = write_file('devel')
-  test_neg, test_pos = write_file('test')
+    write_scores(os.path.join(args.outputdir, name), reals, positives,
+        attacks, negatives, args.verbose)
 
-  def eval(nb):
+    return negatives, positives
 
-    thres = nb - 0.5
+  # all blinks are read once, for all numbers of scores
+  train = read_group('train')
+  devel = read_group('devel')
+  test = read_group('test')
 
-    dev_far, dev_frr = bob.measure.farfrr(dev_neg, dev_pos, thres)
-    dev_hter = (dev_far + dev_frr)/2.0
+  for column, end in enumerate(args.ends):
 
-    test_far, test_frr = bob.measure.farfrr(test_neg, test_pos, thres)
-    test_hter = (test_far + test_frr)/2.0
+    if len(args.ends) != 1:
+      print "Number of scores: %d" % end
 
-    print("Threshold - at least %d blink(s)" % nb)
-    
-    dev_ni = len(dev_neg) #number of impostors
-    dev_fa = int(round(dev_far*dev_ni)) #number of false accepts
-    dev_nc = len(dev_pos) #number of clients
-    dev_fr = int(round(dev_frr*dev_nc)) #number of false rejects
-    test_ni = len(test_neg) #number of impostors
-    test_fa = int(round(test_far*test_ni)) #number of false accepts
-    test_nc = len(test_pos) #number of clients
-    test_fr = int(round(test_frr*test_nc)) #number of false rejects
+    train_neg, train_pos = write_file('train', train, column)
+    dev_neg, dev_pos = write_file('devel', devel, column)
+    test_neg, test_pos = write_file('test', test, column)
 
-    print " Error (devel): FAR %.2f%% (%d/%d) x FRR %.2f%% (%d/%d) = HTER %.2f%%" % \
-        (100*dev_far, dev_fa, dev_ni, 100*dev_frr, dev_fr, dev_nc, 100*dev_hter)
-    print " Error (test ): FAR %.2f%% (%d/%d) x FRR %.2f%% (%d/%d) = HTER %.2f%%" % \
-        (100*test_far, test_fa, test_ni, 100*test_frr, test_fr, test_nc, 100*test_hter)
+    report(dev_neg, dev_pos, test_neg, test_pos, 1)
+    report(dev_neg, dev_pos, test_neg, test_pos, 2)
+    report(dev_neg, dev_pos, test_neg, test_pos, 3)
 
-  eval(1)
-  eval(2)
-  eval(3)
+  if args.sweep or args.csv or args.json:
+    results = sweep(args.ends, devel[3], devel[2], test[3], test[2])
+    if args.sweep: print_sweep(results)
+    if args.csv: write_sweep_csv(args.csv, results)
+    if args.json: write_sweep_json(args.json, results)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Compares the error rates obtained with blinks detected at different strides
+(see the ``--stride`` option of framediff.py), next to the speed-up of each
+stride. For every stride, give the directory containing the blinks counted by
+count_blinks.py and the directory containing the features calculated by
+framediff.py, as ``BLINKS:STRIDE:FEATURES``.
+
+The speed-up is measured: it is the ratio between the time framediff.py took
+to calculate the features at the smallest stride and at every stride, over
+the videos timed at both (see the ``-timing`` store framediff.py saves next to
+the features). If the features of a stride are not given, or were all read
+from a stage cache, no speed-up is shown.
+"""
+
+import os
+import sys
+import bob
+import numpy
+import argparse
+
+def main():
+  """Main method"""
+
+  from xbob.db.replay import Database
+  from . import add_database_options
+  from .. import utils
+  from .. import store
+  from ..store import StageInput
+  from .framediff import timing_filename
+
+  parser = argparse.ArgumentParser(description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('inputs', metavar='BLINKS:STRIDE:FEATURES', type=str,
+      nargs='+', help='Base directories (or store files) containing the eye-blinks counted for every stride, followed by the stride and, optionally, by the directory (or store file) containing the features calculated at that stride')
+
+  add_database_options(parser)
+
+  parser.add_argument('-n', '--number-of-scores', metavar='INT', type=int,
+      default=220, dest='end', help="Number of frames to consider from every file (defaults to %(default)s)")
+
+  parser.add_argument('-v', '--verbose', action='store_true', dest='verbose',
+      default=False, help='Increases this script verbosity')
+
+  args = parser.parse_args()
+
+  inputs = []
+  for k in args.inputs:
+    parts = k.split(':')
+    if len(parts) not in (2, 3):
+      parser.error("input `%s' should be given as BLINKS:STRIDE[:FEATURES]" % k)
+    directory, stride, features = (parts + [None])[:3]
+    try:
+      stride = int(stride)
+    except ValueError:
+      parser.error("the stride of input `%s' is not an integer" % k)
+    if stride < 1:
+      parser.error("the stride of input `%s' should be at least 1" % k)
+    for path in (directory, features):
+      if path is not None and not store.exists(path):
+        parser.error("input directory `%s' does not exist" % path)
+    inputs.append((stride, directory, features))
+
+  if args.support == 'hand+fixed': args.support = ('hand', 'fixed')
+
+  db = Database()
+
+  def load(directory, stride, group, cls):
+    """Loads the number of blinks up to frame (end-1) for all videos"""
+
+    row = utils.stride_row(args.end-1, stride)
+    reader = StageInput(directory, '.hdf5')
+    objs = db.objects(protocol=args.protocol, support=args.support,
+        groups=(group,), cls=(cls,))
+    return [reader.load(obj)[row] for obj in objs]
+
+  def timing(features):
+    """Loads the time taken to calculate the features of every video, as a
+    dictionary keyed by file id (empty if there are no timings)"""
+
+    if features is None or not store.exists(timing_filename(features)):
+      return {}
+    reader = StageInput(timing_filename(features))
+    return dict([(k, float(reader.store[k][0])) for k in reader.store.ids()])
+
+  # the speed-up is measured w.r.t. the smallest stride
+  inputs = sorted(inputs)
+  baseline = timing(inputs[0][2])
+  blinks = (1, 2, 3)
+
+  # HTERs on the development and test sets for every number of blinks
+  print "%6s %7s %7s | %s" % ('', '', 'speedup',
+      ' | '.join(["%-15s" % ("%d blink(s)" % k) for k in blinks]))
+  print "%6s %7s %7s | %s" % ('stride', 'frames', 'measured',
+      ' | '.join(["%7s %7s" % ('devel', 'test') for k in blinks]))
+
+  for stride, directory, features in inputs:
+
+    if args.verbose:
+      print "Loading blinks from `%s' (stride %d)..." % (directory, stride)
+
+    dev_neg = load(directory, stride, 'devel', 'attack')
+    dev_pos = load(directory, stride, 'devel', 'real')
+    test_neg = load(directory, stride, 'test', 'attack')
+    test_pos = load(directory, stride, 'test', 'real')
+
+    frames = utils.stride_row(args.end-1, stride) + 1
+
+    seconds = timing(features)
+    common = [k for k in seconds if k in baseline]
+    speedup = '%7s' % 'n/a'
+    if common and sum([seconds[k] for k in common]) > 0:
+      speedup = '%6.2fx' % (sum([baseline[k] for k in common]) /
+          sum([seconds[k] for k in common]))
+
+    errors = []
+    for nb in blinks:
+      dev_hter = utils.blink_errors(dev_neg, dev_pos, nb)[2]
+      test_hter = utils.blink_errors(test_neg, test_pos, nb)[2]
+      errors.append("%6.2f%% %6.2f%%" % (100*dev_hter, 100*test_hter))
+
+    print "%6d %7d %s | %s" % (stride, frames, speedup, ' | '.join(errors))
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""A content-addressed cache for the (per-video) results of processing stages
+"""
+
+import os
+import numpy
+
+#: The version of the implementation of every stage, which is part of the keys
+#: of its results. Increment the version of a stage whenever a change makes
+#: it produce different results (e.g. a new light normalization formula), so
+#: results cached by older versions are not used anymore. Stages depending on
+#: it get new keys as well, through their upstream keys. The version of
+#: ``crops`` is the one of the light normalization, whose results are cached
+#: by :py:class:`.crops.CropCache`.
+VERSIONS = {
+    'crops': 3, #histogram equalization as in bob, with or without bob
+    'framediff': 3, #histogram equalization as in bob, with or without bob
+    'make_scores': 1,
+    'count_blinks': 1,
+    }
+
+class StageCache(object):
+  """A directory of arrays, each one identified by a key calculated from
+  everything that determines its contents
+
+  Keys (see :py:meth:`key`) are hashes of the stage name and version (see
+  :py:data:`VERSIONS`), the stage parameters, the identity of the input files
+  (path, modification time and size) and the keys of the results of upstream
+  stages the stage depends on. Any change to one of those leads to different
+  keys for the stage and all stages depending on it, while results of
+  upstream stages that did not change are reused. Changes to the code of a
+  stage are only detected if its version is incremented.
+
+  Entries are never modified. Old entries can be removed with :py:meth:`evict`.
+
+  Keyword parameters:
+
+  directory
+    The directory containing the cache. It is created if it does not exist.
+  """
+
+  def __init__(self, directory):
+
+    self.directory = directory
+    if not os.path.exists(directory): os.makedirs(directory)
+
+  @staticmethod
+  def key(stage, parameters, inputs=(), upstream=()):
+    """Calculates the key for the result of a stage
+
+    Keyword parameters:
+
+    stage
+      The name of the stage, which should have a version in
+      :py:data:`VERSIONS`
+
+    parameters
+      A dictionary with all parameters of the stage that affect its result
+
+    inputs
+      The files (e.g. video and annotations) read by the stage
+
+    upstream
+      The keys of the results of other stages used by the stage
+    """
+
+    import hashlib
+
+    def identity(filename):
+      stat = os.stat(filename)
+      return (os.path.realpath(filename), stat.st_mtime, stat.st_size)
+
+    description = (stage, VERSIONS[stage], sorted(parameters.items()),
+        [identity(k) for k in inputs], list(upstream))
+    return hashlib.sha1(repr(description)).hexdigest()
+
+  def path(self, key):
+    """Returns the path of the file for the given key"""
+
+    return os.path.join(self.directory, key[:2], key + '.npy')
+
+  def get(self, key):
+    """Returns the array for the given key or ``None``, if it is not cached"""
+
+    path = self.path(key)
+    try:
+      retval = numpy.load(path)
+    except IOError:
+      return None
+
+    try:
+      os.utime(path, None) #recently used entries are evicted last
+    except OSError: #evicted by another process in the meanwhile
+      pass
+    return retval
+
+  def put(self, key, array):
+    """Caches the array for the given key"""
+
+    path = self.path(key)
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+      try:
+        os.makedirs(directory)
+      except OSError: #created by another process in the meanwhile
+        pass
+
+    # writes and renames, so an existing entry is always complete
+    partial = '%s.%d.partial' % (path, os.getpid())
+    f = open(partial, 'wb')
+    try:
+      numpy.save(f, numpy.asarray(array))
+    finally:
+      f.close()
+    os.rename(partial, path)
+
+  def entries(self):
+    """Returns a list with the path, size and last use time of every entry,
+    from the least to the most recently used"""
+
+    retval = []
+    for root, dirs, files in os.walk(self.directory):
+      for name in files:
+        if not name.endswith('.npy'): continue
+        path = os.path.join(root, name)
+        try:
+          stat = os.stat(path)
+        except OSError: #removed by another process
+          continue
+        retval.append((path, stat.st_size, stat.st_mtime))
+
+    return sorted(retval, key=lambda k: k[2])
+
+  def evict(self, max_size=None, max_age=None):
+    """Removes entries from the cache
+
+    Keyword parameters:
+
+    max_size
+      If given, the least recently used entries are removed until the total
+      size of the cache is at most this number of bytes
+
+    max_age
+      If given, entries that were not used for more than this number of
+      seconds are removed
+
+    Returns the number of entries removed and the number of bytes freed.
+    """
+
+    import time
+
+    entries = self.entries()
+    total = sum([k[1] for k in entries])
+    now = time.time()
+
+    removed = 0
+    freed = 0
+    for path, size, mtime in entries:
+      expired = max_age is not None and (now - mtime) > max_age
+      oversized = max_size is not None and (total - freed) > max_size
+      if not (expired or oversized): continue
+      try:
+        os.unlink(path)
+      except OSError: #removed by another process
+        continue
+      removed += 1
+      freed += size
+
+    return removed, freed
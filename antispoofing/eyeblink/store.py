@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Consolidated storage of per-video arrays (features, scores or blinks) for a
+whole protocol, in a single file
+"""
+
+import os
+import numpy
+
+#: The extension identifying feature stores, instead of directories with one
+#: file per video, on the command line of all scripts
+EXTENSION = '.store'
+
+#: The layout of the index of a feature store
+INDEX = [
+    ('id', 'int64'),
+    ('offset', 'int64'),
+    ('length', 'int64'),
+    ]
+
+def is_store(path):
+  """Tells if the given path refers to a feature store (see
+  :py:data:`EXTENSION`) instead of a directory"""
+
+  return path.endswith(EXTENSION)
+
+def exists(path):
+  """Tells if the given directory or store exists. A store written by grid
+  tasks may exist only as shards (see :py:meth:`FeatureStore.shard`), before
+  it is consolidated."""
+
+  if os.path.exists(path): return True
+  return is_store(path) and bool(FeatureStore.shards(path))
+
+class FeatureStore(object):
+  """Ragged arrays for many videos, keyed by file id
+
+  A store is a file with two arrays in ``.npy`` format, one after the other: an
+  index (see :py:data:`INDEX`) followed by the rows of the arrays of all
+  videos, concatenated along the first dimension. The index keeps, for every
+  file id, the offset and number of its rows. The rows are memory-mapped, so
+  only the arrays that are used are ever read from disk.
+
+  Parallel writers do not modify the store, but write their own (smaller)
+  stores, called shards, next to it (see :py:meth:`shard`). When a store is
+  opened, its shards are read (into memory) as well, with arrays in shards
+  taking precedence. Use :py:meth:`consolidate` to merge the shards into the
+  store.
+
+  Keyword parameters:
+
+  filename
+    The name of the file containing the store. It does not need to exist.
+  """
+
+  def __init__(self, filename):
+
+    self.filename = filename
+    self.entries = {}
+
+    sources = [(k, False) for k in FeatureStore.shards(filename)]
+    if os.path.exists(filename): sources.insert(0, (filename, True))
+    for source, mmap in sources:
+      index, rows = FeatureStore.read(source, mmap)
+      for entry in index:
+        self.entries[int(entry['id'])] = \
+            rows[entry['offset']:(entry['offset']+entry['length'])]
+
+  @staticmethod
+  def read(filename, mmap=True):
+    """Returns the index and the rows of a single store file, ignoring any
+    shards. Rows are memory-mapped, unless ``mmap`` is not set, in which case
+    they are read into memory and no file is kept open."""
+
+    from numpy.lib import format
+
+    f = open(filename, 'rb')
+    try:
+      format.read_magic(f)
+      shape, fortran, dtype = format.read_array_header_1_0(f)
+      index = numpy.fromfile(f, dtype=dtype, count=shape[0])
+      format.read_magic(f)
+      shape, fortran, dtype = format.read_array_header_1_0(f)
+      offset = f.tell()
+      if not mmap:
+        count = int(numpy.prod(shape))
+        rows = numpy.fromfile(f, dtype=dtype, count=count).reshape(shape)
+    finally:
+      f.close()
+
+    if mmap and shape[0]:
+      rows = numpy.memmap(filename, dtype=dtype, mode='r', offset=offset,
+          shape=shape)
+    elif mmap:
+      rows = numpy.zeros(shape, dtype=dtype)
+
+    return index, rows
+
+  @staticmethod
+  def write(filename, items):
+    """Writes a new store file (replacing an existing one)
+
+    Keyword parameters:
+
+    filename
+      The name of the file to create
+
+    items
+      An iterable over tuples ``(id, array)``. All arrays should have the same
+      type and shape, except for the first dimension.
+    """
+
+    from numpy.lib import format
+
+    index = []
+    arrays = []
+    offset = 0
+    for id, array in items:
+      array = numpy.asarray(array)
+      if array.ndim == 0: array = array.reshape(1)
+      arrays.append(array)
+      index.append((id, offset, len(array)))
+      offset += len(array)
+
+    index = numpy.array(index, dtype=INDEX)
+    if arrays: rows = numpy.concatenate(arrays)
+    else: rows = numpy.zeros((0,), dtype='float64')
+
+    directory = os.path.dirname(filename)
+    if directory and not os.path.exists(directory): os.makedirs(directory)
+
+    # writes and renames, so an existing store is always complete
+    partial = '%s.%d.partial' % (filename, os.getpid())
+    f = open(partial, 'wb')
+    try:
+      format.write_array(f, index)
+      format.write_array(f, rows)
+    finally:
+      f.close()
+    os.rename(partial, filename)
+
+  @staticmethod
+  def shard(filename, name):
+    """Returns the name of the shard file with the given name, for the store
+    in ``filename``"""
+
+    return '%s.%s.shard' % (filename, name)
+
+  @staticmethod
+  def shards(filename):
+    """Returns the (sorted) names of all shard files of a store"""
+
+    directory = os.path.dirname(filename) or os.curdir
+    if not os.path.exists(directory): return []
+    prefix = os.path.basename(filename) + '.'
+    return [os.path.join(os.path.dirname(filename), k) for k in \
+        sorted(os.listdir(directory)) if k.startswith(prefix) and \
+        k.endswith('.shard')]
+
+  @staticmethod
+  def consolidate(filename, arrays=None):
+    """Merges all shards of a store into the store file and removes them
+
+    Keyword parameters:
+
+    filename
+      The name of the store file. It is created if it does not exist.
+
+    arrays
+      An optional dictionary mapping file ids to arrays to add to the store,
+      taking precedence over the ones in the store and its shards
+    """
+
+    shards = FeatureStore.shards(filename)
+    if not shards and not arrays: return
+
+    store = FeatureStore(filename)
+    entries = dict([(k, store[k]) for k in store.ids()])
+    if arrays: entries.update(arrays)
+    FeatureStore.write(filename, sorted(entries.items()))
+    for shard in shards:
+      try:
+        os.unlink(shard)
+      except OSError: #consolidated by another process in the meanwhile
+        pass
+
+  def ids(self):
+    """Returns the (sorted) list of file ids in the store"""
+
+    return sorted(self.entries.keys())
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __contains__(self, id):
+    return id in self.entries
+
+  def __getitem__(self, id):
+    return self.entries[id]
+
+class StageInput(object):
+  """Loads the arrays of a processing stage for every video, either from a
+  directory with one file per video or from a :py:class:`FeatureStore`
+
+  Shards left next to a store (e.g. by the grid tasks of ``framediff.py``)
+  are merged into it (see :py:meth:`FeatureStore.consolidate`) before it is
+  read, so the following stages always read a single file.
+
+  Keyword parameters:
+
+  path
+    A directory or the name of a store file (see :py:func:`is_store`)
+
+  extension
+    The extension of the files in the directory
+  """
+
+  def __init__(self, path, extension='.hdf5'):
+
+    self.path = path
+    self.extension = extension
+    self.store = None
+    if is_store(path):
+      FeatureStore.consolidate(path)
+      self.store = FeatureStore(path)
+
+  def load(self, obj):
+    """Returns the array for a database object"""
+
+    if self.store is None: return obj.load(self.path, self.extension)
+    return numpy.array(self.store[obj.id])
+
+  def rows(self, obj, rows):
+    """Returns the given rows of the array for a database object. Rows are only
+    read from stores, while whole files are loaded from directories."""
+
+    if self.store is None: return obj.load(self.path, self.extension)[rows]
+    return numpy.array(self.store[obj.id][rows])
+
+class StageOutput(object):
+  """Saves the arrays of a processing stage for every video, either on a
+  directory with one file per video or on a :py:class:`FeatureStore`
+
+  Arrays saved on a store are kept in memory and only written when
+  :py:meth:`close` is called.
+
+  Keyword parameters:
+
+  path
+    A directory or the name of a store file (see :py:func:`is_store`)
+
+  extension
+    The extension of the files in the directory
+
+  shard
+    If set, the arrays are written to a shard with this name (see
+    :py:meth:`FeatureStore.shard`), which is rewritten every time an array is
+    saved, so many processes can write to the same store and a failing
+    process does not lose the arrays it already saved. Arrays already in the
+    shard (e.g. saved by a previous run of the same grid task) are kept.
+    Otherwise, the arrays are merged into the store, together with any
+    existing shards, when :py:meth:`close` is called.
+  """
+
+  def __init__(self, path, extension='.hdf5', shard=None):
+
+    self.path = path
+    self.extension = extension
+    self.shard = shard
+    self.arrays = {}
+    self.existing = None
+
+  def exists(self, obj):
+    """Tells if the array for a database object was already saved (by this or
+    a previous run)"""
+
+    if not is_store(self.path):
+      return os.path.exists(obj.make_path(self.path, self.extension))
+
+    if obj.id in self.arrays: return True
+    if self.existing is None: self.existing = FeatureStore(self.path)
+    return obj.id in self.existing
+
+  def save(self, obj, array):
+    """Saves the array for a database object"""
+
+    if not is_store(self.path):
+      obj.save(array, directory=self.path, extension=self.extension)
+    elif self.shard is not None:
+      shard = FeatureStore.shard(self.path, self.shard)
+      if not self.arrays and os.path.exists(shard):
+        index, rows = FeatureStore.read(shard, mmap=False)
+        for entry in index:
+          self.arrays[int(entry['id'])] = \
+              rows[entry['offset']:(entry['offset']+entry['length'])]
+      self.arrays[obj.id] = numpy.array(array)
+      FeatureStore.write(shard, sorted(self.arrays.items()))
+    else:
+      self.arrays[obj.id] = numpy.array(array)
+
+  def close(self):
+    """Writes the arrays saved on a store. Arrays saved on a shard were
+    already written."""
+
+    if not is_store(self.path) or self.shard is not None or not self.arrays:
+      return
+
+    FeatureStore.consolidate(self.path, self.arrays)
+    self.arrays = {}
+
+class BlinkSummary(object):
+  """The frames at which the number of eye-blinks detected on every video
+  increases, as written by ``count_blinks.py`` next to the blinks
+
+  The number of blinks detected up to any frame can be read from a summary
+  without loading the (cumulative) blink arrays, which are as long as the
+  videos. Summaries are stored in a :py:class:`FeatureStore`, with the length
+  of the blink array of every video, the modification time (in microseconds)
+  and size of the file it was read from (see :py:meth:`source`) followed by
+  the frames at which blinks were detected. Entries whose source file changed
+  after the summary was written are not used (see :py:meth:`valid`).
+
+  Keyword parameters:
+
+  path
+    The directory or store file containing the blinks (see
+    :py:meth:`filename`)
+  """
+
+  def __init__(self, path):
+
+    self.path = path
+    self.store = FeatureStore(BlinkSummary.filename(path))
+    # arrays in shards of a blinks store override the ones in the store file,
+    # which is what the summary is checked against
+    self.sharded = is_store(path) and bool(FeatureStore.shards(path))
+
+  @staticmethod
+  def filename(path):
+    """Returns the name of the summary file for the blinks in ``path``"""
+
+    if is_store(path): return path[:-len(EXTENSION)] + '-summary' + EXTENSION
+    return os.path.join(path, 'summary' + EXTENSION)
+
+  @staticmethod
+  def source(path, obj):
+    """Returns the modification time (in microseconds) and size of the file
+    containing the blinks of a database object: the store file or the file of
+    the object in the directory ``path``. Returns ``None`` if there is no such
+    file."""
+
+    if not is_store(path): path = obj.make_path(path, '.hdf5')
+    try:
+      stat = os.stat(path)
+    except OSError:
+      return None
+    return int(stat.st_mtime * 1e6), stat.st_size
+
+  @staticmethod
+  def write(path, items):
+    """Writes (or updates) the summary for the blinks in ``path``. The blinks
+    should already be saved there.
+
+    Keyword parameters:
+
+    path
+      The directory or store file containing the blinks
+
+    items
+      An iterable over tuples ``(obj, blinks)``, with a database object and
+      the cumulative number of blinks detected up to every frame of its video
+      (as produced by :py:func:`.utils.count_blinks`)
+    """
+
+    arrays = {}
+    for obj, blinks in items:
+      blinks = numpy.asarray(blinks)
+      source = BlinkSummary.source(path, obj)
+      if source is None: continue #blinks were not saved
+      events = numpy.flatnonzero(numpy.diff(numpy.concatenate(([0], blinks))))
+      arrays[obj.id] = numpy.concatenate(([len(blinks)], source,
+        events)).astype('int64')
+
+    FeatureStore.consolidate(BlinkSummary.filename(path), arrays)
+
+  @staticmethod
+  def open(path):
+    """Returns the summary for the blinks in ``path`` or ``None``, if there is
+    none"""
+
+    if not os.path.exists(BlinkSummary.filename(path)): return None
+    return BlinkSummary(path)
+
+  def __contains__(self, id):
+    return id in self.store
+
+  def valid(self, obj):
+    """Tells if the summary has an entry for a database object, written for
+    the blinks that are currently saved. Otherwise, the blinks should be read
+    from their file."""
+
+    if self.sharded or obj.id not in self.store: return False
+    entry = self.store[obj.id]
+    if len(entry) < 3: return False
+    return BlinkSummary.source(self.path, obj) == (entry[1], entry[2])
+
+  def counts(self, id, rows):
+    """Returns the number of blinks detected up to the given frames (rows of
+    the blink array, which may be negative), for the video with the given id,
+    as a float64 array"""
+
+    entry = self.store[id]
+    length, events = entry[0], entry[3:]
+    rows = numpy.asarray(rows, dtype='int64')
+    if (rows >= length).any() or (rows < -length).any():
+      raise IndexError, "index out of bounds for blinks of length %d" % length
+    rows = numpy.where(rows < 0, rows + length, rows)
+    return numpy.searchsorted(events, rows, 'right').astype('float64')
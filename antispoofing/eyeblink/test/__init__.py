@@ -0,0 +1,7 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Tests for the eye-blink counter-measure. Run them with::
+
+  $ python -m unittest discover -t . -s antispoofing/eyeblink/test
+"""
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Tests the array-backed annotations against the original dictionaries
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from .. import utils
+from ..annotations import AnnotationTable, AnnotationCache
+
+#: Landmarks of a frontal face on a 320x240 frame
+LANDMARKS = numpy.array([[160, 120], [140, 100], [180, 100], [145, 160],
+  [175, 160], [120, 100], [200, 100], [160, 135]])
+
+def flandmark_lines(generator, length, missing=0.1):
+  """Annotations for a slowly moving face, in flandmark format, with some
+  frames missing and some faces narrower than the default minimum width"""
+
+  retval = []
+  offset = numpy.zeros((2,), dtype=int)
+  for key in range(length):
+    offset += generator.randint(-2, 3, 2)
+    if generator.rand() < missing: continue
+    landmarks = LANDMARKS + offset + generator.randint(-1, 2, LANDMARKS.shape)
+    width = generator.randint(40, 140)
+    bbox = [landmarks[0,0] - width//2, landmarks[0,1] - width//2, width, width]
+    retval.append(' '.join([str(k) for k in [key] + bbox +
+      landmarks.ravel().tolist()]))
+  return retval
+
+def astuples(annotation):
+  """The annotation of a frame, with all sequences as tuples (the original
+  dictionaries mix tuples and lists)"""
+
+  if annotation is None: return None
+
+  def convert(value):
+    if isinstance(value, (list, tuple)): return tuple([convert(k) for k in value])
+    return value
+
+  return dict([(k, convert(v)) for k, v in annotation.items()])
+
+class AnnotationTableTest(unittest.TestCase):
+
+  def setUp(self):
+
+    self.directory = tempfile.mkdtemp()
+    self.filename = os.path.join(self.directory, 'video.flandmark')
+    self.length = 60
+    f = open(self.filename, 'wt')
+    f.write('\n'.join(flandmark_lines(numpy.random.RandomState(0),
+      self.length)) + '\n')
+    f.close()
+
+    self.dictionary = utils.flandmark_read_annotations(self.filename, False)
+    self.table = AnnotationTable.flandmark_read(self.filename, self.length)
+
+  def tearDown(self):
+
+    shutil.rmtree(self.directory)
+
+  def test_dictionary_interface(self):
+
+    self.assertEqual(sorted(self.dictionary.keys()), self.table.keys())
+    self.assertEqual(len(self.dictionary), len(self.table))
+    for key in range(-1, self.length + 1):
+      self.assertEqual(self.dictionary.has_key(key), self.table.has_key(key))
+      self.assertEqual(astuples(self.dictionary.get(key)),
+          self.table.get(key))
+    for key, value in self.table.iteritems():
+      self.assertEqual(astuples(self.dictionary[key]), value)
+    self.assertRaises(KeyError, self.table.__getitem__, -1)
+
+  def test_modified(self):
+
+    key = self.table.keys()[0]
+    self.table.filter_width(1000)
+    self.assertFalse(self.table.has_key(key))
+    self.assertEqual(self.table.keys(), [])
+
+  def test_used_frames(self):
+
+    self.assertEqual(utils.used_frames(self.dictionary),
+        utils.used_frames(self.table))
+
+  def test_difference_buffer(self):
+
+    self.assertEqual(
+        utils.DifferenceBuffer.from_annotations(self.dictionary).array.shape,
+        utils.DifferenceBuffer.from_annotations(self.table).array.shape)
+
+  def test_frame_differences(self):
+
+    generator = numpy.random.RandomState(1)
+    frames = generator.randint(0, 256, (self.length, 240, 320)).astype('uint8')
+    for start in (0, 5):
+      expected = list(utils.frame_differences(frames[start:],
+        self.dictionary, 0.2, start))
+      obtained = list(utils.frame_differences(frames[start:], self.table,
+        0.2, start))
+      self.assertTrue(numpy.array_equal(expected, obtained))
+
+  def test_cache_long_paths(self):
+
+    directory = os.path.join(self.directory, 'a' * 200, 'b' * 200, 'c' * 200)
+    os.makedirs(directory)
+    source = os.path.join(directory, 'video.flandmark')
+    shutil.copy(self.filename, source)
+
+    cache = os.path.join(self.directory, 'cache.bin')
+    AnnotationCache.create(cache, [self.filename, source])
+    expected = AnnotationTable.read(self.filename, self.length).keys()
+    for filename in (self.filename, source):
+      table = AnnotationCache.open(cache).table(filename, self.length)
+      self.assertTrue(table is not None)
+      self.assertEqual(expected, table.keys())
+
+  def test_light_normalized_frames(self):
+
+    generator = numpy.random.RandomState(2)
+    frames = generator.randint(0, 256, (self.length, 240, 320)).astype('uint8')
+    normalize = utils.light_normalizer('histogram', 'union')
+    expected = list(utils.light_normalized_frames(numpy.array(frames),
+      self.dictionary, normalize, used_only=True))
+    obtained = list(utils.light_normalized_frames(numpy.array(frames),
+      self.table, normalize, used_only=True))
+    self.assertTrue(numpy.array_equal(expected, obtained))
+    self.assertFalse(numpy.array_equal(expected, frames))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Tests the batched blink counting and the threshold sweep against the
+per-video and per-threshold implementations
+"""
+
+import unittest
+import numpy
+
+from .. import utils
+
+def scores(generator, length, blinks=6):
+  """Scores of a video with some eye-blinks (peaks of the eye differences)"""
+
+  features = numpy.ndarray((length, 2), dtype='float64')
+  features[:,0] = generator.rand(length) * 5.
+  features[:,1] = generator.rand(length) * 5. + 5.
+  features[generator.rand(length) * length < blinks, 0] += 40.
+  features[generator.rand(length) < 0.05, 0] = 0.
+  return utils.score(features)
+
+class CountBlinksTest(unittest.TestCase):
+
+  def setUp(self):
+
+    generator = numpy.random.RandomState(0)
+    self.scores = [scores(generator, k) for k in (150, 97, 1, 0, 150, 60)]
+
+  def test_batch(self):
+
+    stacked = utils.stack_sequences(self.scores)
+    lengths = [len(k) for k in self.scores]
+    for thres_ratio, skip in ((3., 10), (1., 0), (0.5, 3), (3., 200)):
+      for given in (lengths, None):
+        blinks = utils.count_blinks_batch(stacked, thres_ratio, skip, given)
+        for row, expected in zip(blinks, self.scores):
+          expected = utils.count_blinks(expected, thres_ratio, skip)
+          self.assertTrue(numpy.array_equal(row[:len(expected)], expected))
+          self.assertTrue(numpy.isnan(row[len(expected):]).all())
+
+  def test_single(self):
+
+    for sequence in self.scores:
+      self.assertTrue(numpy.array_equal(
+        utils.count_blinks_batch(sequence, 3., 10),
+        utils.count_blinks(sequence, 3., 10)))
+
+class BlinkSweepTest(unittest.TestCase):
+
+  def setUp(self):
+
+    generator = numpy.random.RandomState(0)
+    self.negatives = generator.poisson(0.5, (40, 3)).astype('float64')
+    self.positives = generator.poisson(3., (25, 3)).astype('float64')
+
+  def test_errors(self):
+
+    thresholds, far, frr, hter = utils.blink_sweep(self.negatives,
+        self.positives)
+    self.assertEqual(thresholds[-1], max(self.negatives.max(),
+      self.positives.max()) + 1)
+    for row, blinks in enumerate(thresholds):
+      for column in range(self.negatives.shape[1]):
+        expected = utils.blink_errors(self.negatives[:,column],
+            self.positives[:,column], blinks)
+        self.assertTrue(numpy.allclose(expected, (far[row,column],
+          frr[row,column], hter[row,column])))
+
+  def test_single_column(self):
+
+    sweep = utils.blink_sweep(self.negatives[:,0], self.positives[:,0], 4)
+    self.assertTrue(numpy.array_equal(sweep[0], numpy.arange(5)))
+    for k, errors in enumerate(sweep[1:]):
+      self.assertEqual(errors.shape, (5, 1))
+      full = utils.blink_sweep(self.negatives, self.positives, 4)[k+1]
+      self.assertTrue(numpy.array_equal(errors[:,0], full[:,0]))
+
+  def test_selection(self):
+
+    thresholds, far, frr, hter = utils.blink_sweep(self.negatives,
+        self.positives)
+    for column in range(self.negatives.shape[1]):
+      # the first threshold reaching the lowest value, by brute force
+      eer = [abs(far[k,column] - frr[k,column]) for k in \
+          range(len(thresholds))]
+      self.assertEqual(utils.select_blink_threshold(far, frr, 'eer')[column],
+          eer.index(min(eer)))
+      total = [hter[k,column] for k in range(len(thresholds))]
+      self.assertEqual(
+          utils.select_blink_threshold(far, frr, 'min-hter')[column],
+          total.index(min(total)))
+    self.assertRaises(ValueError, utils.select_blink_threshold, far, frr,
+        'unknown')
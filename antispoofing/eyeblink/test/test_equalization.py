@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Tests the (batched) histogram equalization against a per-pixel reference
+and against Bob, where it is installed
+"""
+
+import unittest
+import numpy
+
+from .. import utils
+
+def reference(image):
+  """Per-pixel implementation of the histogram equalization of
+  ``bob.ip.histogram_equalization``"""
+
+  values = image.ravel().tolist()
+  pixels = float(len(values))
+  cdf = []
+  for k in range(256):
+    frequency = values.count(k) / pixels
+    cdf.append(cdf[-1] + frequency if cdf else frequency)
+  cdf_min = min(cdf)
+  retval = numpy.zeros(image.shape, dtype='uint8')
+  if cdf_min == 1.: return retval
+  for index, v in numpy.ndenumerate(image):
+    retval[index] = min(int((cdf[v] - cdf_min) / (1. - cdf_min) * 255.), 255)
+  return retval
+
+def crops():
+  """Random crops (of two sizes), low-contrast crops and constant crops of a
+  few values"""
+
+  generator = numpy.random.RandomState(0)
+  retval = [generator.randint(0, 256, (12, 10)).astype('uint8')
+      for k in range(3)]
+  retval += [generator.randint(60, 90, (12, 10)).astype('uint8')
+      for k in range(3)]
+  retval += [generator.randint(0, 256, (97, 83)).astype('uint8')]
+  retval += [numpy.zeros((12, 10), dtype='uint8') + k for k in (0, 1, 128, 255)]
+  return retval
+
+class EqualizationTest(unittest.TestCase):
+
+  def test_reference(self):
+
+    for crop in crops():
+      self.assertTrue((utils.equalize_histograms(crop) ==
+        reference(crop)).all())
+
+  def test_stack(self):
+
+    stack = numpy.array([k for k in crops() if k.shape == (12, 10)])
+    equalized = utils.equalize_histograms(stack)
+    for crop, result in zip(stack, equalized):
+      self.assertTrue((utils.equalize_histograms(crop) == result).all())
+
+  def test_extremes(self):
+
+    crop = crops()[3]
+    result = utils.equalize_histograms(crop)
+    self.assertTrue(result[crop == crop.min()].max() > 0)
+    self.assertEqual(result[crop == crop.max()].min(), 255)
+
+    crop[crop == crop.min()] = 0
+    self.assertEqual(utils.equalize_histograms(crop)[crop == 0].max(), 0)
+
+    for constant in crops()[-4:]:
+      expected = 0 if constant[0,0] == 0 else 255
+      self.assertTrue((utils.equalize_histograms(constant) == expected).all())
+
+  def test_bob(self):
+
+    try:
+      from bob.ip import histogram_equalization
+    except ImportError:
+      raise unittest.SkipTest("bob.ip.histogram_equalization is not available")
+
+    for crop in crops():
+      self.assertTrue((utils.equalize_histograms(crop) ==
+        histogram_equalization(crop)).all())
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Tests the whole-video frame differences against the frame-by-frame ones
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from .. import utils
+from .test_annotations import flandmark_lines
+
+class VideoFeaturesTest(unittest.TestCase):
+
+  def setUp(self):
+
+    directory = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(directory, 'video.flandmark')
+      self.length = 50
+      f = open(filename, 'wt')
+      f.write('\n'.join(flandmark_lines(numpy.random.RandomState(0),
+        self.length)) + '\n')
+      f.close()
+      self.annotations = utils.flandmark_read_annotations(filename, False)
+    finally:
+      shutil.rmtree(directory)
+
+    generator = numpy.random.RandomState(1)
+    self.frames = generator.randint(0, 256,
+        (self.length, 240, 320)).astype('uint8')
+
+  def check(self, exact):
+
+    expected = numpy.array(list(utils.frame_differences(self.frames,
+      self.annotations, 0.2, exact=exact)))
+    arrays = utils.annotation_arrays(self.annotations, self.length)
+    for block in (1, 7, 64):
+      obtained = utils.video_features(self.frames, *arrays,
+          max_center_displacement=0.2, exact=exact, block=block)
+      self.assertTrue(numpy.isnan(obtained[0]).all())
+      self.assertTrue(numpy.allclose(expected, obtained[1:]))
+
+  def test_approximate(self):
+
+    self.check(False)
+
+  def test_exact(self):
+
+    self.check(True)
+
+  def test_blocks(self):
+
+    arrays = utils.annotation_arrays(self.annotations, self.length)
+    expected = utils.video_features(self.frames, *arrays,
+        max_center_displacement=0.2)
+    obtained = numpy.ndarray(expected.shape, dtype='float64')
+    obtained[:] = numpy.NaN
+    for start, block in utils.frame_blocks(iter(self.frames), 8):
+      end = start + len(block)
+      obtained[(start+1):end] = utils.video_features(block,
+          *[k[start:end] for k in arrays], max_center_displacement=0.2)[1:]
+    self.assertTrue(numpy.allclose(expected, obtained, equal_nan=True))
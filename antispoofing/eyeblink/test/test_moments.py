@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Tests the running statistics against the mean and standard deviation of
+every prefix of the signal
+"""
+
+import unittest
+import numpy
+
+from ..moments import cumulative_moments, RunningMoments
+
+class MomentsTest(unittest.TestCase):
+
+  def setUp(self):
+
+    generator = numpy.random.RandomState(0)
+    self.signals = generator.rand(3, 200) * 10. + 1000.
+
+  def test_prefixes(self):
+
+    for method in ('welford', 'sum'):
+      mean, std = cumulative_moments(self.signals[0], method)
+      self.assertTrue(numpy.allclose(mean, [numpy.mean(self.signals[0,:k+1])
+        for k in range(self.signals.shape[1])]))
+      self.assertTrue(numpy.allclose(std, [numpy.std(self.signals[0,:k+1])
+        for k in range(self.signals.shape[1])], atol=1e-6))
+
+  def test_rows(self):
+
+    mean, std = cumulative_moments(self.signals)
+    for k, signal in enumerate(self.signals):
+      row_mean, row_std = cumulative_moments(signal)
+      self.assertTrue(numpy.array_equal(mean[k], row_mean))
+      self.assertTrue(numpy.array_equal(std[k], row_std))
+
+  def test_running(self):
+
+    mean, std = cumulative_moments(self.signals[0])
+    running = RunningMoments()
+    for k, value in enumerate(self.signals[0]):
+      self.assertEqual((mean[k], std[k]), running.update(value))
+
+  def test_merge(self):
+
+    first = RunningMoments(self.signals[0,:70])
+    first.merge(RunningMoments(self.signals[0,70:]))
+    self.assertAlmostEqual(first.mean, numpy.mean(self.signals[0]))
+    self.assertAlmostEqual(first.std, numpy.std(self.signals[0]))
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Tests the online blink detector against the scores and blinks calculated
+on whole videos
+"""
+
+import unittest
+import numpy
+
+from .. import utils
+from ..online import OnlineBlinkDetector
+
+class OnlineBlinkDetectorTest(unittest.TestCase):
+
+  def setUp(self):
+
+    generator = numpy.random.RandomState(0)
+    length = 200
+    self.features = numpy.ndarray((length, 2), dtype='float64')
+    self.features[:,0] = generator.rand(length) * 5.
+    self.features[:,1] = generator.rand(length) * 5. + 5.
+    self.features[generator.rand(length) < 0.04, 0] += 40.
+    self.features[generator.rand(length) < 0.05, 0] = 0.
+    self.features[0] = numpy.NaN #the first frame has no predecessor
+
+    self.scores = utils.score(self.features)
+    self.blinks = utils.count_blinks(self.scores, 3., 10)
+
+  def test_push(self):
+
+    detector = OnlineBlinkDetector(threshold_ratio=3., skip_frames=10)
+    self.assertEqual(detector.score, self.scores[0])
+    self.assertEqual(detector.blinks, self.blinks[0])
+    for k, (eye, facerem) in enumerate(self.features[1:], 1):
+      self.assertEqual((self.scores[k], self.blinks[k]),
+          detector.push(eye, facerem))
+
+  def test_decide(self):
+
+    self.assertTrue(self.blinks[-1] >= 2)
+    detector = OnlineBlinkDetector(threshold_ratio=3., skip_frames=10)
+    frame, blinks = detector.decide(self.features[1:], blinks=2)
+    self.assertEqual(blinks, 2)
+    self.assertEqual(frame, numpy.searchsorted(self.blinks, 2))
+
+    detector.reset()
+    self.assertEqual(detector.decide(self.features[1:], blinks=2, budget=5),
+        (4, self.blinks[4]))
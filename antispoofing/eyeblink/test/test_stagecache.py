@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Tests the invalidation of entries of the stage cache
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from .. import stagecache
+from ..stagecache import StageCache
+
+class StageCacheTest(unittest.TestCase):
+
+  def setUp(self):
+
+    self.directory = tempfile.mkdtemp()
+    self.input = os.path.join(self.directory, 'video.avi')
+    open(self.input, 'wb').write('frames')
+    self.cache = StageCache(os.path.join(self.directory, 'cache'))
+
+  def tearDown(self):
+
+    shutil.rmtree(self.directory)
+
+  def test_keys(self):
+
+    key = StageCache.key('framediff', {'a': 1}, inputs=(self.input,))
+    self.assertEqual(key, StageCache.key('framediff', {'a': 1},
+      inputs=(self.input,)))
+    self.assertNotEqual(key, StageCache.key('framediff', {'a': 2},
+      inputs=(self.input,)))
+    self.assertNotEqual(StageCache.key('make_scores', {}, upstream=(key,)),
+        StageCache.key('make_scores', {}, upstream=(key[::-1],)))
+
+    version = stagecache.VERSIONS['framediff']
+    try:
+      stagecache.VERSIONS['framediff'] = version + 1
+      self.assertNotEqual(key, StageCache.key('framediff', {'a': 1},
+        inputs=(self.input,)))
+    finally:
+      stagecache.VERSIONS['framediff'] = version
+
+  def test_get_put_evict(self):
+
+    key = StageCache.key('count_blinks', {})
+    self.assertTrue(self.cache.get(key) is None)
+    self.cache.put(key, numpy.arange(5))
+    self.assertTrue((self.cache.get(key) == numpy.arange(5)).all())
+    self.assertEqual(self.cache.evict(max_size=0)[0], 1)
+    self.assertTrue(self.cache.get(key) is None)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Tests the grid shards of feature stores and the blink summaries against
+the blinks they were written for
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from ..store import FeatureStore, BlinkSummary, StageInput, StageOutput
+
+class File(object):
+  """The parts of a database object used to save and load arrays"""
+
+  def __init__(self, id):
+    self.id = id
+    self.path = 'video%d' % id
+
+  def make_path(self, directory, extension):
+    return os.path.join(directory, self.path + extension)
+
+  def save(self, array, directory, extension):
+    f = open(self.make_path(directory, extension), 'wb')
+    try:
+      numpy.save(f, array)
+    finally:
+      f.close()
+
+  def load(self, directory, extension):
+    return numpy.load(self.make_path(directory, extension))
+
+class ShardTest(unittest.TestCase):
+
+  def setUp(self):
+
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'features.store')
+
+  def tearDown(self):
+
+    shutil.rmtree(self.directory)
+
+  def test_tasks(self):
+
+    # two grid tasks of 3 videos, the second one fails on its last video
+    for task in (0, 1):
+      writer = StageOutput(self.path, shard='task%05d' % task)
+      for id in range(3*task, 3*task + (2 if task else 3)):
+        writer.save(File(id), numpy.ones((id+1, 2)) * id)
+      if not task: writer.close()
+    self.assertEqual(len(FeatureStore.shards(self.path)), 2)
+
+    # resubmitted, the second task keeps the videos it already saved
+    writer = StageOutput(self.path, shard='task00001')
+    self.assertTrue(writer.exists(File(4)))
+    self.assertFalse(writer.exists(File(5)))
+    writer.save(File(5), numpy.ones((6, 2)) * 5)
+
+    reader = StageInput(self.path)
+    self.assertEqual(FeatureStore.shards(self.path), [])
+    self.assertEqual(reader.store.ids(), range(6))
+    for id in range(6):
+      self.assertTrue(numpy.array_equal(reader.load(File(id)),
+        numpy.ones((id+1, 2)) * id))
+
+class BlinkSummaryTest(unittest.TestCase):
+
+  def setUp(self):
+
+    self.directory = tempfile.mkdtemp()
+    self.objs = [File(1), File(2)]
+    self.blinks = {
+        1: numpy.array([0, 0, 1, 1, 2], 'float64'),
+        2: numpy.array([0, 1, 1], 'float64'),
+        }
+
+  def tearDown(self):
+
+    shutil.rmtree(self.directory)
+
+  def save(self, path, objs):
+
+    writer = StageOutput(path)
+    for obj in objs: writer.save(obj, self.blinks[obj.id])
+    writer.close()
+
+  def check(self, path):
+
+    self.save(path, self.objs)
+    BlinkSummary.write(path, [(k, self.blinks[k.id]) for k in self.objs])
+
+    summary = BlinkSummary.open(path)
+    self.assertTrue(all([summary.valid(k) for k in self.objs]))
+    reader = StageInput(path)
+    for obj in self.objs:
+      rows = [0, 1, -1]
+      self.assertTrue(numpy.array_equal(summary.counts(obj.id, rows),
+        reader.rows(obj, rows)))
+
+    # blinks saved again after the summary was written
+    time.sleep(0.02)
+    self.blinks[2] = numpy.array([0, 0, 0, 0], 'float64')
+    self.save(path, self.objs[1:])
+    self.assertFalse(BlinkSummary.open(path).valid(self.objs[1]))
+
+  def test_directory(self):
+
+    self.check(self.directory)
+
+  def test_store(self):
+
+    self.check(os.path.join(self.directory, 'blinks.store'))
@@ -40,9 +40,13 @@ def load_annotations(obj, dir, ext, verbose):
     configuration used and must be interpreted accordingly.
   """
 
-  from itertools import izip
+  return read_annotations(obj.make_path(dir, ext), verbose)
+
+def read_annotations(filename, verbose):
+  """Reads annotations from a given file. See :py:func:`load_annotations` for
+  details on the returned dictionary."""
 
-  filename = obj.make_path(dir, ext)
+  from itertools import izip
 
   if verbose:
     print "Loading annotations from '%s'..." % filename,
@@ -66,47 +70,481 @@ def load_annotations(obj, dir, ext, verbose):
 
   return retval
 
-def light_normalize_tantriggs(frames, annotations, start, end):
-  """Runs the light normalization on detected faces"""
+TANTRIGGS_THRESHOLD = 10.
 
-  GAMMA = 0.2
-  SIGMA0 = 1.
-  SIGMA1 = 2.
-  SIZE = 5
-  THRESHOLD = 10.
-  ALPHA = 0.1
+def tantriggs_operator(gamma=0.2, sigma0=1., sigma1=2., size=5,
+    threshold=TANTRIGGS_THRESHOLD, alpha=0.1):
+  """Builds the Tan-Triggs operator used for light normalization"""
 
   from bob.ip import TanTriggs
+
+  return TanTriggs(gamma, sigma0, sigma1, size, threshold, alpha)
+
+def equalize_histograms(stack):
+  """Runs histogram equalization on a stack of gray-scaled images at once
+
+  The results are the same as the ones of ``bob.ip.histogram_equalization``
+  on every image. The normalized cumulative histogram ``cdf`` of every image
+  is accumulated in double precision and pixels are mapped to
+  ``(cdf[pixel] - cdf_min) / (1 - cdf_min) * 255``, truncated, where
+  ``cdf_min`` is the minimum of ``cdf`` (i.e. ``cdf[0]``). The brightest
+  pixels are then mapped to 255, but the darkest ones are only mapped to 0 if
+  their value is 0. Images with all pixels set to 0 are left unchanged.
+
+  Keyword parameters:
+
+  stack
+    A 3D (uint8) array with ``T`` images of the same size, ``(T, height,
+    width)``. A single 2D image is also accepted.
+
+  Returns a new (uint8) array with the same shape as ``stack``, containing the
+  equalized images.
+  """
+
+  stack = numpy.asarray(stack, dtype='uint8')
+  images = stack if stack.ndim == 3 else stack[numpy.newaxis]
+  count = images.shape[0]
+  pixels = images.shape[1] * images.shape[2]
+  if not count or not pixels: return stack.copy()
+
+  # all histograms at once, with the values of every image offset to its bins
+  offset = (256 * numpy.arange(count, dtype='int64')).reshape(count, 1)
+  index = images.reshape(count, pixels) + offset
+  hist = numpy.bincount(index.ravel(), minlength=256*count).reshape(count, 256)
+
+  # one lookup table per image, with the same floating-point operations as bob
+  cdf = numpy.cumsum(hist / float(pixels), axis=1)
+  cdf_min = cdf.min(axis=1).reshape(count, 1)
+  cdf_range = 1. - cdf_min
+  black = (cdf_range == 0.).ravel() #all pixels are 0
+  cdf_range[black] = 1.
+  table = ((cdf - cdf_min) / cdf_range * 255.).astype('int64').clip(0, 255)
+  table[black] = 0
+
+  return table.astype('uint8').ravel()[index].reshape(stack.shape)
+
+def equalize_histogram(image):
+  """Runs histogram equalization on a single gray-scaled image (see
+  :py:func:`equalize_histograms`). Returns the equalized image."""
+
+  return equalize_histograms(image)
+
+def light_normalize_tantriggs_frame(frame, annotation, op=None):
+  """Runs the Tan-Triggs light normalization on the face remainder of a single
+  frame, in place. If the operator ``op`` is not given, a new one is built
+  using :py:func:`tantriggs_operator`."""
+
   from bob.core import convert
 
-  op = TanTriggs(GAMMA, SIGMA0, SIGMA1, SIZE, THRESHOLD, ALPHA)
+  if op is None: op = tantriggs_operator()
+
+  x, y, width, height = annotation['face_remainder']
+  res = op(frame[y:(y+height), x:(x+width)])
+  frame[y:(y+height), x:(x+width)] = convert(res, 'uint8', (0, 255),
+      (-TANTRIGGS_THRESHOLD, TANTRIGGS_THRESHOLD))
+
+def light_normalize_histogram_frame(frame, annotation):
+  """Runs histogram equalization on the face remainder of a single frame, in
+  place."""
+
+  x, y, width, height = annotation['face_remainder']
+  res = equalize_histogram(frame[y:(y+height), x:(x+width)])
+  frame[y:(y+height), x:(x+width)] = res
+
+def light_normalize_tantriggs(frames, annotations, start, end):
+  """Runs the light normalization on detected faces"""
+
+  normalize = LightNormalizer('tantriggs')
 
   counter = 0
   for key in range(start, end):
-    if annotations.has_key(key):
-      x, y, width, height = annotations[key]['face_remainder']
-      res = op(frames[counter][y:(y+height), x:(x+width)])
-      frames[counter][y:(y+height), x:(x+width)] = \
-          convert(res, 'uint8', (0, 255), (-THRESHOLD, THRESHOLD))
+    annotation = annotations.get(key)
+    if annotation is not None: normalize(frames[counter], annotation)
 
     counter += 1
 
 def light_normalize_histogram(frames, annotations, start, end):
-  """Runs the light normalization on detected faces"""
+  """Runs the light normalization on detected faces
 
-  from bob.ip import histogram_equalization
-  from bob.core import convert
+  Face remainders of the same size are equalized together, with
+  :py:func:`equalize_histograms`.
+  """
 
+  # groups the crops to normalize by size
+  groups = {}
   counter = 0
   for key in range(start, end):
-    if annotations.has_key(key):
-      x, y, width, height = annotations[key]['face_remainder']
-      res = histogram_equalization(frames[counter][y:(y+height), x:(x+width)])
-      frames[counter][y:(y+height), x:(x+width)] = res
+    annotation = annotations.get(key)
+    if annotation is not None:
+      x, y, width, height = annotation['face_remainder']
+      crop = frames[counter][y:(y+height), x:(x+width)]
+      groups.setdefault(crop.shape, []).append(crop)
 
     counter += 1
 
-def flandmark_calculate_eye_region(annotations):
+  for crops in groups.itervalues():
+    for crop, res in zip(crops, equalize_histograms(crops)): crop[:] = res
+
+def normalize_histogram_roi(roi, operator, normalizer):
+  """Light normalization strategy: histogram equalization"""
+
+  roi[:] = equalize_histogram(roi)
+
+def normalize_tantriggs_roi(roi, operator, normalizer):
+  """Light normalization strategy: Tan-Triggs, with the output mapped from
+  ``[-threshold, threshold]`` to 8-bit values"""
+
+  from bob.core import convert
+
+  res = normalizer.buffer(roi.shape)
+  operator(roi, res)
+  threshold = LIGHT_NORMALIZATIONS['tantriggs'][2]['threshold']
+  roi[:] = convert(res, 'uint8', (0, 255), (-threshold, threshold))
+
+def clahe_operator(clip_limit=2., tile_size=8):
+  """Builds the (OpenCV) operator for contrast limited adaptive histogram
+  equalization"""
+
+  import cv2
+
+  return cv2.createCLAHE(clipLimit=clip_limit,
+      tileGridSize=(tile_size, tile_size))
+
+def normalize_clahe_roi(roi, operator, normalizer):
+  """Light normalization strategy: contrast limited adaptive histogram
+  equalization (requires OpenCV)"""
+
+  roi[:] = operator.apply(numpy.ascontiguousarray(roi))
+
+#: The available light normalization strategies. Every entry maps a name to a
+#: tuple with the function normalizing a region in place (or ``None``, if no
+#: normalization should be applied), the function building the operator it
+#: needs (or ``None``) and the parameters for the latter.
+LIGHT_NORMALIZATIONS = {}
+
+def register_light_normalization(name, normalize, operator=None,
+    **parameters):
+  """Registers a light normalization strategy
+
+  Keyword parameters:
+
+  name
+    The name of the strategy (e.g. as selected on the command line)
+
+  normalize
+    A callable ``normalize(roi, operator, normalizer)`` that normalizes the
+    (uint8) region ``roi`` in place, given the operator built by ``operator``
+    and the :py:class:`LightNormalizer` that is calling it (for scratch
+    buffers). If set to ``None``, frames are not normalized.
+
+  operator
+    A callable building the operator used by ``normalize``, once per process,
+    given the ``parameters``
+
+  parameters
+    The parameters of the strategy. They identify the normalized frames in
+    caches, together with the name.
+  """
+
+  LIGHT_NORMALIZATIONS[name] = (normalize, operator, parameters)
+
+register_light_normalization('none', None)
+register_light_normalization('histogram', normalize_histogram_roi)
+register_light_normalization('tantriggs', normalize_tantriggs_roi,
+    tantriggs_operator, gamma=0.2, sigma0=1., sigma1=2., size=5,
+    threshold=TANTRIGGS_THRESHOLD, alpha=0.1)
+register_light_normalization('clahe', normalize_clahe_roi, clahe_operator,
+    clip_limit=2., tile_size=8)
+
+class LightNormalizer(object):
+  """Light-normalizes the face regions of single frames, in place, reusing the
+  normalization operator and scratch buffers across frames (and videos)
+
+  Instances are callables that can be given to
+  :py:func:`light_normalized_frames`.
+
+  Keyword parameters:
+
+  method
+    The normalization strategy to apply, one of :py:data:`LIGHT_NORMALIZATIONS`
+    (e.g. ``'histogram'``, ``'tantriggs'`` or ``'clahe'``)
+
+  region
+    The region of every frame to normalize: ``'face_remainder'`` normalizes
+    only the face remainder (as :py:func:`light_normalize_histogram_frame`
+    and :py:func:`light_normalize_tantriggs_frame` do), while ``'union'``
+    normalizes the bounding box of the face remainder and both eye regions,
+    covering every pixel read by the difference step.
+
+  Operators are built once per strategy and shared by all instances.
+  """
+
+  REGIONS = ('face_remainder', 'union')
+  operators = {}
+
+  def __init__(self, method='histogram', region='face_remainder'):
+
+    if LIGHT_NORMALIZATIONS.get(method, (None,))[0] is None:
+      raise RuntimeError, "Unknown light normalization method '%s'" % method
+    if region not in LightNormalizer.REGIONS:
+      raise RuntimeError, "Unknown light normalization region '%s'" % region
+
+    self.method = method
+    self.region = region
+    self.scratch = numpy.ndarray((0,), dtype='float64')
+
+  def box(self, annotation):
+    """Returns the box ``(x, y, width, height)`` of the region to normalize for
+    the given annotation"""
+
+    if self.region == 'face_remainder': return annotation['face_remainder']
+
+    boxes = (annotation['face_remainder'],) + tuple(annotation['eyes'])
+    x0 = min([k[0] for k in boxes])
+    y0 = min([k[1] for k in boxes])
+    x1 = max([k[0]+k[2] for k in boxes])
+    y1 = max([k[1]+k[3] for k in boxes])
+    return (x0, y0, x1-x0, y1-y0)
+
+  def buffer(self, shape):
+    """Returns a contiguous float64 scratch array with the given shape, viewing
+    a buffer that is only re-allocated if it needs to grow"""
+
+    size = shape[0] * shape[1]
+    if self.scratch.size < size:
+      self.scratch = numpy.ndarray((size,), dtype='float64')
+    return self.scratch[:size].reshape(shape)
+
+  def operator(self):
+    """Returns the operator for this normalization strategy, building it if
+    that was not done yet by this process"""
+
+    normalize, build, parameters = LIGHT_NORMALIZATIONS[self.method]
+    if build is None: return None
+    if not LightNormalizer.operators.has_key(self.method):
+      LightNormalizer.operators[self.method] = build(**parameters)
+    return LightNormalizer.operators[self.method]
+
+  def __call__(self, frame, annotation):
+    """Light-normalizes the region of interest of ``frame``, in place"""
+
+    x, y, width, height = self.box(annotation)
+    roi = frame[y:(y+height), x:(x+width)]
+    if not roi.size: return
+
+    LIGHT_NORMALIZATIONS[self.method][0](roi, self.operator(), self)
+
+def light_normalizer(method, region='face_remainder'):
+  """Returns a :py:class:`LightNormalizer` for the given strategy (see
+  :py:data:`LIGHT_NORMALIZATIONS`) or ``None``, if the strategy does not
+  normalize frames (``'none'``). The result can be given to
+  :py:func:`light_normalized_frames`."""
+
+  if not LIGHT_NORMALIZATIONS.has_key(method):
+    raise RuntimeError, "Unknown light normalization method '%s'" % method
+  if LIGHT_NORMALIZATIONS[method][0] is None: return None
+  return LightNormalizer(method, region)
+
+def used_frames(annotations):
+  """Returns the set of frame numbers whose pixels are read by the difference
+  step: annotated frames with (at least) one annotated neighbour"""
+
+  from .annotations import AnnotationTable
+
+  if isinstance(annotations, AnnotationTable):
+    valid = annotations.valid
+    neighbour = numpy.zeros(valid.shape, dtype=bool)
+    neighbour[1:] |= valid[:-1]
+    neighbour[:-1] |= valid[1:]
+    return set(numpy.nonzero(valid & neighbour)[0].tolist())
+
+  return set([k for k in annotations.keys() if annotations.has_key(k-1) or \
+      annotations.has_key(k+1)])
+
+def gray_frames(video):
+  """Decodes and converts the frames of a video to gray-scale, one at a time
+
+  Keyword parameters:
+
+  video
+    An iterable over the (RGB) frames of a video, such as a
+    ``bob.io.VideoReader``
+
+  This is a generator: a frame is only decoded when the previous one has been
+  consumed, so memory usage does not depend on the video length.
+  """
+
+  import bob
+
+  for frame in video: yield bob.ip.rgb_to_gray(frame)
+
+def prefetch(iterable, depth):
+  """Produces the items of an iterable in a background thread, ahead of their
+  consumption
+
+  Keyword parameters:
+
+  iterable
+    The iterable to consume in the background, e.g. :py:func:`gray_frames`
+
+  depth
+    The maximum number of items waiting to be consumed. If smaller than 1,
+    the items are produced by the calling thread, as they are consumed.
+
+  This is a generator that yields the items of ``iterable``, in order. While
+  the consumer works on one item, the following ones (up to ``depth``) are
+  produced, so decoding a video overlaps with the processing of its frames
+  (to the extent the decoder releases the interpreter lock). Exceptions raised
+  by the iterable are re-raised by the consumer. If the consumer stops early,
+  the background thread stops as well.
+  """
+
+  import sys
+  import threading
+  import Queue
+
+  if depth < 1:
+    for item in iterable: yield item
+    return
+
+  queue = Queue.Queue(depth)
+  stop = threading.Event()
+  end = object() #marks the end of the iterable
+
+  def put(item):
+    """Waits for space on the queue, unless the consumer has stopped"""
+
+    while not stop.is_set():
+      try:
+        queue.put(item, timeout=0.1)
+        return True
+      except Queue.Full:
+        pass
+    return False
+
+  def produce():
+    try:
+      for item in iterable:
+        if not put((item, None)): return
+      put((end, None))
+    except:
+      put((end, sys.exc_info()))
+
+  thread = threading.Thread(target=produce)
+  thread.daemon = True
+  thread.start()
+
+  try:
+    while True:
+      item, error = queue.get()
+      if item is end:
+        if error is not None: raise error[0], error[1], error[2]
+        return
+      yield item
+  finally:
+    stop.set()
+
+def light_normalized_frames(frames, annotations, normalize, start=0,
+    used_only=False):
+  """Light-normalizes gray-scaled frames as they are produced
+
+  Keyword parameters:
+
+  frames
+    An iterable over gray-scaled frames (e.g. :py:func:`gray_frames`)
+
+  annotations
+    Annotations for the video, keyed by frame number
+
+  normalize
+    A callable that light-normalizes a single frame in place, given its
+    annotation, such as :py:func:`light_normalize_histogram_frame`. If set to
+    ``None``, frames are passed through unchanged.
+
+  start
+    The frame number of the first frame produced by ``frames``
+
+  used_only
+    If set, only frames that are used by the difference step (see
+    :py:func:`used_frames`) are normalized. Features calculated from the
+    frames do not change.
+
+  This is a generator that yields every frame, normalized if it is annotated.
+  """
+
+  from .annotations import AnnotationTable
+
+  if normalize is None: keys = ()
+  elif used_only: keys = used_frames(annotations)
+  else: keys = annotations
+
+  lookup = annotations.get
+  if isinstance(annotations, AnnotationTable): lookup = annotations.regions
+
+  for key, frame in enumerate(frames, start):
+    if key in keys: normalize(frame, lookup(key))
+    yield frame
+
+def frame_pairs(frames):
+  """Yields tuples of consecutive frames ``(previous, current)``, keeping only
+  a two-frame window of the input iterable in memory."""
+
+  previous = None
+  for current in frames:
+    if previous is not None: yield previous, current
+    previous = current
+
+def frame_differences(frames, annotations, max_center_displacement, start=0,
+    exact=False, integral=False):
+  """Calculates the features of every pair of consecutive frames as they are
+  produced
+
+  Keyword parameters:
+
+  frames
+    An iterable over (light-normalized) gray-scaled frames
+
+  annotations
+    Annotations for the video, keyed by frame number
+
+  max_center_displacement
+    Maximum displacement between eye-centers to consider that particular eye
+    in the calculation.
+
+  start
+    The frame number of the first frame produced by ``frames``
+
+  exact
+    If set, the face remainder is calculated from the exact intersection of
+    the regions involved (see :py:func:`eval_exact_differences`)
+
+  integral
+    If set, all sums are read from a single summed-area table per frame pair
+    (see :py:func:`eval_integral_differences`)
+
+  This is a generator that yields, for every frame except the first, a tuple
+  with the normalized eye and face remainder differences w.r.t. the previous
+  frame (see :py:func:`frame_features`). Differences are calculated on a
+  single scratch buffer, sized for the whole video. The annotations of an
+  :py:class:`.annotations.AnnotationTable` are read from its arrays (see
+  :py:meth:`.annotations.AnnotationTable.regions`).
+  """
+
+  from .annotations import AnnotationTable
+
+  buffer = DifferenceBuffer.from_annotations(annotations)
+
+  lookup = annotations.get
+  if isinstance(annotations, AnnotationTable): lookup = annotations.regions
+
+  curr_annot = lookup(start)
+  for key, use_frames in enumerate(frame_pairs(frames), start+1):
+    prev_annot, curr_annot = curr_annot, lookup(key)
+    yield frame_features(use_frames, (prev_annot, curr_annot),
+        max_center_displacement, buffer, exact, integral)
+
+def flandmark_calculate_eye_region(annotations, width_enlargement=0.1,
+    height_proportion=0.5):
   """Increments each annotation with the eye-regions calculated taking into
   consideration the landmarks were extracted automatically using flandmark.
   
@@ -115,6 +553,17 @@ def flandmark_calculate_eye_region(annotations):
   bounding-boxes respectively. It also creates an new entry called
   ``eye_centers`` which contains 2-tuples with the estimated eye-centers for
   the right and left eyes respectively.
+
+  Keyword parameters:
+
+  annotations
+    The annotation (dictionary with a ``landmark`` entry) to be incremented
+
+  width_enlargement
+    Bounding box width extra w.r.t. eye width
+
+  height_proportion
+    Bounding box height proportion w.r.t. eye width
   """
 
   from scipy.spatial.distance import euclidean
@@ -122,9 +571,6 @@ def flandmark_calculate_eye_region(annotations):
   center, ic_reye, ic_leye, r_mouth, l_mouth, oc_reye, oc_leye, nose = \
       annotations['landmark']
 
-  width_enlargement = 0.1 #bounding box width extra w.r.t. eye width
-  height_proportion = 0.5 #bounding box height proportion w.r.t. eye width
-
   annotations['eye_centers'] = (
       (
         int(round( ( ic_reye[0] + oc_reye[0] ) / 2.0 )),
@@ -208,6 +654,111 @@ def flandmark_calculate_face_remainder(annotations):
 
   return annotations['face_remainder']
 
+def round_half_away(arr):
+  """Rounds the elements of an array to the nearest integer, with halves
+  rounded away from zero, as Python's built-in ``round()`` does. Returns an
+  ``int64`` array."""
+
+  arr = numpy.asarray(arr, dtype='float64')
+  magnitude = numpy.abs(arr)
+  retval = numpy.floor(magnitude)
+  retval += (magnitude - retval) >= 0.5
+  return (numpy.sign(arr) * retval).astype('int64')
+
+def flandmark_eye_regions(landmarks, width_enlargement=0.1,
+    height_proportion=0.5):
+  """Calculates the eye regions and eye-centers for many frames at once
+
+  This is the vectorized version of :py:func:`flandmark_calculate_eye_region`
+  and produces exactly the same results.
+
+  Keyword parameters:
+
+  landmarks
+    An array ``(T,8,2)`` with the flandmark key-points for ``T`` frames
+
+  width_enlargement
+    Bounding box width extra w.r.t. eye width
+
+  height_proportion
+    Bounding box height proportion w.r.t. eye width
+
+  Returns a tuple with two ``int64`` arrays: the right and left eye
+  bounding-boxes ``(T,2,4)`` and the right and left eye-centers ``(T,2,2)``.
+  """
+
+  landmarks = numpy.asarray(landmarks, dtype='float64')
+  ic_reye, ic_leye = landmarks[:,1], landmarks[:,2]
+  oc_reye, oc_leye = landmarks[:,5], landmarks[:,6]
+
+  eye_centers = numpy.ndarray((len(landmarks), 2, 2), dtype='float64')
+  eye_centers[:,0] = (ic_reye + oc_reye) / 2.0
+  eye_centers[:,1] = (ic_leye + oc_leye) / 2.0
+
+  def eye_box(corner, origin):
+    """Calculates the bounding-box of an eye given its other corner and the
+    corner on the left of the image"""
+
+    width = numpy.sqrt(((corner - origin)**2).sum(axis=1))
+    retval = numpy.ndarray((len(width), 4), dtype='float64')
+    retval[:,0] = origin[:,0] - ((width_enlargement * width)/2.0)
+    retval[:,1] = origin[:,1] - ((height_proportion * width)/2.0)
+    retval[:,2] = ( 1.0 + width_enlargement ) * width
+    retval[:,3] = height_proportion * width
+    return retval
+
+  eyes = numpy.ndarray((len(landmarks), 2, 4), dtype='float64')
+  eyes[:,0] = eye_box(ic_reye, oc_reye) # note: right-eye is on the left
+  eyes[:,1] = eye_box(oc_leye, ic_leye) # note: left-eye is on the right
+
+  return round_half_away(eyes), round_half_away(eye_centers)
+
+def flandmark_face_remainders(landmarks):
+  """Calculates the face remainder regions for many frames at once
+
+  This is the vectorized version of
+  :py:func:`flandmark_calculate_face_remainder` and produces exactly the same
+  results.
+
+  Keyword parameters:
+
+  landmarks
+    An array ``(T,8,2)`` with the flandmark key-points for ``T`` frames
+
+  Returns an ``int64`` array ``(T,4)`` with the face remainder bounding-boxes.
+  """
+
+  width_enlargement = 0.3 #eye outer corner distance extra width
+  nose_distance_proportion = 1.6 #eye -> nose height enlargement
+  mouth_distance_proportion = 1.3 #nose -> mouth height enlargement
+
+  def distance(a, b):
+    return numpy.sqrt(((a - b)**2).sum(axis=1))
+
+  landmarks = numpy.asarray(landmarks, dtype='float64')
+  ic_reye, ic_leye = landmarks[:,1], landmarks[:,2]
+  r_mouth, l_mouth = landmarks[:,3], landmarks[:,4]
+  oc_reye, oc_leye = landmarks[:,5], landmarks[:,6]
+  nose = landmarks[:,7]
+
+  width = distance(oc_reye, oc_leye)
+  eye_center = (ic_leye + ic_reye) / 2.0
+  nose_distance = distance(eye_center, nose)
+
+  extra_on_right_side = width_enlargement * width / 2.0
+  extra_on_top_side = nose_distance_proportion * nose_distance / 2.0
+
+  mouth_center = (r_mouth + l_mouth) / 2.0
+  mouth_distance = distance(eye_center, mouth_center)
+
+  retval = numpy.ndarray((len(landmarks), 4), dtype='float64')
+  retval[:,0] = oc_reye[:,0] - extra_on_right_side
+  retval[:,1] = eye_center[:,1] - extra_on_top_side
+  retval[:,2] = (1.0+width_enlargement)*width
+  retval[:,3] = extra_on_top_side + (mouth_distance_proportion * mouth_distance)
+
+  return round_half_away(retval)
+
 def flandmark_load_annotations(obj, dir, verbose):
   """Loads annotations for the given object from the directory/extension given
   as input.
@@ -237,7 +788,14 @@ def flandmark_load_annotations(obj, dir, verbose):
     configuration used and must be interpreted accordingly.
   """
 
-  retval = load_annotations(obj, dir, '.flandmark', verbose)
+  return flandmark_read_annotations(obj.make_path(dir, '.flandmark'), verbose)
+
+def flandmark_read_annotations(filename, verbose):
+  """Reads (flandmark) annotations from a given file. See
+  :py:func:`flandmark_load_annotations` for details on the returned
+  dictionary."""
+
+  retval = read_annotations(filename, verbose)
   for v in retval.itervalues(): flandmark_calculate_eye_region(v)
   for v in retval.itervalues(): flandmark_calculate_face_remainder(v)
   return retval
@@ -248,13 +806,84 @@ def select(arr, bbx):
   x, y, width, height = bbx
   return arr[y:(y+height), x:(x+width)].astype('int32')
 
-def diff(prev, curr, bbx):
+def diff(prev, curr, bbx, out=None):
   """Calculates the absolute pixel-by-pixel differences between to consecutive
   frames, given a bounding-box region of interest.
+
+  If ``out`` is given, it should be a 2D ``int32`` array at least as large as
+  the bounding-box. The differences are then calculated in place, on its
+  top-left corner, and a view to that area is returned, so no temporaries are
+  allocated.
   """
-  return abs(select(curr, bbx) - select(prev, bbx))
 
-def eval_eyes_difference(frames, annotations, max_center_displacement):
+  if out is None: return abs(select(curr, bbx) - select(prev, bbx))
+
+  x, y, width, height = bbx
+  curr = curr[y:(y+height), x:(x+width)]
+  out = out[:curr.shape[0], :curr.shape[1]]
+  numpy.subtract(curr, prev[y:(y+height), x:(x+width)], out=out,
+      dtype='int32', casting='unsafe')
+  return numpy.absolute(out, out)
+
+class DifferenceBuffer(object):
+  """A scratch buffer for calculating frame differences without allocating
+  temporaries (see :py:func:`diff`)
+
+  The buffer grows as needed. To avoid re-allocations during the processing
+  of a video, size it from the annotations using :py:meth:`from_annotations`.
+
+  Keyword parameters:
+
+  height, width
+    The initial size of the buffer
+  """
+
+  def __init__(self, height=0, width=0):
+
+    self.array = numpy.ndarray((height, width), dtype='int32')
+
+  @staticmethod
+  def from_annotations(annotations):
+    """Builds a buffer large enough to hold the differences on the eye and face
+    remainder regions of all given annotations, as well as on their union"""
+
+    from .annotations import AnnotationTable
+
+    if isinstance(annotations, AnnotationTable):
+      valid = annotations.valid
+      if not valid.any(): return DifferenceBuffer()
+      boxes = numpy.concatenate((annotations.eyes[valid],
+        annotations.face_remainder[valid][:,numpy.newaxis]), axis=1)
+      top = boxes[:,:,1].min(axis=1)
+      left = boxes[:,:,0].min(axis=1)
+      height = (boxes[:,:,1] + boxes[:,:,3]).max(axis=1) - top
+      width = (boxes[:,:,0] + boxes[:,:,2]).max(axis=1) - left
+      return DifferenceBuffer(max(int(height.max()), 0),
+          max(int(width.max()), 0))
+
+    height, width = 0, 0
+    for v in annotations.itervalues():
+      boxes = tuple(v['eyes']) + (v['face_remainder'],)
+      top = min([k[1] for k in boxes])
+      left = min([k[0] for k in boxes])
+      height = max(height, max([k[1]+k[3] for k in boxes]) - top)
+      width = max(width, max([k[0]+k[2] for k in boxes]) - left)
+
+    return DifferenceBuffer(height, width)
+
+  def get(self, bbx):
+    """Returns the buffer array, making sure it is large enough to hold the
+    given bounding-box"""
+
+    height = max(bbx[3], self.array.shape[0])
+    width = max(bbx[2], self.array.shape[1])
+    if (height, width) != self.array.shape:
+      self.array = numpy.ndarray((height, width), dtype='int32')
+
+    return self.array
+
+def eval_eyes_difference(frames, annotations, max_center_displacement,
+    buffer=None):
   """Evaluates the normalized frame difference on the eye region
 
   If annotation is None or invalid, returns 0.
@@ -271,6 +900,9 @@ def eval_eyes_difference(frames, annotations, max_center_displacement):
   max_center_displacement
     Maximum displacement between eye-centers to consider that particular eye
     in the calculation.
+
+  buffer
+    An optional :py:class:`DifferenceBuffer` to calculate the differences in
   """
   
   from scipy.spatial.distance import euclidean
@@ -287,7 +919,8 @@ def eval_eyes_difference(frames, annotations, max_center_displacement):
     displacement = euclidean(prev_annot['eye_centers'][0],
         curr_annot['eye_centers'][0])
     if displacement < max_displacement:
-      d = diff(previous, current, curr_annot['eyes'][0])
+      box = curr_annot['eyes'][0]
+      d = diff(previous, current, box, buffer and buffer.get(box))
       pixels += d.size
       r += d.sum()
 
@@ -295,13 +928,15 @@ def eval_eyes_difference(frames, annotations, max_center_displacement):
     displacement = euclidean(prev_annot['eye_centers'][1], 
       curr_annot['eye_centers'][1])
     if displacement < max_displacement:
-      d = diff(previous, current, curr_annot['eyes'][1])
+      box = curr_annot['eyes'][1]
+      d = diff(previous, current, box, buffer and buffer.get(box))
       pixels += d.size
       r += d.sum()
     
   return r, pixels
 
-def eval_face_remainder_difference(frames, annotations, eye_diff, eye_pixels):
+def eval_face_remainder_difference(frames, annotations, eye_diff, eye_pixels,
+    buffer=None):
   """Evaluates the normalized frame difference on the face remainder
 
   If annotation is None or invalid, returns 0
@@ -319,6 +954,9 @@ def eval_face_remainder_difference(frames, annotations, eye_diff, eye_pixels):
 
   eye_pixels
     The total number of pixels in the eye region.
+
+  buffer
+    An optional :py:class:`DifferenceBuffer` to calculate the differences in
   """
   
   previous, current = frames
@@ -326,7 +964,8 @@ def eval_face_remainder_difference(frames, annotations, eye_diff, eye_pixels):
 
   if prev_annot and curr_annot:
 
-    face = diff(previous, current, curr_annot['face_remainder'])
+    box = curr_annot['face_remainder']
+    face = diff(previous, current, box, buffer and buffer.get(box))
     remainder = face.sum() - eye_diff
     remainder_size = face.size - eye_pixels
 
@@ -339,13 +978,562 @@ def eval_face_remainder_difference(frames, annotations, eye_diff, eye_pixels):
 
   return 0, 0 
 
+def clip_box(bbx, shape):
+  """Returns the region of an array of the given shape that is selected by a
+  bounding-box, following the same (slicing) rules as :py:func:`select`.
+
+  The region is returned as a tuple ``(y0, y1, x0, x1)``. If the bounding-box
+  selects no pixels, ``y1 <= y0`` or ``x1 <= x0``.
+  """
+
+  x, y, width, height = bbx
+  y0, y1, _ = slice(y, y+height).indices(shape[0])
+  x0, x1, _ = slice(x, x+width).indices(shape[1])
+  return y0, max(y0, y1), x0, max(x0, x1)
+
+def eval_exact_differences(frames, annotations, max_center_displacement,
+    buffer=None):
+  """Evaluates the frame differences on the eye region and on the exact face
+  remainder
+
+  Differently from :py:func:`eval_face_remainder_difference`, the face
+  remainder is calculated from the intersections of the rectangles involved:
+  it is made of the pixels in the face remainder bounding-box that are not
+  covered by any of the eyes considered in the eye difference. A single
+  difference is calculated over the union of all regions. Eye differences are
+  the same as the ones returned by :py:func:`eval_eyes_difference`.
+
+  Keyword Parameters:
+
+  frames
+    A tuple with two frames with which to calculate the frame differences. Both
+    frames need to be gray-scaled
+
+  annotations
+    Annotations for the two frames (dictionaries with ``eyes``,
+    ``eye_centers`` and ``face_remainder`` fields)
+
+  max_center_displacement
+    Maximum displacement between eye-centers to consider that particular eye
+    in the calculation.
+
+  buffer
+    An optional :py:class:`DifferenceBuffer` to calculate the differences in
+
+  Returns a tuple with the eye difference, the number of eye pixels, the face
+  remainder difference and the number of face remainder pixels. If any of the
+  annotations is None or invalid, returns zeros.
+  """
+
+  from scipy.spatial.distance import euclidean
+
+  previous, current = frames
+  prev_annot, curr_annot = annotations
+
+  if not (prev_annot and curr_annot): return 0., 0, 0, 0
+
+  eyes = []
+  for k in (0, 1):
+    max_displacement = max_center_displacement * curr_annot['eyes'][k][2]
+    displacement = euclidean(prev_annot['eye_centers'][k],
+        curr_annot['eye_centers'][k])
+    if displacement < max_displacement:
+      eyes.append(clip_box(curr_annot['eyes'][k], current.shape))
+
+  face = clip_box(curr_annot['face_remainder'], current.shape)
+
+  regions = [k for k in [face] + eyes if k[1] > k[0] and k[3] > k[2]]
+  if not regions: return 0., 0, 0, 0
+
+  y0 = min([k[0] for k in regions])
+  y1 = max([k[1] for k in regions])
+  x0 = min([k[2] for k in regions])
+  x1 = max([k[3] for k in regions])
+  union = (x0, y0, x1-x0, y1-y0)
+  d = diff(previous, current, union, buffer and buffer.get(union))
+
+  r = 0.
+  pixels = 0
+  covered = numpy.zeros(d.shape, dtype=bool)
+  for ey0, ey1, ex0, ex1 in eyes:
+    area = (slice(ey0-y0, ey1-y0), slice(ex0-x0, ex1-x0))
+    pixels += d[area].size
+    r += d[area].sum()
+    covered[area] = True
+
+  remainder = numpy.zeros(d.shape, dtype=bool)
+  remainder[(face[0]-y0):(face[1]-y0), (face[2]-x0):(face[3]-x0)] = True
+  remainder &= ~covered
+
+  return r, pixels, d[remainder].sum(), int(remainder.sum())
+
+class IntegralDifference(object):
+  """The summed-area table (integral image) of the absolute differences between
+  two frames over a region of interest
+
+  Once built, the sum of the differences in any rectangle inside the region can
+  be read in constant time, so many candidate regions (e.g. eye regions with
+  different geometries) can be evaluated for the cost of a single difference.
+
+  Keyword parameters:
+
+  previous, current
+    The two (gray-scaled) frames to calculate the differences from
+
+  bbx
+    The bounding-box of the region of interest, as ``(x, y, width,
+    height)``. It is clipped to the frames following the same rules as
+    :py:func:`select`.
+  """
+
+  def __init__(self, previous, current, bbx):
+
+    self.shape = current.shape
+    self.region = clip_box(bbx, self.shape)
+    y0, y1, x0, x1 = self.region
+
+    d = diff(previous, current, (x0, y0, x1-x0, y1-y0))
+    self.table = numpy.zeros((d.shape[0]+1, d.shape[1]+1), dtype='int64')
+    numpy.cumsum(d, axis=0, dtype='int64', out=self.table[1:,1:])
+    numpy.cumsum(self.table[1:,1:], axis=1, out=self.table[1:,1:])
+
+  def area(self, region):
+    """Returns the sum of the differences and the number of pixels in a region
+    ``(y0, y1, x0, x1)`` given in frame coordinates, which must be inside the
+    region of interest."""
+
+    y0, y1, x0, x1 = region
+    if y1 <= y0 or x1 <= x0: return 0, 0
+
+    ry0, ry1, rx0, rx1 = self.region
+    if y0 < ry0 or y1 > ry1 or x0 < rx0 or x1 > rx1:
+      raise RuntimeError, "Region %s is not inside the region of interest %s" \
+          % (region, self.region)
+
+    y0, y1, x0, x1 = y0-ry0, y1-ry0, x0-rx0, x1-rx0
+    t = self.table
+    return t[y1,x1] - t[y0,x1] - t[y1,x0] + t[y0,x0], (y1-y0)*(x1-x0)
+
+  def sum(self, bbx):
+    """Returns the sum of the differences and the number of pixels in a
+    bounding-box ``(x, y, width, height)``, selected as in :py:func:`diff`"""
+
+    return self.area(clip_box(bbx, self.shape))
+
+def intersect_regions(*regions):
+  """Returns the intersection of regions given as ``(y0, y1, x0, x1)``"""
+
+  y0 = max([k[0] for k in regions])
+  y1 = min([k[1] for k in regions])
+  x0 = max([k[2] for k in regions])
+  x1 = min([k[3] for k in regions])
+  return y0, max(y0, y1), x0, max(x0, x1)
+
+def eval_integral_differences(frames, annotations, max_center_displacement,
+    exact=False):
+  """Evaluates the frame differences on the eye region and on the face
+  remainder, using a single summed-area table (see
+  :py:class:`IntegralDifference`)
+
+  The table covers the union of the face bounding-box and the eye and face
+  remainder regions of the current annotation. Results are the same as the
+  ones of :py:func:`eval_eyes_difference` followed by
+  :py:func:`eval_face_remainder_difference` or, if ``exact`` is set, as the
+  ones of :py:func:`eval_exact_differences`.
+
+  Keyword Parameters:
+
+  frames
+    A tuple with two frames with which to calculate the frame differences. Both
+    frames need to be gray-scaled
+
+  annotations
+    Annotations for the two frames (dictionaries with ``bbox``, ``eyes``,
+    ``eye_centers`` and ``face_remainder`` fields)
+
+  max_center_displacement
+    Maximum displacement between eye-centers to consider that particular eye
+    in the calculation.
+
+  exact
+    If set, the face remainder is calculated from the exact intersection of
+    the regions involved, by inclusion-exclusion of the rectangle sums.
+
+  Returns a tuple with the eye difference, the number of eye pixels, the face
+  remainder difference and the number of face remainder pixels. If any of the
+  annotations is None or invalid, returns zeros.
+  """
+
+  from scipy.spatial.distance import euclidean
+
+  previous, current = frames
+  prev_annot, curr_annot = annotations
+
+  if not (prev_annot and curr_annot): return 0., 0, 0, 0
+
+  boxes = (curr_annot['bbox'], curr_annot['face_remainder']) + \
+      tuple(curr_annot['eyes'])
+  regions = [clip_box(k, current.shape) for k in boxes]
+  regions = [k for k in regions if k[1] > k[0] and k[3] > k[2]]
+  if not regions: return 0., 0, 0, 0
+  y0 = min([k[0] for k in regions])
+  y1 = max([k[1] for k in regions])
+  x0 = min([k[2] for k in regions])
+  x1 = max([k[3] for k in regions])
+  table = IntegralDifference(previous, current, (x0, y0, x1-x0, y1-y0))
+
+  r = 0.
+  pixels = 0
+  eyes = []
+  for k in (0, 1):
+    max_displacement = max_center_displacement * curr_annot['eyes'][k][2]
+    displacement = euclidean(prev_annot['eye_centers'][k],
+        curr_annot['eye_centers'][k])
+    if displacement < max_displacement:
+      eyes.append(clip_box(curr_annot['eyes'][k], current.shape))
+      d, size = table.area(eyes[-1])
+      pixels += size
+      r += d
+
+  face = clip_box(curr_annot['face_remainder'], current.shape)
+  remainder, remainder_size = table.area(face)
+
+  if not exact:
+    remainder -= r
+    remainder_size -= pixels
+    if remainder < 0:
+      raise RuntimeError, "Remainder is smaller than zero"
+    return r, pixels, remainder, remainder_size
+
+  # inclusion-exclusion of the eye regions inside the face remainder
+  for eye in eyes:
+    d, size = table.area(intersect_regions(face, eye))
+    remainder -= d
+    remainder_size -= size
+  if len(eyes) == 2:
+    d, size = table.area(intersect_regions(face, *eyes))
+    remainder += d
+    remainder_size += size
+
+  return r, pixels, remainder, remainder_size
+
+def frame_features(frames, annotations, max_center_displacement,
+    buffer=None, exact=False, integral=False):
+  """Calculates the feature vector for a pair of consecutive frames
+
+  Keyword Parameters:
+
+  frames
+    A tuple with two frames with which to calculate the frame differences. Both
+    frames need to be gray-scaled
+
+  annotations
+    Annotations for the two frames (dictionaries with ``eyes``,
+    ``eye_centers`` and ``face_remainder`` fields or ``None``)
+
+  max_center_displacement
+    Maximum displacement between eye-centers to consider that particular eye
+    in the calculation.
+
+  buffer
+    An optional :py:class:`DifferenceBuffer` to calculate the differences in
+
+  exact
+    If set, the face remainder is calculated from the exact intersection of
+    the regions involved (see :py:func:`eval_exact_differences`)
+
+  integral
+    If set, all sums are read from a single summed-area table (see
+    :py:func:`eval_integral_differences`). Results are the same.
+
+  Returns a tuple with the normalized eye and face remainder differences. If
+  no eye pixels are available, the eye difference is set to 0. If no face
+  remainder pixels are available, the face remainder difference is set to 1.
+  """
+
+  if integral:
+    eye_diff, eye_pixels, facerem_diff, facerem_pixels = \
+        eval_integral_differences(frames, annotations,
+            max_center_displacement, exact)
+  elif exact:
+    eye_diff, eye_pixels, facerem_diff, facerem_pixels = \
+        eval_exact_differences(frames, annotations, max_center_displacement,
+            buffer)
+  else:
+    eye_diff, eye_pixels = eval_eyes_difference(frames, annotations,
+        max_center_displacement, buffer)
+    facerem_diff, facerem_pixels = eval_face_remainder_difference(frames,
+        annotations, eye_diff, eye_pixels, buffer)
+
+  if eye_pixels != 0: eye = eye_diff/float(eye_pixels)
+  else: eye = 0.
+
+  if facerem_pixels != 0: facerem = facerem_diff/float(facerem_pixels)
+  else: facerem = 1.
+
+  return eye, facerem
+
+def annotation_arrays(annotations, length):
+  """Converts annotations from a dictionary keyed by frame number into arrays
+
+  Keyword parameters:
+
+  annotations
+    The annotations as returned by :py:func:`flandmark_load_annotations`
+
+  length
+    The number of frames in the video
+
+  Returns a tuple of arrays ``(valid, eyes, eye_centers, face_remainder)``
+  with shapes ``(T,)``, ``(T,2,4)``, ``(T,2,2)`` and ``(T,4)``. ``valid`` is
+  a boolean mask indicating which frames are annotated. Entries for frames
+  that are not annotated are set to zero.
+  """
+
+  valid = numpy.zeros((length,), dtype=bool)
+  eyes = numpy.zeros((length, 2, 4), dtype='int32')
+  eye_centers = numpy.zeros((length, 2, 2), dtype='int32')
+  face_remainder = numpy.zeros((length, 4), dtype='int32')
+
+  for key, v in annotations.iteritems():
+    if key < 0 or key >= length: continue
+    valid[key] = True
+    eyes[key] = v['eyes']
+    eye_centers[key] = v['eye_centers']
+    face_remainder[key] = v['face_remainder']
+
+  return valid, eyes, eye_centers, face_remainder
+
+def clip_boxes(boxes, shape):
+  """Vectorized version of :py:func:`clip_box`
+
+  Keyword parameters:
+
+  boxes
+    An array of bounding-boxes with shape ``(..., 4)``, each one defined as
+    ``(x, y, width, height)``
+
+  shape
+    The shape of the (2D) frames the boxes refer to
+
+  Returns an array of shape ``(..., 4)`` with the regions ``(y0, y1, x0, x1)``
+  selected by the bounding-boxes.
+  """
+
+  def indices(start, stop, size):
+    """Resolves slice boundaries like Python does for positive steps"""
+
+    start = numpy.where(start < 0, start + size, start)
+    stop = numpy.where(stop < 0, stop + size, stop)
+    start = numpy.clip(start, 0, size)
+    stop = numpy.clip(stop, 0, size)
+    return start, numpy.maximum(start, stop)
+
+  boxes = numpy.asarray(boxes, dtype='int64')
+  x, y, width, height = [boxes[...,k] for k in range(4)]
+  y0, y1 = indices(y, y + height, shape[0])
+  x0, x1 = indices(x, x + width, shape[1])
+  return numpy.concatenate([k[...,numpy.newaxis] for k in (y0, y1, x0, x1)],
+      axis=-1)
+
+def video_features(frames, valid, eyes, eye_centers, face_remainder,
+    max_center_displacement, exact=False, block=32):
+  """Calculates the features of a whole video (or part of it) at once
+
+  This is equivalent to calling :py:func:`frame_features` on every pair of
+  consecutive frames, but frame differences are calculated for many frames in
+  one go, over the union of all regions of interest, and region sums are read
+  from summed-area tables.
+
+  Keyword parameters:
+
+  frames
+    A 3D array ``(T, H, W)`` with the (light-normalized) gray-scaled frames
+
+  valid, eyes, eye_centers, face_remainder
+    The annotations for the ``T`` frames, as returned by
+    :py:func:`annotation_arrays`
+
+  max_center_displacement
+    Maximum displacement between eye-centers to consider that particular eye
+    in the calculation.
+
+  exact
+    If set, the face remainder is calculated from the exact intersection of
+    the regions involved (see :py:func:`eval_exact_differences`)
+
+  block
+    The number of frame differences to calculate at once. Memory usage grows
+    linearly with this number.
+
+  Returns a 2D array ``(T, 2)`` with the normalized eye and face remainder
+  differences for every frame. The first row, for which there is no previous
+  frame, is set to NaN.
+  """
+
+  frames = numpy.asarray(frames)
+  valid = numpy.asarray(valid, dtype=bool)
+  length = len(frames)
+
+  retval = numpy.ndarray((length, 2), dtype='float64')
+  retval[:1] = numpy.NaN
+  retval[1:] = (0., 1.)
+  if length < 2: return retval
+
+  # pairs (k-1, k) for which both frames are annotated
+  used = valid[1:] & valid[:-1]
+  if not used.any(): return retval
+  pairs = numpy.nonzero(used)[0] + 1
+
+  curr_eyes = numpy.asarray(eyes, dtype='int64')[pairs]
+  curr_centers = numpy.asarray(eye_centers, dtype='float64')[pairs]
+  prev_centers = numpy.asarray(eye_centers, dtype='float64')[pairs-1]
+  displacement = numpy.sqrt(((curr_centers - prev_centers)**2).sum(axis=2))
+  accepted = displacement < (max_center_displacement * curr_eyes[:,:,2])
+
+  shape = frames.shape[1:]
+  eye_regions = clip_boxes(curr_eyes, shape) #(P, 2, 4)
+  face = clip_boxes(numpy.asarray(face_remainder)[pairs], shape) #(P, 4)
+
+  # the union of all regions that will be needed
+  regions = numpy.vstack((face, eye_regions.reshape(-1, 4)))
+  regions = regions[(regions[:,1] > regions[:,0]) & \
+      (regions[:,3] > regions[:,2])]
+  if not len(regions): return retval
+  y0, x0 = regions[:,0].min(), regions[:,2].min()
+  y1, x1 = regions[:,1].max(), regions[:,3].max()
+
+  # empty regions may lie outside the union, move them to its origin
+  for r in (face, eye_regions):
+    empty = (r[...,1] <= r[...,0]) | (r[...,3] <= r[...,2])
+    r[empty] = (y0, y0, x0, x0)
+  face = face - (y0, y0, x0, x0)
+  eye_regions = eye_regions - (y0, y0, x0, x0)
+
+  def area_sums(table, region):
+    """Reads the sums of one region per table"""
+
+    index = numpy.arange(len(table))
+    ry0, ry1, rx0, rx1 = [region[:,k] for k in range(4)]
+    return table[index,ry1,rx1] - table[index,ry0,rx1] - \
+        table[index,ry1,rx0] + table[index,ry0,rx0]
+
+  def area_sizes(region):
+    """Calculates the number of pixels in a region"""
+
+    return (region[:,1] - region[:,0]) * (region[:,3] - region[:,2])
+
+  def intersect(*regions):
+    """Intersects regions"""
+
+    ry0 = numpy.max([k[:,0] for k in regions], axis=0)
+    ry1 = numpy.min([k[:,1] for k in regions], axis=0)
+    rx0 = numpy.max([k[:,2] for k in regions], axis=0)
+    rx1 = numpy.min([k[:,3] for k in regions], axis=0)
+    return numpy.vstack((ry0, numpy.maximum(ry0, ry1), rx0,
+      numpy.maximum(rx0, rx1))).T
+
+  eye_sum = numpy.zeros((len(pairs),), dtype='int64')
+  eye_size = numpy.zeros((len(pairs),), dtype='int64')
+  face_sum = numpy.zeros((len(pairs),), dtype='int64')
+  face_size = numpy.zeros((len(pairs),), dtype='int64')
+
+  crop = frames[:, y0:y1, x0:x1]
+  table = numpy.zeros((block, y1-y0+1, x1-x0+1), dtype='int64')
+
+  for start in range(0, len(pairs), block):
+    sel = slice(start, start+block)
+    k = pairs[sel]
+    t = table[:len(k)]
+    d = numpy.subtract(crop[k], crop[k-1], dtype='int32', casting='unsafe')
+    numpy.absolute(d, d)
+    numpy.cumsum(d, axis=1, dtype='int64', out=t[:,1:,1:])
+    numpy.cumsum(t[:,1:,1:], axis=2, out=t[:,1:,1:])
+
+    for e in (0, 1):
+      ok = accepted[sel,e]
+      eye_sum[sel] += numpy.where(ok, area_sums(t, eye_regions[sel,e]), 0)
+      eye_size[sel] += numpy.where(ok, area_sizes(eye_regions[sel,e]), 0)
+
+    face_sum[sel] = area_sums(t, face[sel])
+    face_size[sel] = area_sizes(face[sel])
+
+    if exact:
+      # inclusion-exclusion of the eye regions inside the face remainder
+      for e in (0, 1):
+        ok = accepted[sel,e]
+        overlap = intersect(face[sel], eye_regions[sel,e])
+        face_sum[sel] -= numpy.where(ok, area_sums(t, overlap), 0)
+        face_size[sel] -= numpy.where(ok, area_sizes(overlap), 0)
+      ok = accepted[sel,0] & accepted[sel,1]
+      overlap = intersect(face[sel], eye_regions[sel,0], eye_regions[sel,1])
+      face_sum[sel] += numpy.where(ok, area_sums(t, overlap), 0)
+      face_size[sel] += numpy.where(ok, area_sizes(overlap), 0)
+
+  if not exact:
+    face_sum -= eye_sum
+    face_size -= eye_size
+    if (face_sum < 0).any():
+      raise RuntimeError, "Remainder is smaller than zero"
+
+  features = retval[pairs]
+  has_eyes = eye_size != 0
+  features[has_eyes,0] = eye_sum[has_eyes] / eye_size[has_eyes].astype('float64')
+  has_face = face_size != 0
+  features[has_face,1] = face_sum[has_face] / \
+      face_size[has_face].astype('float64')
+  features[~has_eyes,0] = 0.
+  features[~has_face,1] = 1.
+  retval[pairs] = features
+
+  return retval
+
+def frame_blocks(frames, size):
+  """Groups frames produced one at a time in 3D arrays
+
+  Consecutive blocks overlap by one frame, so that the differences between all
+  consecutive frames can be calculated from the blocks.
+
+  Keyword parameters:
+
+  frames
+    An iterable over (light-normalized) gray-scaled frames
+
+  size
+    The maximum number of frames on every block
+
+  This is a generator yielding tuples containing the index of the first frame
+  of the block and the block itself. The same array is re-used for all blocks,
+  so every block must be consumed before the next one is requested.
+  """
+
+  if size < 2: raise RuntimeError, "Blocks should contain at least 2 frames"
+
+  start = 0
+  block = None
+  count = 0
+  for frame in frames:
+    if block is None:
+      block = numpy.ndarray((size,) + frame.shape, dtype=frame.dtype)
+    elif count == size:
+      yield start, block
+      block[0] = block[-1]
+      start += size - 1
+      count = 1
+    block[count] = frame
+    count += 1
+
+  if count > 1 or (start == 0 and count): yield start, block[:count]
+
 def rmean(arr):
   """Calculates the running mean in a 1D numpy array"""
-  return numpy.array([numpy.mean(arr[:(k+1)]) for k in range(len(arr))])
+  from .moments import cumulative_mean
+  return cumulative_mean(arr)
 
 def rstd(arr):
   """Calculates the running standard deviation (biased estimator) in a 1D numpy array"""
-  return numpy.array([numpy.std(arr[:(k+1)]) for k in range(len(arr))])
+  from .moments import cumulative_std
+  return cumulative_std(arr)
 
 def score(data):
   '''Calculates the score in any given input frame.
@@ -374,9 +1562,10 @@ def score(data):
   denominator = numpy.copy(data[:,1])
   denominator[denominator == 0.0] = 1.0
 
+  from .moments import cumulative_moments
+
   norm = replace_nan(data[:,0]/denominator)
-  rm = rmean(norm)
-  rs = rstd(norm)
+  rm, rs = cumulative_moments(norm)
   retval = norm - rm
   retval[data[:,0] == 0.0] = rm[data[:,0] == 0.0]
   retval[abs(retval) < rs] = rm[abs(retval) < rs]
@@ -402,10 +1591,11 @@ def count_blinks(scores, std_thres, skip_frames):
     method to falsely detect positives following a successful detection.
   """
 
+  from .moments import cumulative_moments
+
   detected = 0
   skip = skip_frames #start by skipping the initial frames
-  rm = rmean(scores)
-  rs = rstd(scores)
+  rm, rs = cumulative_moments(scores)
   retval = numpy.ndarray((len(scores),), dtype='float64')
 
   for k, score in enumerate(scores):
@@ -421,3 +1611,230 @@ def count_blinks(scores, std_thres, skip_frames):
     retval[k] = detected
 
   return retval
+
+def stack_sequences(sequences):
+  """Stacks 1D sequences of possibly different lengths as rows of a 2D array.
+
+  Rows shorter than the longest sequence are padded with NaNs at the end.
+  """
+
+  length = max([len(k) for k in sequences]) if len(sequences) else 0
+  retval = numpy.ndarray((len(sequences), length), dtype='float64')
+  retval[:] = numpy.NaN
+  for row, seq in zip(retval, sequences): row[:len(seq)] = seq
+  return retval
+
+def count_blinks_batch(scores, std_thres, skip_frames, lengths=None):
+  """Counts blinks in many score sequences at once
+
+  This is equivalent to calling :py:func:`count_blinks` on every row of the
+  input, but the refractory period (``skip_frames``) is handled by jumping
+  between candidate peaks of all rows simultaneously, so the number of Python
+  iterations is bound by the maximum number of blinks in a row rather than by
+  the number of frames.
+
+  Keyword arguments
+
+  scores
+    A 2D array with one score sequence per row. Sequences shorter than the
+    longest one should be NaN-padded at the end (see
+    :py:func:`stack_sequences`).
+
+  std_thres
+    The threshold applied on the current point being analized in the scores
+    to check for valid blinks (in number of standard deviations from the
+    running average).
+
+  skip_frames
+    How many frames to skip before start eye-blink detection again (after an
+    eye-blink has been successfuly detected).
+
+  lengths
+    The length of each sequence. If not given, it is inferred from the
+    trailing NaNs of every row.
+
+  Returns a 2D array of the same shape as the input with the cumulative number
+  of blinks detected on every row. Padded positions are set to NaN.
+  """
+
+  from .moments import cumulative_moments
+
+  scores = numpy.asarray(scores, dtype='float64')
+  if scores.ndim == 1:
+    return count_blinks_batch(scores[numpy.newaxis], std_thres, skip_frames,
+        None if lengths is None else [lengths])[0]
+
+  rows, length = scores.shape
+  positions = numpy.arange(length)
+
+  if lengths is None and not length:
+    lengths = numpy.zeros((rows,), dtype='int64')
+  elif lengths is None:
+    reversed_valid = ~numpy.isnan(scores[:,::-1])
+    lengths = length - reversed_valid.argmax(axis=1)
+    lengths[~reversed_valid.any(axis=1)] = 0
+  lengths = numpy.asarray(lengths, dtype='int64')
+  padding = positions[numpy.newaxis,:] >= lengths[:,numpy.newaxis]
+
+  # prefix statistics are not affected by the padding at the end of each row
+  rm, rs = cumulative_moments(scores)
+  old_settings = numpy.seterr(invalid='ignore')
+  candidate = (scores - rm) >= (std_thres * rs)
+  numpy.seterr(**old_settings)
+  candidate[padding] = False
+
+  # for every position, the index of the next candidate peak (or ``length``)
+  following = numpy.where(candidate, positions, length)
+  following = numpy.minimum.accumulate(following[:,::-1], axis=1)[:,::-1]
+  following = numpy.hstack((following,
+    numpy.repeat(length, rows).reshape(rows, 1)))
+
+  detections = numpy.zeros((rows, length), dtype='int64')
+  pointer = numpy.repeat(min(skip_frames, length), rows)
+  active = numpy.arange(rows)
+
+  while active.size:
+    peak = following[active, pointer[active]]
+    found = peak < length
+    active = active[found]
+    peak = peak[found]
+    detections[active, peak] = 1
+    pointer[active] = numpy.minimum(peak + skip_frames + 1, length)
+
+  retval = numpy.cumsum(detections, axis=1).astype('float64')
+  retval[padding] = numpy.NaN
+  return retval
+
+def stride_skip_frames(skip_frames, stride):
+  """Returns the number of (feature) rows to skip after a detected eye-blink,
+  equivalent to skipping ``skip_frames`` frames on features calculated for
+  every ``stride`` frames (rounded up)"""
+
+  return (skip_frames + stride - 1) // stride
+
+def stride_row(frame, stride):
+  """Returns the (feature) row holding the results up to ``frame`` (inclusive),
+  for features calculated for every ``stride`` frames"""
+
+  return frame // stride
+
+def blink_errors(negatives, positives, blinks):
+  """Calculates the error rates of accepting videos with at least ``blinks``
+  eye-blinks as real accesses
+
+  Keyword parameters:
+
+  negatives
+    The number of blinks detected on every attack video
+
+  positives
+    The number of blinks detected on every real-access video
+
+  blinks
+    The minimum number of blinks for accepting a video
+
+  Returns a tuple with the false acceptance, false rejection and half total
+  error rates, in this order, as calculated by ``bob.measure.farfrr`` with
+  the threshold ``blinks - 0.5``.
+  """
+
+  negatives = numpy.asarray(negatives, dtype='float64')
+  positives = numpy.asarray(positives, dtype='float64')
+  threshold = blinks - 0.5
+
+  far = (negatives >= threshold).mean() if len(negatives) else 0.
+  frr = (positives < threshold).mean() if len(positives) else 0.
+  return far, frr, (far + frr) / 2.
+
+def blink_sweep(negatives, positives, maximum=None):
+  """Calculates the error rates of accepting videos with at least ``b``
+  eye-blinks as real accesses, for every possible ``b`` at once
+
+  Keyword parameters:
+
+  negatives
+    The number of blinks detected on every attack video, as a 1D array, or a
+    2D array with one column for every configuration (e.g. number of frames)
+
+  positives
+    The number of blinks detected on every real-access video, in the same
+    format as ``negatives``
+
+  maximum
+    The largest threshold to evaluate. By default, it is one more than the
+    maximum number of blinks detected, so all videos are rejected at it.
+
+  Returns a tuple with the thresholds (numbers of blinks, from 0 to
+  ``maximum``) and the false acceptance,
+  false rejection and half total error rates. The error rates are 2D arrays,
+  with one row for every threshold and one column for every configuration.
+  At every threshold ``b``, they are the same returned by
+  :py:func:`blink_errors`.
+  """
+
+  def as_counts(k):
+    k = numpy.rint(numpy.asarray(k, dtype='float64')).astype('int64')
+    if k.ndim == 1: k = k.reshape(len(k), 1)
+    return k
+
+  negatives = as_counts(negatives)
+  positives = as_counts(positives)
+  columns = max(negatives.shape[1], positives.shape[1])
+
+  if maximum is None:
+    maximum = 1
+    if negatives.size: maximum = max(maximum, negatives.max() + 1)
+    if positives.size: maximum = max(maximum, positives.max() + 1)
+  maximum = int(maximum)
+  thresholds = numpy.arange(maximum + 1)
+
+  def below(counts):
+    """The number of videos with less blinks than every threshold"""
+
+    retval = numpy.zeros((len(thresholds), columns), dtype='int64')
+    if not counts.size: return retval
+
+    # a histogram of the number of blinks for every column, in one go (more
+    # blinks than the maximum threshold make no difference), accumulated
+    bins = len(thresholds)
+    offsets = counts.clip(0, maximum) + bins * numpy.arange(counts.shape[1])
+    histogram = numpy.bincount(offsets.ravel(),
+        minlength=bins*counts.shape[1]).reshape(counts.shape[1], bins)
+    retval[1:] = numpy.cumsum(histogram, axis=1)[:,:-1].T
+    return retval
+
+  far = numpy.zeros((len(thresholds), columns), dtype='float64')
+  frr = numpy.zeros((len(thresholds), columns), dtype='float64')
+  if len(negatives):
+    far[:] = 1. - below(negatives) / float(len(negatives))
+  if len(positives):
+    frr[:] = below(positives) / float(len(positives))
+
+  return thresholds, far, frr, (far + frr) / 2.
+
+def select_blink_threshold(far, frr, criterion='eer'):
+  """Selects a threshold for every configuration from the error rates
+  returned by :py:func:`blink_sweep`
+
+  Keyword parameters:
+
+  far, frr
+    The false acceptance and false rejection rates, with one row for every
+    threshold and one column for every configuration
+
+  criterion
+    Either ``'eer'``, to select the threshold at which the false acceptance
+    and false rejection rates are the closest, or ``'min-hter'``, to select
+    the threshold with the lowest half total error rate. Ties are resolved in
+    favor of the smallest threshold.
+
+  Returns the index of the selected threshold for every configuration.
+  """
+
+  if criterion == 'min-hter':
+    return numpy.argmin(far + frr, axis=0)
+
+  if criterion == 'eer':
+    return numpy.argmin(numpy.abs(far - frr), axis=0)
+
+  raise ValueError, "unknown threshold criterion `%s'" % criterion
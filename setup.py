@@ -41,6 +41,10 @@ setup(
         'count_blinks.py = antispoofing.eyeblink.script.count_blinks:main',
         'merge_scores.py = antispoofing.eyeblink.script.merge_scores:main',
         'make_movie.py = antispoofing.eyeblink.script.make_movie:main',
+        'cache_annotations.py = antispoofing.eyeblink.script.cache_annotations:main',
+        'stride_report.py = antispoofing.eyeblink.script.stride_report:main',
+        'early_decision.py = antispoofing.eyeblink.script.early_decision:main',
+        'eyeblink_pipeline.py = antispoofing.eyeblink.script.eyeblink_pipeline:main',
         ],
 
       },